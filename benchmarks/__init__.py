@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for the bot. These don't connect to discord, they drive
+the cogs with the fake discord objects from benchmarks.fakes instead.
+"""
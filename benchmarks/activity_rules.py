@@ -0,0 +1,286 @@
+"""
+Measures how long warming the activity engine up from message_log takes.
+
+Fills a real sqlite database in a temporary directory with a synthetic log of
+messages spread over a number of days, where a few users write most of the
+messages like in a real guild, then replays it for a set of rules
+with a per-rule range scan on the partitions (what ActivityTracking does)
+and with a scan of every recent message (what it used to do). Both have to end
+up with the same windows, otherwise the run fails. Rules of at least
+--coarse-hours are counted per hour like with the default HourlyRulePeriod,
+they have to qualify exactly the users with enough messages in the whole hours
+of their window. It also fails if no user meets a fine or a coarse rule, since
+then the qualification isn't checked at all. The full replay reads the
+partitions of the single file store, so ShardDirectory must not be set.
+
+    python -m benchmarks.activity_rules --rows 2000000 --guilds 20
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import random
+import sys
+import time
+from typing import Dict, List, Set, Tuple
+
+from benchmarks.fakes import next_id, offline_bot
+from src.main import PCParadiseBot
+from src.utils.activity_engine import ActivityEngine, ActivityRule
+from src.utils.message_log import COLUMNS, MessageLogRow, MessageLogStore
+
+HOUR = 60 * 60
+# rows are written in chunks so the whole log never has to be in memory.
+CHUNK = 100_000
+
+
+def make_rules(guilds: Dict[int, List[int]]) -> List[ActivityRule]:
+    """
+    Two rules per guild, one counting a couple of channels and one counting
+    every channel, with windows between an hour and a day.
+    """
+    return [
+        ActivityRule(
+            id=next_id(),
+            server_id=server_id,
+            time_period=random.choice((1, 6, 24)) * HOUR,
+            role_id=next_id(),
+            message_count=random.choice((5, 20, 50)),
+            channels=counted,
+        )
+        for server_id, channels in guilds.items()
+        for counted in (frozenset(random.sample(channels, 2)), frozenset())
+    ]
+
+
+async def fill_log(bot: PCParadiseBot, guilds: Dict[int, List[int]], args, now):
+    """
+    Writes args.rows messages spread evenly over the last args.days days. The
+    users' shares follow Zipf's law, the n-th most active user writes 1/n as
+    much as the most active one.
+    """
+    async with bot.db.connection() as database:
+        await database.executemany(
+            "INSERT INTO servers VALUES (?)", [(guild,) for guild in guilds]
+        )
+        await database.commit()
+    users = [next_id() for _ in range(args.users)]
+    shares = list(itertools.accumulate(1 / rank for rank in range(1, len(users) + 1)))
+    servers = list(guilds)
+    span = args.days * 24 * HOUR
+    written = 0
+    while written < args.rows:
+        rows = []
+        authors = random.choices(
+            users, cum_weights=shares, k=min(CHUNK, args.rows - written)
+        )
+        for user_id in authors:
+            server_id = random.choice(servers)
+            rows.append(
+                (
+                    random.choice(guilds[server_id]),
+                    user_id,
+                    now - random.random() * span,
+                    server_id,
+                )
+            )
+        await bot.message_log.insert(rows)
+        written += len(rows)
+
+
+async def range_scan(
+    bot: PCParadiseBot, rules, now, coarse_period: float
+) -> Tuple[ActivityEngine, Dict]:
+    """
+    Warms a fresh engine up with ActivityTracking.replay_history, timing every
+    rule.
+    """
+    cog = bot.get_cog("ActivityTracking")
+    engine = cog.engine = ActivityEngine(coarse_period=coarse_period)
+    engine.load_rules(rules)
+    timings = {}
+    for rule in rules:
+        start = time.perf_counter()
+        await cog.replay_history([rule], now)
+        timings[rule.id] = time.perf_counter() - start
+    return engine, timings
+
+
+async def recent_messages(
+    bot: PCParadiseBot, since: float, until: float
+) -> List[MessageLogRow]:
+    """
+    Every message sent in [since, until), oldest first, read from the
+    partitions of the single file store that overlap it.
+    """
+    rows: List[MessageLogRow] = []
+    async with bot.db.connection() as database:
+        for name in bot.message_log.overlapping(since, until):
+            cur = await database.execute(
+                f"SELECT {COLUMNS} FROM {name} "
+                "WHERE time >= ? AND time < ? ORDER BY time",
+                (since, until),
+            )
+            rows.extend(await cur.fetchall())
+    return rows
+
+
+async def full_scan(
+    bot: PCParadiseBot, rules, now
+) -> Tuple[ActivityEngine, List[MessageLogRow]]:
+    """
+    Warms an engine up by replaying every message in the longest window,
+    returns it with the replayed messages.
+    """
+    engine = ActivityEngine()
+    engine.load_rules(rules)
+    since = now - max(rule.time_period for rule in rules)
+    rows = await recent_messages(bot, since, now)
+    for channel_id, user_id, sent_at, server_id in rows:
+        engine.record(server_id, channel_id, user_id, sent_at)
+    return engine, rows
+
+
+def windows(engine: ActivityEngine, rules: List[ActivityRule], now: float) -> Dict:
+    """
+    The messages of every window of the given rules that still count at now.
+    The full replay also keeps messages that were only in the window of the
+    user's last message.
+    """
+    periods = {rule.id: rule.time_period for rule in rules}
+    trimmed = {
+        key: [sent_at for sent_at in window if sent_at >= now - periods[key[0]]]
+        for key, window in engine.windows.items()
+        if key[0] in periods
+    }
+    return {key: window for key, window in trimmed.items() if window}
+
+
+def met(trimmed: Dict, rules: List[ActivityRule]) -> Set[Tuple[int, int]]:
+    """The (rule id, user id) pairs whose window has enough messages."""
+    counts = {rule.id: rule.message_count for rule in rules}
+    return {key for key, window in trimmed.items() if len(window) >= counts[key[0]]}
+
+
+def hourly_qualified(
+    rows: List[MessageLogRow], rules: List[ActivityRule], now: float
+) -> Set[Tuple[int, int]]:
+    """
+    The (rule id, user id) pairs with enough messages in the hours that lie
+    completely inside the window of a coarse rule, see HourlyWindow.
+    """
+    sent: Dict[Tuple[int, int], int] = {}
+    for rule in rules:
+        since = math.ceil((now - rule.time_period) / HOUR) * HOUR
+        for channel_id, user_id, sent_at, server_id in rows:
+            if (
+                server_id == rule.server_id
+                and rule.applies_to(channel_id)
+                and since <= sent_at < now
+            ):
+                sent[rule.id, user_id] = sent.get((rule.id, user_id), 0) + 1
+    counts = {rule.id: rule.message_count for rule in rules}
+    return {key for key, total in sent.items() if total >= counts[key[0]]}
+
+
+def agree(
+    scanned: ActivityEngine,
+    replayed: ActivityEngine,
+    rows: List[MessageLogRow],
+    rules: List[ActivityRule],
+    now: float,
+) -> bool:
+    """
+    Whether the range scan and the full replay agree, and any user meets a rule.
+    """
+    coarse = [rule for rule in rules if scanned.is_coarse(rule)]
+    fine = [rule for rule in rules if not scanned.is_coarse(rule)]
+    fine_ids = {rule.id for rule in fine}
+    fine_qualified = {key for key in scanned.qualified if key[0] in fine_ids}
+    coarse_qualified = scanned.qualified - fine_qualified
+    print(
+        f"{len(fine_qualified)} (rule, user) pairs meet one of {len(fine)} rules, "
+        f"{len(coarse_qualified)} meet one of {len(coarse)} hourly rules"
+    )
+    expected = windows(replayed, fine, now)
+    if windows(scanned, fine, now) != expected or fine_qualified != met(expected, fine):
+        print("MISMATCH - the range scan and the full replay disagree")
+        return False
+    # an hourly window may qualify a user late, but never early.
+    if coarse_qualified != hourly_qualified(rows, coarse, now) or not (
+        coarse_qualified <= met(windows(replayed, coarse, now), coarse)
+    ):
+        print("MISMATCH - the hourly counts and the full replay disagree")
+        return False
+    if not fine_qualified or (coarse and not coarse_qualified):
+        print("NO MATCHES - no user meets a rule, use more --rows or fewer --users")
+        return False
+    return True
+
+
+async def run_benchmark(args) -> bool:
+    """
+    Runs both warm ups against the same log, returns whether they agree.
+    """
+    random.seed(args.seed)
+    now = time.time()
+    async with offline_bot() as bot:
+        if not isinstance(bot.message_log, MessageLogStore):
+            print(
+                "The full replay only reads the single file message log, "
+                "unset ShardDirectory in the config.",
+                file=sys.stderr,
+            )
+            return False
+        guilds = {
+            next_id(): [next_id() for _ in range(args.channels)]
+            for _ in range(args.guilds)
+        }
+        start = time.perf_counter()
+        await fill_log(bot, guilds, args, now)
+        print(
+            f"Wrote {args.rows} rows over {args.days} days in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        rules = make_rules(guilds)
+
+        start = time.perf_counter()
+        scanned, timings = await range_scan(bot, rules, now, args.coarse_hours * HOUR)
+        range_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        replayed, rows = await full_scan(bot, rules, now)
+        full_elapsed = time.perf_counter() - start
+
+    samples = sorted(timings.values())
+    print(
+        f"Per-rule range scan: {range_elapsed * 1000:.1f}ms for {len(rules)} rules, "
+        f"median {samples[len(samples) // 2] * 1000:.2f}ms, "
+        f"max {samples[-1] * 1000:.2f}ms per rule"
+    )
+    print(f"Full replay:         {full_elapsed * 1000:.1f}ms")
+    return agree(scanned, replayed, rows, rules, now)
+
+
+def main():
+    """Entry point, see --help."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=10, help="at least 2")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--coarse-hours",
+        type=int,
+        default=24,
+        help="rules this long are counted per hour, 0 for none",
+    )
+    args = parser.parse_args()
+
+    if not asyncio.run(run_benchmark(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Lightweight stand-ins for the discord.py objects the cogs use, so the cogs
+can be driven without a connection to discord. Only the attributes and
+methods the cogs actually touch are implemented.
+"""
+import contextlib
+import io
+import itertools
+import pathlib
+import random
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+_ids = itertools.count(1)
+
+
+def next_id() -> int:
+    """A unique snowflake-ish id."""
+    return next(_ids)
+
+
+@contextlib.asynccontextmanager
+async def offline_bot(
+    db_path: Optional[pathlib.Path] = None, **options
+) -> AsyncIterator:
+    """
+    A bot that was set up against a fresh database in a temporary directory,
+    or against db_path if given, without connecting to discord. Its startup
+    and shutdown output is hidden. Options are passed on to the bot, with
+    shard_ids it runs a subset of the shards like a process of run_sharded.
+    """
+    # imported here so importing the fakes doesn't load the bot.
+    # pylint: disable-next=import-outside-toplevel
+    from src.main import PCParadiseBot, ShardedPCParadiseBot
+
+    bot_class = ShardedPCParadiseBot if "shard_ids" in options else PCParadiseBot
+    with tempfile.TemporaryDirectory() as directory:
+        bot = bot_class(
+            db_path=db_path or pathlib.Path(directory) / "database.db", **options
+        )
+        async with bot:
+            with contextlib.redirect_stdout(io.StringIO()):
+                await bot.setup_hook()
+            try:
+                yield bot
+            finally:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    await bot.close()
+
+
+@dataclass
+class FakePermissions:
+    """Stand-in for discord.Permissions."""
+
+    administrator: bool = False
+
+
+@dataclass(eq=False)
+class FakeRole:
+    """Stand-in for discord.Role."""
+
+    id: int  # pylint: disable=invalid-name
+    name: str = "role"
+
+
+@dataclass(eq=False)
+class FakeMember:
+    """Stand-in for discord.Member."""
+
+    id: int  # pylint: disable=invalid-name
+    guild: "FakeGuild"
+    name: str = "member"
+    bot: bool = False
+    roles: List[FakeRole] = field(default_factory=list)
+    guild_permissions: FakePermissions = field(default_factory=FakePermissions)
+
+    async def add_roles(self, *roles: FakeRole, reason=None, atomic=True):
+        """Adds the roles without talking to discord."""
+        del reason, atomic
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+
+@dataclass(eq=False)
+class FakeGuild:
+    """Stand-in for discord.Guild."""
+
+    id: int  # pylint: disable=invalid-name
+    name: str = "guild"
+    roles: List[FakeRole] = field(default_factory=list)
+    members: Dict[int, FakeMember] = field(default_factory=dict)
+    text_channels: List["FakeChannel"] = field(default_factory=list)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        """Looks a role up by id."""
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    def get_member(self, user_id: int) -> Optional[FakeMember]:
+        """Looks a member up by id."""
+        return self.members.get(user_id)
+
+    async def fetch_member(self, user_id: int) -> FakeMember:
+        """Looks a member up by id, the fake members are what discord knows."""
+        return self.members[user_id]
+
+    def add_member(self, **kwargs) -> FakeMember:
+        """Creates a member in this guild."""
+        member = FakeMember(id=next_id(), guild=self, **kwargs)
+        self.members[member.id] = member
+        return member
+
+
+@dataclass(eq=False)
+class FakeChannel:
+    """Stand-in for discord.TextChannel."""
+
+    id: int  # pylint: disable=invalid-name
+    guild: FakeGuild
+    name: str = "channel"
+    sent: int = 0
+    deleted: int = 0
+
+    async def send(self, content=None, *, embed=None) -> "FakeMessage":
+        """Pretends to send a message, returning it."""
+        del embed
+        self.sent += 1
+        return FakeMessage(
+            id=next_id(),
+            guild=self.guild,
+            channel=self,
+            author=FakeMember(id=next_id(), guild=self.guild, bot=True),
+            content=content or "",
+        )
+
+    async def delete_messages(self, messages, *, reason=None):
+        """Pretends to bulk delete messages."""
+        del reason
+        self.deleted += len(list(messages))
+
+
+@dataclass(eq=False)
+class FakeMessage:  # pylint: disable=too-many-instance-attributes
+    """Stand-in for discord.Message."""
+
+    id: int  # pylint: disable=invalid-name
+    guild: Optional[FakeGuild]
+    channel: FakeChannel
+    author: FakeMember
+    content: str = ""
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    channel_mentions: List[FakeChannel] = field(default_factory=list)
+    role_mentions: List[FakeRole] = field(default_factory=list)
+
+    async def delete(self, *, delay=None):
+        """Pretends to delete the message."""
+        del delay
+        self.channel.deleted += 1
+
+
+class StandInGateway:
+    """
+    Stands in for discord's gateway when the bot is split by shard: a stream of
+    messages over all guilds, of which every shard only gets its own guilds'.
+    """
+
+    def __init__(self, guilds: Iterable[FakeGuild], shard_count: int):
+        self.guilds = list(guilds)
+        self.shard_count = shard_count
+
+    def shard_of(self, guild_id: int) -> int:
+        """The shard discord sends a guild's events on."""
+        return (guild_id >> 22) % self.shard_count
+
+    def messages(
+        self, count: int, shard_ids: Iterable[int], seed: int = 0
+    ) -> Iterator[FakeMessage]:
+        """
+        The messages of the given shards among the first count of the stream.
+        The stream only depends on the seed, so every process sees the same one.
+        """
+        shard_ids = set(shard_ids)
+        rng = random.Random(seed)
+        for _ in range(count):
+            guild = rng.choice(self.guilds)
+            channel = rng.choice(guild.text_channels)
+            author = rng.choice(list(guild.members.values()))
+            if self.shard_of(guild.id) in shard_ids:
+                yield FakeMessage(
+                    id=next_id(), guild=guild, channel=channel, author=author
+                )
@@ -0,0 +1,123 @@
+"""
+Measures what answering !help costs with the embeds rendered on every call,
+compared to looking them up in the HelpEmbedCache, and what suggesting a
+command for a typo costs with difflib compared to the bot's SuggestionIndex.
+
+Loads the real cogs into a bot that doesn't connect to discord and renders
+the bot, cog and command help embeds both ways.
+
+    python -m benchmarks.help_embeds --iterations 2000
+"""
+import argparse
+import asyncio
+import difflib
+import itertools
+import time
+from typing import Callable, Dict, List
+
+from benchmarks.fakes import offline_bot
+from src.cogs.help import CustomHelp, HelpEmbedCache, bot_mapping
+
+
+def per_call(function: Callable, iterations: int) -> float:
+    """The average time a call of function takes, in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def close_matches(bot, word: str) -> List[str]:
+    """
+    What CustomHelp.command_not_found used to do on every miss, collect the
+    name of every command in the help mapping and run difflib over them.
+    """
+    names = [
+        cmd.name for cmd in itertools.chain.from_iterable(bot_mapping(bot).values())
+    ]
+    return difflib.get_close_matches(word, names)
+
+
+async def run_benchmark(args) -> Dict[str, Dict[str, float]]:
+    """
+    Times every kind of help embed, returns {kind: {"render": us, "cached": us}}.
+    """
+    async with offline_bot() as bot:
+        cache = HelpEmbedCache()
+        build = per_call(lambda: cache.build(bot), args.iterations)
+        cogs = list(bot.cogs.values())
+        commands = list(bot.walk_commands())
+        # every command name with its last two characters swapped.
+        typos = [cmd.name[:-2] + cmd.name[-1] + cmd.name[-2] for cmd in commands]
+
+        def cached_bot():
+            cache.ensure_built(bot)
+            return cache.bot_embed
+
+        def cached_cogs():
+            cache.ensure_built(bot)
+            return [cache.cog_embeds[cog.qualified_name] for cog in cogs]
+
+        def cached_commands():
+            cache.ensure_built(bot)
+            return [cache.command_embeds[cmd.qualified_name] for cmd in commands]
+
+        results = {
+            "bot": {
+                "render": per_call(
+                    lambda: CustomHelp.get_bot_help(bot_mapping(bot)), args.iterations
+                ),
+                "cached": per_call(cached_bot, args.iterations),
+            },
+            "cog": {
+                "render": per_call(
+                    lambda: [CustomHelp.get_cog_help(cog) for cog in cogs],
+                    args.iterations,
+                )
+                / len(cogs),
+                "cached": per_call(cached_cogs, args.iterations) / len(cogs),
+            },
+            "suggest": {
+                "render": per_call(
+                    lambda: [close_matches(bot, typo) for typo in typos],
+                    args.iterations,
+                )
+                / len(typos),
+                "cached": per_call(
+                    lambda: [bot.suggestions.suggest(typo) for typo in typos],
+                    args.iterations,
+                )
+                / len(typos),
+            },
+            "command": {
+                "render": per_call(
+                    lambda: [CustomHelp.get_command_help(cmd) for cmd in commands],
+                    args.iterations,
+                )
+                / len(commands),
+                "cached": per_call(cached_commands, args.iterations) / len(commands),
+            },
+        }
+    print(
+        f"{len(cogs)} cogs and {len(commands)} commands, rebuilding the whole "
+        f"cache takes {build:.1f}us"
+    )
+    return results
+
+
+def main():
+    """Entry point, see --help."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    for kind, timings in asyncio.run(run_benchmark(args)).items():
+        print(
+            f"  {kind:<8} rendered {timings['render']:8.2f}us  "
+            f"cached {timings['cached']:6.2f}us  "
+            f"({timings['render'] / timings['cached']:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Measures how many messages per second the message ingestion pipeline can handle.
+
+Builds a synthetic firehose of messages spread over a number of fake guilds and
+feeds it to bot.ingestion, which passes it on to the Logging and WelcomeModule
+handlers, using a real sqlite database in a temporary directory. No connection
+to discord is made.
+
+    python -m benchmarks.listener_throughput --messages 20000 --guilds 50
+    python -m benchmarks.listener_throughput --output run.json --baseline base.json
+"""
+import argparse
+import asyncio
+import json
+import pathlib
+import random
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+from benchmarks.fakes import (
+    FakeChannel,
+    FakeGuild,
+    FakeMessage,
+    FakeRole,
+    next_id,
+    offline_bot,
+)
+from src.main import PCParadiseBot
+
+DETECTION_WORD = "i agree"
+# the options that change what is being measured, stored with the results.
+WORKLOAD_OPTIONS = (
+    "messages",
+    "guilds",
+    "channels",
+    "members",
+    "rate",
+    "welcome_ratio",
+    "seed",
+)
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency percentiles of a list of samples, in milliseconds."""
+    if len(samples) < 2:
+        samples = samples * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100)
+    return {
+        "mean": statistics.fmean(samples) * 1000,
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+        "max": max(samples) * 1000,
+    }
+
+
+async def build_guilds(bot: PCParadiseBot, args) -> List[FakeGuild]:
+    """
+    Creates the fake guilds, and registers them along with their welcome
+    settings in the database like the Config cog would.
+    """
+    guilds = []
+    async with bot.db.connection() as database:
+        for _ in range(args.guilds):
+            guild = FakeGuild(id=next_id())
+            role = FakeRole(id=next_id(), name="verified")
+            guild.roles.append(role)
+            guild.text_channels = [
+                FakeChannel(id=next_id(), guild=guild) for _ in range(args.channels)
+            ]
+            for _ in range(args.members):
+                guild.add_member()
+            await database.execute("INSERT INTO servers VALUES (?)", (guild.id,))
+            await database.execute(
+                "INSERT INTO welcome_config_settings VALUES (?, ?, ?, ?)",
+                (guild.id, DETECTION_WORD, role.id, guild.text_channels[0].id),
+            )
+            guilds.append(guild)
+        await database.commit()
+    await bot.guild_settings.load_all()
+    return guilds
+
+
+def make_message(guild: FakeGuild, welcome_ratio: float) -> FakeMessage:
+    """
+    A random message in the guild. welcome_ratio of them are sent in the welcome
+    channel and pass verification, the rest go to one of the other channels.
+    """
+    author = random.choice(list(guild.members.values()))
+    if random.random() < welcome_ratio:
+        channel, content = guild.text_channels[0], DETECTION_WORD
+    else:
+        channel, content = random.choice(guild.text_channels[1:]), "hello"
+    return FakeMessage(
+        id=next_id(), guild=guild, channel=channel, author=author, content=content
+    )
+
+
+async def drive(listeners: Dict, guilds: List[FakeGuild], args) -> Dict[str, List]:
+    """
+    Sends the messages to every listener, at args.rate messages per second if
+    set. Returns the latency of every call per listener.
+    """
+    latencies: Dict[str, List[float]] = {name: [] for name in listeners}
+    interval = 1 / args.rate if args.rate else 0
+    start = time.perf_counter()
+    for index in range(args.messages):
+        if interval:
+            delay = start + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        msg = make_message(random.choice(guilds), args.welcome_ratio)
+        for name, listener in listeners.items():
+            before = time.perf_counter()
+            await listener(msg)
+            latencies[name].append(time.perf_counter() - before)
+        # the handlers run while the gateway waits for the next message.
+        await asyncio.sleep(0)
+    return latencies
+
+
+async def run_benchmark(args) -> Dict:
+    """
+    Runs the firehose against a fresh bot and returns the results.
+    """
+    random.seed(args.seed)
+    async with offline_bot() as bot:
+        guilds = await build_guilds(bot, args)
+
+        start = time.perf_counter()
+        latencies = await drive(
+            {"MessagePipeline.ingest": bot.ingestion.ingest},
+            guilds,
+            args,
+        )
+        # the run isn't over until every handler ran and everything is written.
+        await bot.ingestion.drain()
+        await bot.message_buffer.flush()
+        elapsed = time.perf_counter() - start
+        buffer_stats, pool_stats = bot.message_buffer.stats, bot.db.stats
+        # what each handler behind the pipeline took, as recorded by the bot.
+        handlers = {
+            name: {
+                "calls": histogram.count,
+                "mean": histogram.total / histogram.count * 1000,
+            }
+            for (kind, name), histogram in bot.metrics.histograms.items()
+            if kind == "listener" and histogram.count
+        }
+
+    return {
+        "config": {key: getattr(args, key) for key in WORKLOAD_OPTIONS},
+        "elapsed": elapsed,
+        "throughput": args.messages / elapsed,
+        "listeners": {name: summarize(samples) for name, samples in latencies.items()},
+        "handlers": handlers,
+        "db": {
+            "flushes": buffer_stats.flushes,
+            "rows": buffer_stats.rows_flushed,
+            "flush_time": buffer_stats.total_flush_latency * 1000,
+            "average_flush": buffer_stats.average_flush_latency * 1000,
+            "max_flush": buffer_stats.max_flush_latency * 1000,
+            "pool_wait": pool_stats.total_wait * 1000,
+        },
+    }
+
+
+def print_report(results: Dict) -> None:
+    """Prints the results in a human readable way."""
+    print(
+        f"{results['config']['messages']} messages over "
+        f"{results['config']['guilds']} guilds in {results['elapsed']:.2f}s "
+        f"- {results['throughput']:.0f} messages/s"
+    )
+    for name, latency in results["listeners"].items():
+        print(
+            f"  {name:<26} p50 {latency['p50']:.3f}ms  p95 {latency['p95']:.3f}ms  "
+            f"p99 {latency['p99']:.3f}ms  max {latency['max']:.3f}ms"
+        )
+    for name, handler in results.get("handlers", {}).items():
+        print(
+            f"    {name:<36} {handler['calls']:>7} calls  mean {handler['mean']:.3f}ms"
+        )
+    db = results["db"]  # pylint: disable=invalid-name
+    print(
+        f"  database: {db['rows']} rows in {db['flushes']} flushes, "
+        f"{db['flush_time']:.1f}ms total, {db['average_flush']:.3f}ms average, "
+        f"{db['max_flush']:.3f}ms max, {db['pool_wait']:.3f}ms waiting for the pool"
+    )
+
+
+def compare(results: Dict, baseline: Dict, max_regression: float) -> bool:
+    """
+    Prints how the results changed compared to the baseline. Returns False if
+    throughput or any listener's p99 got worse by more than max_regression percent.
+    """
+    ok = True
+
+    def report(name: str, current: float, previous: float, higher_is_better: bool):
+        nonlocal ok
+        change = (current - previous) / previous * 100 if previous else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > max_regression:
+            ok, flag = False, "  REGRESSION"
+        print(
+            f"  {name:<36} {previous:10.3f} -> {current:10.3f} ({change:+.1f}%){flag}"
+        )
+
+    print("Compared to the baseline:")
+    if baseline["config"] != results["config"]:
+        print("  (note: the baseline was run with different options)")
+    report("throughput", results["throughput"], baseline["throughput"], True)
+    for name, latency in results["listeners"].items():
+        if name in baseline["listeners"]:
+            previous = baseline["listeners"][name]["p99"]
+            report(f"{name} p99", latency["p99"], previous, False)
+    return ok
+
+
+def main():
+    """Entry point, see --help."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="messages per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--welcome-ratio",
+        type=float,
+        default=0.01,
+        help="share of messages sent in the welcome channel",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, help="write the results as json")
+    parser.add_argument(
+        "--baseline", type=pathlib.Path, help="json results to compare to"
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=10,
+        help="percent a metric may get worse before the run fails",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    print_report(results)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.baseline and args.baseline.exists():
+        if not compare(
+            results, json.loads(args.baseline.read_text()), args.max_regression
+        ):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Runs the bot split into worker processes like run_sharded does, against a
+stand-in gateway instead of discord, and checks that every message reached
+the database through the writer process exactly once and that every worker
+only loaded the activity rules of its own guilds.
+
+    python -m benchmarks.sharded_ingestion --workers 4 --shards 8 --messages 40000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.fakes import (
+    FakeChannel,
+    FakeGuild,
+    StandInGateway,
+    offline_bot,
+)
+from src.main import PCParadiseBot, shards_of
+from src.utils.message_writer import WriterConnection, serve
+
+
+def build_guilds(args) -> List[FakeGuild]:
+    """
+    The same guilds in every process. Their ids are spread evenly over the shards.
+    """
+    guilds = []
+    for index in range(args.guilds):
+        guild = FakeGuild(id=(index + 1) << 22)
+        guild.text_channels = [
+            FakeChannel(id=(index + 1) * 1000 + channel, guild=guild)
+            for channel in range(args.channels)
+        ]
+        for _ in range(args.members):
+            guild.add_member()
+        guilds.append(guild)
+    return guilds
+
+
+async def prepare(db_path: pathlib.Path, guilds: List[FakeGuild]) -> None:
+    """Creates the database, with one activity rule per guild."""
+    async with offline_bot(db_path) as bot:
+        async with bot.db.connection() as database:
+            for guild in guilds:
+                await database.execute("INSERT INTO servers VALUES (?)", (guild.id,))
+                await database.execute(
+                    "INSERT INTO activity_tracking_settings "
+                    "(server_id, time_period, role_id, message_count) "
+                    "VALUES (?, 3600, 1, 1000)",
+                    (guild.id,),
+                )
+            await database.commit()
+
+
+async def drive_worker(
+    writer: WriterConnection, shard_ids: List[int], db_path: pathlib.Path, args
+) -> Dict:
+    """Feeds a worker its share of the stream, returns what it saw."""
+    guilds = build_guilds(args)
+    gateway = StandInGateway(guilds, args.shards)
+    async with offline_bot(
+        db_path, writer=writer, shard_ids=shard_ids, shard_count=args.shards
+    ) as bot:
+        await bot.get_cog("ActivityTracking").load_rules()
+        rules = len(
+            [
+                rule
+                for rules in bot.get_cog("ActivityTracking").engine.rules.values()
+                for rule in rules
+            ]
+        )
+        messages = list(gateway.messages(args.messages, shard_ids, args.seed))
+        start = time.perf_counter()
+        for msg in messages:
+            await bot.ingestion.ingest(msg)
+        await bot.ingestion.drain()
+        await bot.message_buffer.flush()
+        elapsed = time.perf_counter() - start
+    owned = [guild.id for guild in guilds if gateway.shard_of(guild.id) in shard_ids]
+    return {
+        "worker": writer.worker,
+        "guilds": len(owned),
+        "rules": rules,
+        "messages": len(messages),
+        "elapsed": elapsed,
+    }
+
+
+def run_worker(writer, shard_ids, db_path, args, results) -> None:
+    """Entry point of a worker process."""
+    results.put(asyncio.run(drive_worker(writer, shard_ids, db_path, args)))
+
+
+async def count_rows(db_path: pathlib.Path) -> int:
+    """How many messages ended up in message_log."""
+    async with offline_bot(db_path) as bot:
+        async with bot.db.connection() as database:
+            cur = await database.execute("SELECT COUNT(*) FROM message_log")
+            (count,) = await cur.fetchone()
+    return count
+
+
+def main():  # pylint: disable=too-many-locals
+    """Entry point, see --help."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--guilds", type=int, default=40)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = pathlib.Path(directory) / "database.db"
+        asyncio.run(prepare(db_path, build_guilds(args)))
+
+        requests = context.Queue()
+        replies = [context.Queue() for _ in range(args.workers)]
+        results = context.Queue()
+        ready = context.Event()
+        config = PCParadiseBot.initialize_config()
+        config.pop("sharddirectory", None)
+        writer = context.Process(
+            target=serve, args=(db_path, config, requests, replies, ready)
+        )
+        writer.start()
+        ready.wait()
+
+        start = time.perf_counter()
+        workers = [
+            context.Process(
+                target=run_worker,
+                args=(
+                    WriterConnection(worker, requests, replies[worker]),
+                    shards_of(worker, args.workers, args.shards),
+                    db_path,
+                    args,
+                    results,
+                ),
+            )
+            for worker in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        reports = sorted(
+            (results.get() for _ in workers), key=lambda report: report["worker"]
+        )
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        requests.put(None)
+        writer.join()
+        rows = asyncio.run(count_rows(db_path))
+
+    ok = rows == args.messages
+    for report in reports:
+        print(
+            f"  worker {report['worker']}: {report['guilds']} guilds, "
+            f"{report['rules']} rules loaded, {report['messages']} messages in "
+            f"{report['elapsed']:.2f}s"
+        )
+        ok = ok and report["rules"] == report["guilds"]
+    print(
+        f"{args.messages} messages over {args.workers} workers and {args.shards} "
+        f"shards in {elapsed:.2f}s including startup, {rows} rows written"
+    )
+    if not ok:
+        print("MISMATCH - messages were lost or rules evaluated by the wrong worker")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+Migration version 4
+"""
+import aiosqlite
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 4.
+    Adds indexes for the way the activity tables are actually queried.
+    """
+    cur = await database.cursor()
+    # covers the join from activity_tracking_channels and the time window,
+    # so counting messages never has to touch the table itself.
+    await cur.execute(
+        "CREATE INDEX message_log_channel_time_user "
+        "ON message_log (channel_id, time, user_id)"
+    )
+    await cur.execute(
+        "CREATE INDEX activity_tracking_channels_rule "
+        "ON activity_tracking_channels (activity_tracking_id, channel)"
+    )
+    await cur.execute(
+        "CREATE INDEX activity_tracking_settings_server "
+        "ON activity_tracking_settings (server_id)"
+    )
+    await cur.execute("UPDATE metadata SET version = ?", [4])
@@ -0,0 +1,65 @@
+"""
+Migration version 5
+"""
+import time
+import aiosqlite
+
+WEEK = 7 * 24 * 60 * 60
+COLUMNS = "channel_id, user_id, time, server_id"
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 5.
+    Splits message_log into one table per week, listed in message_log_partitions,
+    and replaces message_log with a view over all of them.
+    """
+    cur = await database.cursor()
+    await cur.execute(
+        "CREATE TABLE message_log_partitions ("
+        "    name TEXT PRIMARY KEY NOT NULL,"
+        "    start INTEGER NOT NULL,"
+        "    end INTEGER NOT NULL"
+        ");"
+    )
+
+    await cur.execute(
+        f"SELECT DISTINCT CAST(time / {WEEK} AS INTEGER) FROM message_log"
+    )
+    weeks = {week for (week,) in await cur.fetchall()}
+    weeks.add(int(time.time() // WEEK))
+
+    names = []
+    for week in sorted(weeks):
+        name = f"message_log_w{week}"
+        start, end = week * WEEK, (week + 1) * WEEK
+        await cur.execute(
+            f"CREATE TABLE {name} ("
+            "    channel_id INTEGER NOT NULL,"
+            "    user_id INTEGER NOT NULL,"
+            "    time INTEGER NOT NULL,"
+            "    server_id INTEGER NOT NULL,"
+            "    FOREIGN KEY(server_id) REFERENCES servers(id)"
+            ");"
+        )
+        await cur.execute(
+            f"CREATE INDEX {name}_channel_time_user "
+            f"ON {name} (channel_id, time, user_id)"
+        )
+        await cur.execute(
+            f"INSERT INTO {name} SELECT {COLUMNS} FROM message_log "
+            "WHERE time >= ? AND time < ?",
+            (start, end),
+        )
+        await cur.execute(
+            "INSERT INTO message_log_partitions VALUES (?, ?, ?)",
+            (name, start, end),
+        )
+        names.append(name)
+
+    await cur.execute("DROP TABLE message_log")
+    await cur.execute(
+        "CREATE VIEW message_log AS "
+        + " UNION ALL ".join(f"SELECT {COLUMNS} FROM {name}" for name in names)
+    )
+    await cur.execute("UPDATE metadata SET version = ?", [5])
@@ -0,0 +1,23 @@
+"""
+Migration version 6
+"""
+import aiosqlite
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 6.
+    Adds a ledger of the roles the activity rules granted, so a restart knows
+    who was already handled.
+    """
+    cur = await database.cursor()
+    await cur.execute(
+        "CREATE TABLE activity_grant_ledger ("
+        "    server_id INTEGER NOT NULL,"
+        "    role_id INTEGER NOT NULL,"
+        "    user_id INTEGER NOT NULL,"
+        "    granted_at REAL NOT NULL,"
+        "    PRIMARY KEY (server_id, role_id, user_id)"
+        ");"
+    )
+    await cur.execute("UPDATE metadata SET version = ?", [6])
@@ -0,0 +1,20 @@
+"""
+Migration version 7
+"""
+import aiosqlite
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 7.
+    Indexes every message_log partition on (server_id, time, user_id), for
+    activity rules that count messages in all channels.
+    """
+    cur = await database.cursor()
+    await cur.execute("SELECT name FROM message_log_partitions")
+    for (name,) in await cur.fetchall():
+        await cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {name}_server_time_user "
+            f"ON {name} (server_id, time, user_id)"
+        )
+    await cur.execute("UPDATE metadata SET version = ?", [7])
@@ -0,0 +1,20 @@
+"""
+Migration version 8
+"""
+import aiosqlite
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 8.
+    Adds the catalog of per guild message_log files, used when the
+    message log is sharded by guild.
+    """
+    cur = await database.cursor()
+    await cur.execute(
+        "CREATE TABLE message_log_shards ("
+        "    server_id INTEGER PRIMARY KEY NOT NULL,"
+        "    file TEXT NOT NULL"
+        ");"
+    )
+    await cur.execute("UPDATE metadata SET version = ?", [8])
@@ -0,0 +1,39 @@
+"""
+Migration version 9
+"""
+import aiosqlite
+
+
+async def run_migration(database: aiosqlite.Connection):
+    """
+    Run a migration for version 9.
+    Adds message_counts, how many messages every user sent per channel and
+    hour, and fills it from the message_log partitions.
+    """
+    cur = await database.cursor()
+    await cur.execute(
+        "CREATE TABLE message_counts ("
+        "    server_id INTEGER NOT NULL,"
+        "    user_id INTEGER NOT NULL,"
+        "    hour INTEGER NOT NULL,"
+        "    channel_id INTEGER NOT NULL,"
+        "    count INTEGER NOT NULL,"
+        "    PRIMARY KEY (server_id, user_id, hour, channel_id)"
+        ") WITHOUT ROWID;"
+    )
+    await cur.execute(
+        "CREATE INDEX message_counts_channel_hour "
+        "ON message_counts (server_id, channel_id, hour)"
+    )
+    await cur.execute(
+        "CREATE INDEX message_counts_hour ON message_counts (server_id, hour)"
+    )
+    await cur.execute("SELECT name FROM message_log_partitions")
+    for (name,) in await cur.fetchall():
+        # partitions are whole weeks, so no hour spans two of them.
+        await cur.execute(
+            "INSERT INTO message_counts "
+            "SELECT server_id, user_id, CAST(time / 3600 AS INTEGER), channel_id, "
+            f"COUNT(*) FROM {name} GROUP BY 1, 2, 3, 4"
+        )
+    await cur.execute("UPDATE metadata SET version = ?", [9])
@@ -6,6 +6,11 @@ import importlib
 import sqlite3
 import aiosqlite
 
+# every migration in the order they run, _N brings the database to version N.
+# New migrations have to be added here.
+MIGRATIONS = ("_0", "_1", "_2", "_3", "_4", "_5", "_6", "_7", "_8", "_9")
+LATEST_VERSION = len(MIGRATIONS) - 1
+
 
 class _Migration:  # pylint: disable=too-few-public-methods
     """
@@ -13,9 +18,10 @@ class _Migration:  # pylint: disable=too-few-public-methods
     """
 
     @staticmethod
-    async def run_migration(_: pathlib.Path):
+    async def run_migration(_: aiosqlite.Connection):
         """
-        runs the migration to go up one database version.
+        runs the migration to go up one database version, inside the
+        runner's transaction. Migrations must not commit.
         """
 
 
@@ -26,26 +32,35 @@ def _load_migration(name: str) -> _Migration:
     return importlib.import_module(f".{name}", package=__package__)  # type: ignore
 
 
+async def current_version(database: aiosqlite.Connection) -> int:
+    """
+    The version the database is at, -1 for an empty database.
+    """
+    try:
+        cur = await database.execute("SELECT version FROM metadata")
+        version = await cur.fetchone()
+    except sqlite3.OperationalError:
+        return -1
+    return version[0] if version else -1
+
+
 async def run_migrations(db_path: pathlib.Path):
     """
-    Run migrations on all our stuff.
+    Run migrations on all our stuff. Every pending migration runs on one
+    connection in a single transaction, so either all of them are applied
+    or none are. An up to date database only costs one query.
     """
-    version = None
     async with aiosqlite.connect(db_path) as database:
-        cur = await database.cursor()
+        version = await current_version(database)
+        if version >= LATEST_VERSION:
+            return
+
+        await database.execute("BEGIN")
         try:
-            await cur.execute("SELECT version FROM metadata")
-            version = await cur.fetchone()
-            version = version[0] if version else -1
-        except sqlite3.OperationalError:
-            version = -1
-
-    imports = set(p.name for p in pathlib.Path(__file__).parent.glob("_*.py"))
-    while True:
-        file_name = f"_{version + 1}.py"
-        if file_name in imports:
-            print(file_name)
-            await _load_migration(file_name[:-3]).run_migration(db_path)
-            version += 1
-        else:
-            break
+            for name in MIGRATIONS[version + 1 :]:
+                print(f"{name}.py")
+                await _load_migration(name).run_migration(database)
+            await database.commit()
+        except BaseException:
+            await database.rollback()
+            raise
@@ -1,13 +1,34 @@
 """
 A module to assign roles according to activity.
 """
-from asyncio import sleep
-from typing import Iterable, List, Optional, Tuple
-import aiosqlite
-from discord import Guild
-from discord import errors
+import asyncio
+import sys
+import time
+from typing import Callable, Container, Dict, Iterable, List, Optional, Set, Tuple
+import discord
+import pytimeparse
+from discord import Guild, Role
 from discord.ext import commands
 
+from src.utils.activity_engine import HOUR, ActivityEngine, ActivityRule
+from src.utils.cache_policy import Needs
+from src.utils.ingestion import MessageContext
+
+# how often windows of users who stopped talking are dropped from memory, in seconds.
+PRUNE_INTERVAL = 60 * 60
+# counts messages, members are fetched when they're granted a role.
+NEEDS = Needs(intents=frozenset({"guild_messages"}))
+# how many users, channels and servers !activity, !topactive and !topguilds list.
+REPORT_LENGTH = 10
+
+
+def parse_period(period: str) -> int:
+    """The length of a period like "1 week" in seconds."""
+    seconds = pytimeparse.parse(period)
+    if not seconds or seconds <= 0:
+        raise commands.BadArgument(f"Couldn't understand the period `{period}`.")
+    return int(seconds)
+
 
 class ActivityTracking(commands.Cog):
     """
@@ -18,65 +39,335 @@ class ActivityTracking(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # rules at least this long count messages per hour, see HourlyWindow.
+        self.engine = ActivityEngine(
+            bot.grant_ledger,
+            coarse_period=pytimeparse.parse(bot.config.get("hourlyruleperiod", "1 day"))
+            or 0,
+        )
+        self.ready = False
+        # messages received while the engine is warming up.
+        self.pending: List[Tuple[int, int, int, float]] = []
+        self.prune_task: Optional[asyncio.Task] = None
+        self.grant_tasks: Set[asyncio.Task] = set()
 
-    async def check_for_role_grant(self) -> List[Tuple[int, int, int]]:
-        """
-        Checks who should be granted roles.
-        Returns: a list of tuple[int, int, int]. First value is
-        role id that should be assigned, second is user id, and third
-        is server id.
-        """
-        async with aiosqlite.connect(self.bot.db_path) as database:
-            cur = await database.cursor()
-            cur = await cur.execute(
-                "SELECT role_id, user_id, a.server_id FROM activity_tracking_settings a\n"
-                "  INNER JOIN message_log m, activity_tracking_channels c\n"
-                "ON\n"
-                "  c.activity_tracking_id = id AND\n"
-                "  m.channel_id = c.channel\n"
-                "GROUP BY a.id\n"
-                "HAVING\n"
-                '  COUNT(time_period > strftime("%s") - `time`) >= message_count\n'
+    async def fetch_rules(self) -> List[ActivityRule]:
+        """
+        Reads every rule of the guilds this process owns, and its channels,
+        from the database.
+        """
+        async with self.bot.db.connection() as database:
+            cur = await database.execute(
+                "SELECT id, server_id, time_period, role_id, message_count "
+                "FROM activity_tracking_settings"
+            )
+            settings = await cur.fetchall()
+            cur = await database.execute(
+                "SELECT activity_tracking_id, channel FROM activity_tracking_channels"
             )
-            return list(map(tuple, await cur.fetchall()))
+            channels: Dict[int, Set[int]] = {}
+            for rule_id, channel in await cur.fetchall():
+                channels.setdefault(rule_id, set()).add(channel)
+
+        # when the bot is split into processes, the other guilds' rules are
+        # evaluated by the process that gets their messages.
+        return [
+            ActivityRule(*row, channels=frozenset(channels.get(row[0], ())))
+            for row in settings
+            if self.bot.owns_guild(row[1])
+        ]
+
+    async def replay_history(self, rules: List[ActivityRule], until: float) -> None:
+        """
+        Records the logged messages that still fall in the window of the given
+        rules, without granting anything. Each rule only reads its own window,
+        and at most message_count messages per user, or the hourly counts
+        for rules the engine counts per hour.
+        """
+        if not rules:
+            return
+        # make sure everything logged so far is in the database.
+        await self.bot.message_buffer.flush()
+        for rule in rules:
+            if self.engine.is_coarse(rule):
+                for user_id, hour, count in await self.bot.message_log.rule_counts(
+                    rule, until
+                ):
+                    # as of the end of the hour, or until for the current one.
+                    sent_at = min((hour + 1) * HOUR - 1, until)
+                    self.engine.record_rule(rule, user_id, sent_at, count)
+                continue
+            for user_id, sent_at in await self.bot.message_log.latest_per_user(
+                rule, until
+            ):
+                self.engine.record_rule(rule, user_id, sent_at)
+
+    async def load_rules(self) -> None:
+        """
+        (Re)loads the rules from the database. Rules that weren't loaded yet
+        are warmed up from message_log, and anyone who meets them but isn't in
+        the grant ledger yet is granted the role.
+        """
+        # hold back new messages until the history is replayed, so every
+        # window sees its messages in order.
+        self.ready = False
+        started = time.time()
+        new_rules = self.engine.load_rules(await self.fetch_rules())
+        self.bot.ingestion.track(self.engine.tracked_channels())
+        await self.replay_history(new_rules, started)
+
+        rules = {rule.id: rule for rule in new_rules}
+        self.assign_roles(
+            [
+                (rules[rule_id].role_id, user_id, rules[rule_id].server_id)
+                for rule_id, user_id in self.engine.qualified
+                if rule_id in rules
+            ]
+        )
 
-    async def assign_roles(self, info: Iterable[Tuple[int, int, int]]) -> None:
+        # messages sent before started were logged and replayed for the new
+        # rules already, they only count towards the rules loaded before.
+        replayed = {rule.id for rule in new_rules}
+        while self.pending:
+            pending, self.pending = self.pending, []
+            for message in pending:
+                await self.count_message(
+                    *message, skip=replayed if message[3] < started else frozenset()
+                )
+        self.ready = True
+
+    def assign_roles(self, info: Iterable[Tuple[int, int, int]]) -> None:
         """
-        Takes a iterator of (role_id, user_id, server_id), and assigns roles to the user.
+        Takes a iterator of (role_id, user_id, server_id), and queues the roles
+        with the bot's role grant dispatcher. Successful grants are written to
+        the grant ledger.
         """
         for role_id, user_id, server_id in info:
+            if (server_id, role_id, user_id) in self.bot.grant_ledger:
+                continue
             guild: Optional[Guild] = self.bot.get_guild(server_id)
             if not guild:
                 continue
-            member = guild.get_member(user_id)
-            if not member:
-                continue
             role = guild.get_role(role_id)
             if not role:
                 continue
-            await member.add_roles(role)
+            task = asyncio.create_task(self.grant(guild, user_id, role))
+            self.grant_tasks.add(task)
+            task.add_done_callback(self.grant_tasks.discard)
+
+    async def grant(self, guild: Guild, user_id: int, role: Role) -> None:
+        """
+        Grants the role and records it in the ledger once it went through.
+        The member is fetched if it isn't cached, the bot doesn't keep a
+        member cache by default.
+        """
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                # the user left the guild.
+                return
+            except discord.HTTPException as error:
+                print(
+                    f"Couldn't fetch member {user_id} of {guild.id}: {error}",
+                    file=sys.stderr,
+                )
+                return
+        if not await self.bot.role_grants.grant(
+            member, role, reason="Activity rule met"
+        ):
+            return
+        await self.bot.grant_ledger.record(member.guild.id, role.id, member.id)
+        self.engine.forget_user(member.guild.id, role.id, member.id)
+
+    async def prune_periodically(self) -> None:
+        """
+        Drops the windows of users that stopped being active.
+        """
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            self.engine.prune(time.time())
 
     @commands.Cog.listener()
     async def on_ready(self):
         """
-        setup collection event which configures all this.
+        Loads the rules and warms the engine up from the message log. Anyone
+        who met a rule while the bot was down is granted the role now, the
+        ones a previous run handled are in the grant ledger and skipped.
         """
-        cache = set(await self.check_for_role_grant())
-        while True:
-            await sleep(5)
-            # There's a race condition here where the first sent message
-            # before the bot is fully up already got logged, and hence is a part of the cache. :)
-            new_results = set(await self.check_for_role_grant())
-            need_to_set = new_results.difference(cache)
-            try:
-                await self.assign_roles(need_to_set)
-            # we need a better way to handle this so we don't keep retrying constantly
-            # but instead put it on a /far/ higher cooldown. Perhaps we can do the same
-            # for invalidating the cache?
-            except errors.Forbidden:
-                print("Need to set up a cog for logging to alert channel eventually")
-                continue
-            cache = new_results
+        # on_ready is also sent after reconnecting.
+        if self.prune_task:
+            return
+        self.prune_task = asyncio.create_task(self.prune_periodically())
+        await self.load_rules()
+
+    @commands.Cog.listener()
+    async def on_guilds_removed(self, server_ids: List[int]):
+        """
+        Drops the rules of guilds the bot left, their rows are already deleted.
+        """
+        self.engine.forget_servers(server_ids)
+        self.bot.ingestion.track(self.engine.tracked_channels())
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    async def count_message(
+        self,
+        server_id: int,
+        channel_id: int,
+        user_id: int,
+        sent_at: float,
+        skip: Container[int] = frozenset(),
+    ) -> None:
+        """
+        Records a message and grants the roles of any rule the user just met.
+        Rules whose id is in skip aren't counted.
+        """
+        crossed = self.engine.record(server_id, channel_id, user_id, sent_at, skip)
+        self.assign_roles((rule.role_id, user_id, server_id) for rule in crossed)
+
+    async def on_tracked_message(self, ctx: MessageContext):
+        """
+        Counts every message in a tracked channel towards the rules of its server.
+        """
+        message = (ctx.guild_id, ctx.channel_id, ctx.author_id, ctx.sent_at)
+        if not self.ready:
+            self.pending.append(message)
+            return
+        await self.count_message(*message)
+
+    @commands.command(name="activity")
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def activity(
+        self, ctx, user: Optional[discord.User] = None, *, period: str = "1 week"
+    ):
+        """
+        Shows how many messages you, or the given user, sent in each channel
+        of this server in the given period, e.g. !activity @user 1 day.
+        Counted per hour, so the period starts at the beginning of an hour.
+        """
+        user = user or ctx.author
+        seconds = parse_period(period)
+        await self.bot.message_buffer.flush()
+        channels = await self.bot.message_log.user_activity(
+            ctx.guild.id, user.id, time.time() - seconds
+        )
+        embed = discord.Embed(
+            title=f"Activity of {user.display_name}",
+            description=(
+                f"{sum(count for _, count in channels)} messages in the last {period}"
+            ),
+        )
+        if channels:
+            embed.add_field(
+                name="Channels",
+                value="\n".join(
+                    f"<#{channel_id}> - {count}"
+                    for channel_id, count in channels[:REPORT_LENGTH]
+                ),
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
+    @commands.command(name="topactive")
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def topactive(
+        self,
+        ctx,
+        channel: Optional[discord.TextChannel] = None,
+        *,
+        period: str = "1 week",
+    ):
+        """
+        Shows who sent the most messages in this server, or the given channel,
+        in the given period, e.g. !topactive #general 1 day.
+        """
+        seconds = parse_period(period)
+        await self.bot.message_buffer.flush()
+        users = await self.bot.message_log.top_active(
+            ctx.guild.id,
+            time.time() - seconds,
+            channel.id if channel else None,
+            REPORT_LENGTH,
+        )
+        where = channel.mention if channel else "this server"
+        embed = discord.Embed(
+            title="Most active",
+            description=f"in {where} in the last {period}",
+        )
+        embed.add_field(
+            name="Users",
+            value="\n".join(
+                f"{place}. <@{user_id}> - {count}"
+                for place, (user_id, count) in enumerate(users, start=1)
+            )
+            or "Nobody sent a message.",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
+
+    @commands.command(name="topguilds")
+    @commands.is_owner()
+    async def topguilds(self, ctx, *, period: str = "1 week"):
+        """
+        Shows the servers whose members sent the most messages in the given
+        period, across every server the bot is in, e.g. !topguilds 1 day.
+        """
+        seconds = parse_period(period)
+        await self.bot.message_buffer.flush()
+        servers = await self.bot.message_log.server_totals(
+            time.time() - seconds, REPORT_LENGTH
+        )
+        embed = discord.Embed(
+            title="Most active servers",
+            description=f"in the last {period}",
+        )
+        embed.add_field(
+            name="Servers",
+            value="\n".join(
+                f"{place}. {getattr(self.bot.get_guild(server_id), 'name', server_id)}"
+                f" - {count}"
+                for place, (server_id, count) in enumerate(servers, start=1)
+            )
+            or "Nobody sent a message.",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
+
+    def memory_probes(self) -> Dict[str, Callable[[], int]]:
+        """The sizes of what the cog keeps in memory, see MemoryMonitor."""
+        return {
+            "activity.rules": lambda: sum(map(len, self.engine.rules.values())),
+            "activity.windows": lambda: len(self.engine.windows),
+            "activity.window_entries": lambda: sum(
+                map(len, self.engine.windows.values())
+            ),
+            "activity.qualified": lambda: len(self.engine.qualified),
+            "activity.pending": lambda: len(self.pending),
+            "activity.grant_tasks": lambda: len(self.grant_tasks),
+        }
+
+    async def cog_load(self):
+        # only messages in channels some rule counts are passed on, and every
+        # message while the rules are (re)loading, since which channels are
+        # tracked isn't known yet.
+        self.bot.ingestion.subscribe(
+            self.on_tracked_message, lambda ctx: ctx.tracked or not self.ready
+        )
+        for name, probe in self.memory_probes().items():
+            self.bot.memory.register(name, probe)
+
+    async def cog_unload(self):
+        self.bot.ingestion.unsubscribe(self.on_tracked_message)
+        for name in self.memory_probes():
+            self.bot.memory.unregister(name)
+        self.bot.ingestion.track({})
+        if self.prune_task:
+            self.prune_task.cancel()
+        for task in self.grant_tasks:
+            task.cancel()
 
 
 # This function is called by the load_extension method on the bot.
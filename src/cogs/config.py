@@ -4,13 +4,18 @@ A config module that updates values.
 from typing import List, Literal, Union
 import asyncio
 import pytimeparse
-import aiosqlite
 
 import discord
 from discord.ext import commands
 from discord.message import Message
 from discord import TextChannel
 
+from src.utils.cache_policy import Needs
+from src.utils.guild_settings import WelcomeSettings
+
+# the setup commands wait for the user's answers.
+NEEDS = Needs(intents=frozenset({"guild_messages", "message_content"}))
+
 
 class Config(commands.Cog):
     """
@@ -43,7 +48,7 @@ class Config(commands.Cog):
         server_id = msg.guild.id
 
         # deletes existing welcome settings
-        async with aiosqlite.connect(self.bot.db_path) as database:
+        async with self.bot.db.connection() as database:
             cur = await database.cursor()
 
             select_server_settings = (
@@ -68,6 +73,7 @@ class Config(commands.Cog):
 
             await cur.execute(delete_server_settings, (server_id,))
             await database.commit()
+            self.bot.guild_settings.set_welcome(server_id, None)
             await msg.channel.send(
                 (
                     "Success! To re-enable the "
@@ -156,7 +162,7 @@ class Config(commands.Cog):
             return
 
         # updates the db with the new data
-        async with aiosqlite.connect(self.bot.db_path) as database:
+        async with self.bot.db.connection() as database:
             cur = await database.cursor()
 
             insert_sql = (
@@ -171,6 +177,9 @@ class Config(commands.Cog):
                 insert_sql, (server_id, detection_word, role_id, channel_id)
             )
             await database.commit()
+            self.bot.guild_settings.set_welcome(
+                server_id, WelcomeSettings(detection_word, role_id, channel_id)
+            )
             if res.rowcount >= 1:
                 await msg.channel.send(
                     f"Success! Welcome channel has been enabled in <#{channel_id}>. "
@@ -240,7 +249,7 @@ class Config(commands.Cog):
             return
 
         await response.reply("done!")
-        async with aiosqlite.connect(self.bot.db_path) as database:
+        async with self.bot.db.connection() as database:
             cur = await database.cursor()
             insert_settings_into = (
                 "INSERT INTO activity_tracking_settings ("
@@ -256,7 +265,7 @@ class Config(commands.Cog):
             )
 
             id_fetch = await id_fetch.fetchone()
-            assert not id_fetch
+            assert id_fetch
             activity_tracking_id = id_fetch[0]
 
             insert_into_activity_tracking_channels = (
@@ -266,17 +275,21 @@ class Config(commands.Cog):
 
             # (fixme) Probably should represent this state in the database better, instead of
             # representing it as "absence of all channels" :')
-            if channels_for_rule == "all":
-                await database.commit()
-                return
-            activity_tracking_channels = [
-                (channel.id, activity_tracking_id) for channel in channels_for_rule
-            ]
-            await cur.executemany(
-                insert_into_activity_tracking_channels, activity_tracking_channels
-            )
+            if channels_for_rule != "all":
+                await cur.executemany(
+                    insert_into_activity_tracking_channels,
+                    [
+                        (channel.id, activity_tracking_id)
+                        for channel in channels_for_rule
+                    ],
+                )
             await database.commit()
 
+        # let activity tracking pick up the new rule.
+        activity_tracking = self.bot.get_cog("ActivityTracking")
+        if activity_tracking:
+            await activity_tracking.load_rules()
+
 
 # This function is called by the load_extension method on the bot.
 async def setup(bot):
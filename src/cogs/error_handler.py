@@ -1,8 +1,8 @@
 """
 A module that provides error handling using events.
 """
-import logging
 import secrets
+from datetime import datetime
 
 import discord
 from discord.ext import commands
@@ -14,14 +14,6 @@ class CommandErrorHandler(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-    logging.basicConfig(
-        filename="error.log",
-        filemode="a",
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        level=logging.ERROR,
-    )
-
     def generate_log_id(self):
         """Generates a unique ID with secrets.token_hex()"""
         return str(secrets.token_hex(4))
@@ -42,6 +34,9 @@ class CommandErrorHandler(commands.Cog):
                 return message
             case commands.CommandNotFound():
                 message = "Sorry, I don't have that command... _(yet)_."
+                suggestions = self.bot.suggestions.suggest(ctx.invoked_with or "")
+                if suggestions:
+                    footer = f"Perhaps you meant: {self.bot.prefix}{suggestions[0]}"
             case commands.CommandOnCooldown():
                 message = (
                     f"Please wait **{round(error.retry_after, 1)}** "
@@ -84,7 +79,14 @@ class CommandErrorHandler(commands.Cog):
             case _:
                 log_id = self.generate_log_id()
                 error_classname = type(error).__name__
-                logging.error("ID: %s | %s - %s", log_id, error_classname, str(error))
+                self.bot.error_log.error(
+                    log_id,
+                    error,
+                    command=ctx.command.qualified_name if ctx.command else None,
+                    guild_id=ctx.guild.id if ctx.guild else None,
+                    channel_id=ctx.channel.id,
+                    user_id=ctx.author.id,
+                )
 
                 message = (
                     "Oops, an error occurred while executing the command:\n"
@@ -108,6 +110,27 @@ class CommandErrorHandler(commands.Cog):
             error_embed.set_footer(text=footer_message)
         await ctx.send(embed=error_embed)
 
+    @commands.command(name="errorlog")
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def errorlog(self, ctx, log_id: str):
+        """Shows the logged error with the given Error ID."""
+        entry = await self.bot.error_log.find(log_id.strip().lower())
+        # errors from other servers stay private.
+        if entry is None or entry.get("guild_id") != ctx.guild.id:
+            await ctx.send(f"No error with the ID `{log_id}` was found.")
+            return
+
+        embed = discord.Embed(title=f"Error {entry['log_id']}")
+        embed.add_field(name="Error", value=entry["message"][:1024], inline=False)
+        embed.add_field(name="Command", value=entry.get("command") or "N/A")
+        embed.add_field(name="User", value=f"<@{entry.get('user_id')}>")
+        embed.add_field(name="Channel", value=f"<#{entry.get('channel_id')}>")
+        embed.set_footer(
+            text=datetime.fromtimestamp(entry["time"]).strftime("%Y-%m-%d %H:%M:%S")
+        )
+        await ctx.send(embed=embed)
+
 
 # This function is called by the load_extension method on the bot.
 async def setup(bot):
@@ -2,30 +2,20 @@
 Mainly a help command that replaces the default command that discord.py provides.
 This module also contains related commands and functions such as about, contrib, docs.
 """
-from typing import Mapping, Optional, TypeVar, List
+from typing import Dict, Mapping, Optional, List
 from collections.abc import Iterable
 
-import difflib
 import discord
 from discord.ext import commands
 
 from src.main import PCParadiseBot
 
-# pylint: disable=invalid-name
-T = TypeVar("T")
-# pylint: enable=invalid-name
-
 
 def codeblock(text: str) -> str:
     """Adds codeblock formatting to the given text."""
     return "```" + text + "```"
 
 
-def flatten(nested_iterable: Iterable[Iterable[T]]) -> Iterable[T]:
-    """Turns a set of listed iterables to an unested list of T."""
-    return (item for iterable in nested_iterable for item in iterable)
-
-
 def count(iterable: Iterable) -> int:
     """count the amount of items in an iterator."""
     return sum(1 for _ in iterable)
@@ -36,9 +26,72 @@ def command_usage(command: commands.Command) -> str:
     return f"!{command.name} {command.signature}"
 
 
+def bot_mapping(
+    bot: commands.Bot,
+) -> Mapping[Optional[commands.Cog], List[commands.Command]]:
+    """The same mapping HelpCommand.get_bot_mapping passes to send_bot_help."""
+    mapping: Dict[Optional[commands.Cog], List[commands.Command]] = {
+        cog: cog.get_commands() for cog in bot.cogs.values()
+    }
+    mapping[None] = [command for command in bot.commands if command.cog is None]
+    return mapping
+
+
+class HelpEmbedCache:
+    """
+    The rendered help embeds for the bot, every cog and every command. Built
+    all at once, and thrown away whenever a cog is added or removed.
+    """
+
+    def __init__(self):
+        self.bot_embed: Optional[discord.Embed] = None
+        self.cog_embeds: Dict[str, discord.Embed] = {}
+        self.command_embeds: Dict[str, discord.Embed] = {}
+
+    def __deepcopy__(self, memo):
+        # discord.py deep copies the help command's arguments for every
+        # invocation, but every copy has to share the same cache.
+        return self
+
+    def build(self, bot: commands.Bot) -> None:
+        """Renders every embed."""
+        self.bot_embed = CustomHelp.get_bot_help(bot_mapping(bot))
+        self.cog_embeds = {
+            name: CustomHelp.get_cog_help(cog) for name, cog in bot.cogs.items()
+        }
+        self.command_embeds = {
+            command.qualified_name: CustomHelp.get_command_help(command)
+            for command in bot.walk_commands()
+        }
+
+    def ensure_built(self, bot: commands.Bot) -> None:
+        """Renders the embeds again if they were invalidated."""
+        if self.bot_embed is None:
+            self.build(bot)
+
+    def size(self) -> int:
+        """How many embeds are rendered, the memory probe."""
+        return (
+            (self.bot_embed is not None)
+            + len(self.cog_embeds)
+            + len(self.command_embeds)
+        )
+
+    async def invalidate(self) -> None:
+        """Listener for on_commands_changed, the next help rebuilds the embeds."""
+        self.bot_embed = None
+        self.cog_embeds = {}
+        self.command_embeds = {}
+
+
 class CustomHelp(commands.HelpCommand):
     """Help command for the bot.
-    Defines how cogs, command groups, and commands are used."""
+    Defines how cogs, command groups, and commands are used.
+    The embeds come from a HelpEmbedCache."""
+
+    def __init__(self, cache: HelpEmbedCache, **options):
+        super().__init__(**options)
+        self.cache = cache
 
     @staticmethod
     def get_bot_help(
@@ -107,13 +160,7 @@ class CustomHelp(commands.HelpCommand):
     def command_not_found(self, string: str, /) -> discord.Embed:
 
         attempted_command = string.split()[0]
-        # gets the input that discord.py passes to the default help command
-        mapping = self.get_bot_mapping()
-        # gets all commands from the default help and converts it to a string
-        all_commands = [
-            cmd.name for cmd in flatten(cmds for _, cmds in mapping.items())
-        ]
-        most_likely_command = difflib.get_close_matches(attempted_command, all_commands)
+        most_likely_command = self.context.bot.suggestions.suggest(attempted_command)
 
         out = discord.Embed(
             title=f"{attempted_command} not found",
@@ -138,23 +185,40 @@ class CustomHelp(commands.HelpCommand):
 
     async def send_command_help(self, command: commands.Command, /):
         """Sends the command help message"""
+        self.cache.ensure_built(self.context.bot)
+        embed = self.cache.command_embeds.get(command.qualified_name)
         dest = self.get_destination()
-        await dest.send(embed=self.get_command_help(command))
+        await dest.send(embed=embed or self.get_command_help(command))
 
     async def send_cog_help(self, cog: commands.Cog, /):
         """Sends the cog help message"""
+        self.cache.ensure_built(self.context.bot)
+        embed = self.cache.cog_embeds.get(cog.qualified_name)
         dest = self.get_destination()
-        await dest.send(embed=self.get_cog_help(cog))
+        await dest.send(embed=embed or self.get_cog_help(cog))
 
     async def send_bot_help(
         self, mapping: Mapping[Optional[commands.Cog], List[commands.Command]], /
     ):
         """Sends the bot help message"""
+        self.cache.ensure_built(self.context.bot)
         dest = self.get_destination()
-        await dest.send(embed=self.get_bot_help(mapping))
+        await dest.send(embed=self.cache.bot_embed or self.get_bot_help(mapping))
 
 
 # This function is called by the load_extension method on the bot.
 async def setup(bot: PCParadiseBot):
     """Sets up the help command"""
-    bot.help_command = CustomHelp()
+    cache = HelpEmbedCache()
+    bot.help_command = CustomHelp(cache)
+    cache.build(bot)
+    bot.add_listener(cache.invalidate, "on_commands_changed")
+    bot.memory.register("help.embeds", cache.size)
+
+
+async def teardown(bot: PCParadiseBot):
+    """Puts the default help command back"""
+    if isinstance(bot.help_command, CustomHelp):
+        bot.remove_listener(bot.help_command.cache.invalidate, "on_commands_changed")
+    bot.memory.unregister("help.embeds")
+    bot.help_command = commands.DefaultHelpCommand()
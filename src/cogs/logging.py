@@ -1,9 +1,13 @@
 """
 A module to log events.
 """
-import aiosqlite
 from discord.ext import commands
-from discord.message import Message
+
+from src.utils.cache_policy import Needs
+from src.utils.ingestion import MessageContext
+
+# only logs who sent a message where and when, not what it says.
+NEEDS = Needs(intents=frozenset({"guild_messages"}))
 
 
 class Logging(commands.Cog):
@@ -16,25 +20,20 @@ class Logging(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-    @commands.Cog.listener()
-    async def on_message(self, msg: Message):
+    async def cog_load(self):
+        self.bot.ingestion.subscribe(self.log_message)
+
+    async def cog_unload(self):
+        self.bot.ingestion.unsubscribe(self.log_message)
+
+    async def log_message(self, ctx: MessageContext):
         """
-        Log every message when sent.
+        Log every message when sent, see src/utils/ingestion.py
         """
-        async with aiosqlite.connect(self.bot.db_path) as database:
-            cur = await database.cursor()
-            if not msg.channel or not msg.guild:
-                return
-            await cur.execute(
-                "INSERT INTO message_log VALUES(?, ?, ?, ?)",
-                (
-                    msg.channel.id,
-                    msg.author.id,
-                    msg.created_at.timestamp(),
-                    msg.guild.id,
-                ),
-            )
-            await database.commit()
+        # written in batches by the buffer, see src/utils/message_buffer.py
+        self.bot.message_buffer.add(
+            (ctx.channel_id, ctx.author_id, ctx.sent_at, ctx.guild_id)
+        )
 
 
 # This function is called by the load_extension method on the bot.
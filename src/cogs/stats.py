@@ -0,0 +1,137 @@
+"""
+A module that shows which listeners, commands and database calls take the
+most time, and where the memory goes.
+"""
+import asyncio
+from typing import List
+
+import discord
+from discord.ext import commands
+
+from src.main import PCParadiseBot
+from src.utils.cache_policy import cache_estimate
+from src.utils.memory import describe, resident_memory, top_allocations, top_differences
+from src.utils.metrics import KINDS
+
+
+def field(lines: List[str], empty: str) -> str:
+    """Joins lines into an embed field value, which is limited to 1024 characters."""
+    return "\n".join(lines)[:1024] or empty
+
+
+class Stats(commands.Cog):
+    """
+    Shows the latency metrics the bot collects.
+    """
+
+    def __init__(self, bot: PCParadiseBot):
+        self.bot = bot
+
+    @commands.command(name="stats")
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx, count: int = 5):
+        """
+        Shows the listeners, commands and database calls that took
+        the most time in total, with their p50/p95/p99 latencies.
+        """
+        count = max(1, min(count, 15))
+        embed = discord.Embed(title="Top offenders")
+        for kind in KINDS:
+            lines = [
+                f"`{name}` - {histogram.count} calls, "
+                f"{histogram.total * 1000:.0f}ms total, "
+                f"p50 {histogram.quantile(0.5) * 1000:.2f}ms "
+                f"p95 {histogram.quantile(0.95) * 1000:.2f}ms "
+                f"p99 {histogram.quantile(0.99) * 1000:.2f}ms"
+                for (_, name), histogram in self.bot.metrics.top(count, kind)
+            ]
+            embed.add_field(
+                name=kind.capitalize(),
+                value=field(lines, "Nothing recorded yet."),
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
+    @commands.command(name="memstats")
+    @commands.has_permissions(administrator=True)
+    async def memstats(self, ctx, count: int = 5):
+        """
+        Shows how big discord.py's caches and the bot's own in-memory
+        structures are, and with tracemalloc on the lines that allocated
+        the most and what grew since the last and the first snapshot.
+        """
+        count = max(1, min(count, 10))
+        memory = self.bot.memory
+        rss = resident_memory()
+        embed = discord.Embed(
+            title="Memory",
+            description=(
+                f"{rss / 1024 / 1024:.1f}MiB resident"
+                if rss
+                else "Resident size unknown"
+            ),
+        )
+        embed.add_field(
+            name="Discord caches",
+            value=field(
+                [
+                    f"`{kind}` - {objects} objects, ~{size / 1024:.0f}KiB"
+                    for kind, (objects, size) in cache_estimate(self.bot).items()
+                ],
+                "Nothing cached.",
+            ),
+            inline=False,
+        )
+        embed.add_field(
+            name="In memory",
+            value=field(
+                [
+                    f"`{name}` - {size}"
+                    for name, size in memory.sizes().items()
+                    if not name.startswith("discord.")
+                ],
+                "No probes registered.",
+            ),
+            inline=False,
+        )
+        if not memory.tracing:
+            embed.set_footer(
+                text="tracemalloc is off, set TracemallocFrames in config.ini "
+                "to see allocations."
+            )
+            await ctx.send(embed=embed)
+            return
+
+        async with ctx.typing():
+            snapshot, previous, written = await asyncio.to_thread(memory.capture)
+            sections = [("Top allocations", top_allocations(snapshot, count))]
+            if previous is not None:
+                sections.append(
+                    (
+                        "Since the last snapshot",
+                        top_differences(snapshot, previous, count),
+                    )
+                )
+            if memory.baseline is not None and memory.baseline is not snapshot:
+                sections.append(
+                    (
+                        "Since the first snapshot",
+                        top_differences(snapshot, memory.baseline, count),
+                    )
+                )
+        for name, statistics in sections:
+            embed.add_field(
+                name=name,
+                value=field(
+                    [f"`{describe(statistic)}`" for statistic in statistics],
+                    "Nothing allocated.",
+                ),
+                inline=False,
+            )
+        embed.set_footer(text=written.capitalize())
+        await ctx.send(embed=embed)
+
+
+async def setup(bot: PCParadiseBot):
+    """Setup the Stats cog."""
+    await bot.add_cog(Stats(bot))
@@ -2,9 +2,17 @@
 An example module for future contributors to reference using events.
 """
 import asyncio
+from typing import Set
+
 import discord
 from discord.ext import commands
-import aiosqlite
+
+from src.utils.cache_policy import Needs
+from src.utils.guild_settings import WelcomeSettings
+from src.utils.ingestion import MessageContext
+
+# compares what new members write with the welcome message.
+NEEDS = Needs(intents=frozenset({"guild_messages", "message_content"}))
 
 
 class WelcomeModule(commands.Cog):
@@ -15,17 +23,27 @@ class WelcomeModule(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        # tasks waiting to hear whether a member's role was granted.
+        self.reports: Set[asyncio.Task] = set()
 
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        """
-        General on message discord event
-        """
+    async def cog_load(self):
+        # only messages in a welcome channel are passed on, see src/utils/ingestion.py
+        self.bot.ingestion.subscribe(
+            self.on_welcome_message, lambda ctx: ctx.in_welcome_channel
+        )
 
-        # sql logic to check if welcome channel is enabled in server and get config if so
+    async def cog_unload(self):
+        self.bot.ingestion.unsubscribe(self.on_welcome_message)
+        for task in self.reports:
+            task.cancel()
 
+    async def on_welcome_message(self, ctx: MessageContext):
+        """
+        Called for every message sent in a welcome channel.
+        """
+        msg = ctx.message
         try:
-            await self.handle_welcome_message(msg)
+            await self.handle_welcome_message(msg, ctx.welcome)
 
         except discord.Forbidden:
             await msg.channel.send("An error occurred. (Bot is Missing Permissions)")
@@ -35,29 +53,14 @@ class WelcomeModule(commands.Cog):
                 "An error occurred while adding your role. Please try again later."
             )
 
-    async def handle_welcome_message(self, msg):
+    async def handle_welcome_message(self, msg, settings: WelcomeSettings):
         """
         Handles messages in the welcome channel for verification.
         """
-
-        detection_word, role_id, welcome_channel_id = None, None, None
-
-        async with aiosqlite.connect(self.bot.db_path) as database:
-            cur = await database.cursor()
-            server_settings_query = (
-                "SELECT detection_word, role_id, welcome_channel_id "
-                "FROM welcome_config_settings "
-                "WHERE server_id = ?"
-            )
-            await cur.execute(server_settings_query, (msg.guild.id,))
-            result = await cur.fetchone()
-            if result is None:
-                return None
-            detection_word, role_id, welcome_channel_id = result
+        detection_word, role_id, _ = settings
 
         # a few checks to make pylint happy and just adds general logic
         is_detection_word = detection_word == msg.content.lower()
-        is_welcome_channel = msg.channel.id == welcome_channel_id
         is_bypass = (
             msg.content.startswith("-") and msg.author.guild_permissions.administrator
         )
@@ -65,17 +68,18 @@ class WelcomeModule(commands.Cog):
         if is_bypass:
             return None
 
-        if (
-            is_detection_word
-            and not msg.author.bot
-            and msg.guild
-            and is_welcome_channel
-        ):
+        if is_detection_word:
             role = discord.utils.get(msg.guild.roles, id=role_id)
-            await msg.author.add_roles(role, reason="Passed verification in #welcome")
+            granted = self.bot.role_grants.grant(
+                msg.author, role, reason="Passed verification in #welcome"
+            )
+            # the grant can wait on discord's backoff, the handler doesn't.
+            task = asyncio.create_task(self.report_grant(msg.channel, granted))
+            self.reports.add(task)
+            task.add_done_callback(self.reports.discard)
             await msg.delete()
 
-        elif not msg.author.bot and msg.guild and is_welcome_channel:
+        else:
             embed = discord.Embed(
                 title=f"Hey {msg.author.name}",
                 description=(
@@ -87,9 +91,22 @@ class WelcomeModule(commands.Cog):
 
             failed_verify = await msg.channel.send(embed=embed)
             await msg.delete()
+            self.bot.deletions.schedule(failed_verify, delay=10)
 
-            await asyncio.sleep(10)
-            await failed_verify.delete()
+    @staticmethod
+    async def report_grant(channel, granted: asyncio.Future):
+        """
+        Tells the member if their role couldn't be granted, once the role
+        grant dispatcher gave up on it.
+        """
+        if await granted:
+            return
+        try:
+            await channel.send(
+                "An error occurred while adding your role. Please try again later."
+            )
+        except discord.HTTPException:
+            pass
 
 
 # This function is called by the load_extension method on the bot.
@@ -4,22 +4,60 @@ to the EXTENSIONS variable.
 """
 import asyncio
 import configparser
+import contextlib
+import functools
+import multiprocessing
 import os
 import pathlib
 import sys
+import time
 import traceback
 from datetime import datetime
-from typing import Union, Dict
-import aiosqlite
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 # The type stubs for appdirs are fairly old.
 # The mantainer seems open to accepting a PR
 # but the original PR in 2019 seems to be inactive.
 import appdirs  # type: ignore
 import discord
+import pytimeparse
 from discord.ext import commands
 
 import migrations
+from src.utils.cache_policy import CachePolicy, cache_estimate, extension_needs
+from src.utils.database import ConnectionPool, DatabaseSettings
+from src.utils.deletions import DeletionScheduler
+from src.utils.error_log import ErrorLog
+from src.utils.grant_ledger import GrantLedger
+from src.utils.guild_settings import GuildSettingsCache
+from src.utils.guild_sync import GuildSync
+from src.utils.ingestion import MessagePipeline
+from src.utils.memory import MemoryMonitor
+from src.utils.message_buffer import MessageLogBuffer
+from src.utils.message_writer import (
+    MessageLog,
+    RemoteMessageLog,
+    WriterConnection,
+    message_log_from_config,
+    serve,
+)
+from src.utils.metrics import Metrics
+from src.utils.role_grants import RoleGrantDispatcher
+from src.utils.suggestions import SuggestionIndex
+from src.utils.queries import unindexed_scans
+
+# how often run_sharded checks that the message writer is still alive, in seconds.
+WRITER_POLL = 1
 
 # List of cogs the bot will load on startup
 # Names should follow the dot-path notation (similar to imports)
@@ -31,46 +69,149 @@ EXTENSIONS = [
     "src.cogs.welcome",
     "src.cogs.config",
     "src.cogs.error_handler",
+    "src.cogs.stats",
 ]
 
-# Define API Intents that we want to subscribe to
-intents = discord.Intents.all()
-
 
+# pylint: disable-next=too-many-instance-attributes,too-many-public-methods
 class PCParadiseBot(commands.Bot):
     """
     Sub-class that inherits from commands.Bot to add additional attributes
     and have finer control over certain aspects of the bot.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        db_path: Optional[pathlib.Path] = None,
+        writer: Optional[WriterConnection] = None,
+        **options: Any,
+    ):
+        """
+        db_path overrides the path from the config, used by e.g. the benchmarks.
+        writer is set when the bot runs as one of several processes, see
+        run_sharded, options are passed on to commands.Bot.
+        """
         self.config = PCParadiseBot.initialize_config()
-
-        db_path = PCParadiseBot.get_program_path() / "database.db"
-        self.db_path = (
-            pathlib.Path(self.config["databasepath"])
-            if self.config.get("databasepath")
-            else db_path
+        self.writer = writer
+        self.db_path = db_path or PCParadiseBot.database_path(self.config)
+        # command errors, written by a background thread, see !errorlog.
+        self.error_log = ErrorLog(
+            self.process_path(
+                pathlib.Path(
+                    self.config.get("errorlogpath")
+                    or PCParadiseBot.get_program_path() / "error.log"
+                )
+            ),
+            max_bytes=int(self.config.get("errorlogmaxbytes", 1024 * 1024)),
+            backup_count=int(self.config.get("errorlogbackups", 5)),
+            interval=pytimeparse.parse(self.config.get("errorlogrotation", "1 day"))
+            or 0,
+        )
+        # latency of listeners, commands and database calls, see !stats.
+        self.metrics = Metrics()
+        # the timing wrappers around listeners, so remove_listener can find them.
+        self._timed_listeners: Dict[Tuple[str, Callable], Callable] = {}
+        # opened in setup_hook and closed in close, shared by every cog.
+        self.db = ConnectionPool(
+            self.db_path, DatabaseSettings.from_config(self.config), self.metrics
+        )
+        self.guild_settings = GuildSettingsCache(self.db)
+        self.grant_ledger = GrantLedger(self.db)
+        # inspects every message once and passes it on to the cogs that want it.
+        self.ingestion = MessagePipeline(self.guild_settings, self.metrics)
+        # with a shard directory set, every guild's history gets a file of its own.
+        self.message_log: MessageLog = message_log_from_config(
+            self.config, self.db, self.metrics, read_only=writer is not None
+        )
+        if writer is not None:
+            # another process writes message_log, see run_sharded.
+            self.message_log = RemoteMessageLog(self.message_log, writer)
+        self.message_buffer = MessageLogBuffer(
+            self.message_log,
+            flush_rows=int(self.config.get("flushrows", 500)),
+            flush_interval=float(self.config.get("flushinterval", 2)),
+        )
+        # keeps the servers table in step with the guilds the bot is in.
+        self.guild_sync = GuildSync(
+            self.db,
+            self.message_log,
+            self.message_buffer,
+            self.guild_settings,
+            self.grant_ledger,
+        )
+        # every role the bot hands out goes through here.
+        self.role_grants = RoleGrantDispatcher(
+            concurrency=int(self.config.get("grantconcurrency", 2)),
+            backoff=float(self.config.get("grantbackoff", 5)),
+            max_backoff=float(self.config.get("grantmaxbackoff", 600)),
+            max_attempts=int(self.config.get("grantattempts", 5)),
+        )
+        # deletes messages after a delay, e.g. the welcome cog's failure embeds.
+        self.deletions = DeletionScheduler()
+        # size probes, tracemalloc snapshots and the periodic report, see !memstats.
+        self.memory = MemoryMonitor(
+            self.process_path(
+                pathlib.Path(
+                    self.config.get("snapshotdirectory")
+                    or PCParadiseBot.get_program_path() / "memory"
+                )
+            ),
+            frames=int(self.config.get("tracemallocframes", 0)),
+            interval=pytimeparse.parse(self.config.get("memoryreportinterval", "0"))
+            or 0,
+            keep=int(self.config.get("snapshotkeep", 24)),
         )
 
         self.launch_time = datetime.utcnow()
+        # how long each phase of the startup took, in seconds.
+        self.startup_timings: Dict[str, float] = {}
+        self.started_at = time.perf_counter()
         self.default_activity = discord.Activity(
             type=discord.ActivityType.listening, name=f"{self.config['prefix']}help"
         )
 
         self.prefix = self.config["prefix"]
+        # only the intents and caches the extensions need, unless config.ini says otherwise.
+        self.cache_policy = CachePolicy.from_config(
+            self.config, extension_needs(EXTENSIONS)
+        )
+        # "did you mean" for mistyped commands, kept up to date by add/remove_command.
+        self.suggestions = SuggestionIndex(lambda: self.commands)
 
         # Call constructor of superclass Bot
         super().__init__(
             # Bot will respond to mention+cmd name and prefix+cmd name
             command_prefix=commands.when_mentioned_or(self.config["prefix"]),
-            intents=intents,
+            **self.cache_policy.options(),
             # Enables reconnect logic for when bot loses internet connection
             # or due to an issue communicating with the API
             reconnect=True,
+            **options,
         )
+        self.register_memory_probes()
 
-        asyncio.run(self.bot_startup())
+    def register_memory_probes(self) -> None:
+        """
+        Registers the sizes of discord.py's caches and of what the bot's own
+        services keep in memory with the memory monitor.
+        """
+        probes: Dict[str, Callable[[], int]] = {
+            "discord.guilds": lambda: len(self.guilds),
+            "discord.members": lambda: sum(len(guild.members) for guild in self.guilds),
+            "discord.users": lambda: len(self.users),
+            "discord.messages": lambda: len(self.cached_messages),
+            "guild_settings.welcome": lambda: len(self.guild_settings.welcome),
+            "guild_sync.known": lambda: len(self.guild_sync.known),
+            "grant_ledger.granted": lambda: len(self.grant_ledger.granted),
+            "ingestion.tracked": lambda: len(self.ingestion.tracked),
+            "ingestion.handling": lambda: len(self.ingestion.handling),
+            "message_buffer.rows": lambda: self.message_buffer.depth,
+            "role_grants.queued": lambda: len(self.role_grants.queued),
+            "deletions.scheduled": lambda: len(self.deletions.heap),
+            "error_log.index": lambda: len(self.error_log.handler.index),
+        }
+        for name, probe in probes.items():
+            self.memory.register(name, probe)
 
     @staticmethod
     def get_program_path() -> pathlib.Path:
@@ -79,6 +220,32 @@ class PCParadiseBot(commands.Bot):
         """
         return pathlib.Path(__file__).absolute().parent.parent
 
+    @staticmethod
+    def database_path(config: Dict[str, str]) -> pathlib.Path:
+        """The path of the database, from the config or next to the program."""
+        if config.get("databasepath"):
+            return pathlib.Path(config["databasepath"])
+        return PCParadiseBot.get_program_path() / "database.db"
+
+    def process_path(self, path: pathlib.Path) -> pathlib.Path:
+        """
+        The file this process should use for path, e.g. error.worker1.log
+        for the second worker, so processes don't write to the same file.
+        """
+        if self.writer is None:
+            return path
+        return path.with_name(f"{path.stem}.worker{self.writer.worker}{path.suffix}")
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """
+        Whether the guild's events arrive at this process, which is always
+        the case unless the bot is split into processes by shard.
+        """
+        shard_ids = getattr(self, "shard_ids", None) or ()
+        if not shard_ids or not self.shard_count:
+            return True
+        return (guild_id >> 22) % self.shard_count in shard_ids
+
     @staticmethod
     def get_conf_path(file_name: str) -> Union[str, None]:
         """
@@ -136,36 +303,239 @@ class PCParadiseBot(commands.Bot):
 
         return config
 
-    async def bot_startup(self) -> None:
+    @contextlib.contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        """
+        Records how long the body took in startup_timings under the given name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[phase] = time.perf_counter() - start
+
+    def add_listener(  # pylint: disable=W0221
+        self, func: Callable[..., Coroutine[Any, Any, Any]], /, name: str = ""
+    ) -> None:
         """
-        Blocking method that facilitates loading of all the
-        bot's cogs along with any other preliminary setup.
+        Registers a listener like commands.Bot does, wrapped so the time it
+        takes is recorded in the metrics.
         """
+        name = name or func.__name__
+        metric = getattr(func, "__qualname__", name)
+
+        @functools.wraps(func)
+        async def timed_listener(*args, **kwargs):
+            with self.metrics.timed("listener", metric):
+                return await func(*args, **kwargs)
+
+        self._timed_listeners[(name, func)] = timed_listener
+        super().add_listener(timed_listener, name)
+
+    def remove_listener(  # pylint: disable=W0221
+        self, func: Callable, /, name: str = ""
+    ) -> None:
+        """
+        Removes a listener added with add_listener.
+        """
+        name = name or func.__name__
+        super().remove_listener(self._timed_listeners.pop((name, func), func), name)
+
+    def add_command(self, command: commands.Command, /) -> None:
+        """
+        Adds the command like commands.Bot does, and invalidates the suggestions.
+        """
+        super().add_command(command)
+        self.suggestions.invalidate()
+
+    def remove_command(self, name: str, /) -> Optional[commands.Command]:
+        """
+        Removes the command like commands.Bot does, see add_command.
+        """
+        command = super().remove_command(name)
+        self.suggestions.invalidate()
+        return command
+
+    async def add_cog(self, cog: commands.Cog, /, **kwargs) -> None:
+        """
+        Adds the cog like commands.Bot does, and lets listeners like the help
+        command's cache know the commands changed. Reloading an extension
+        goes through here and remove_cog as well.
+        """
+        await super().add_cog(cog, **kwargs)
+        self.dispatch("commands_changed")
+
+    async def remove_cog(self, name: str, /, **kwargs) -> Optional[commands.Cog]:
+        """
+        Removes the cog like commands.Bot does, see add_cog.
+        """
+        cog = await super().remove_cog(name, **kwargs)
+        if cog is not None:
+            self.dispatch("commands_changed")
+        return cog
+
+    async def invoke(self, ctx: commands.Context, /) -> None:  # pylint: disable=W0221
+        """
+        Runs the command like commands.Bot does, recording how long it took.
+        """
+        if ctx.command is None:
+            await super().invoke(ctx)
+            return
+        with self.metrics.timed("command", ctx.command.qualified_name):
+            await super().invoke(ctx)
+
+    async def load_extensions(self) -> None:
+        """
+        Loads all of the bot's cogs concurrently. Extensions don't depend on
+        each other while loading, only on the database being ready.
+        """
+
+        async def load(extension: str) -> None:
+            with self.timed(extension):
+                try:
+                    await self.load_extension(extension)
+                    print(f"SUCCESS - {extension}")
+                except commands.ExtensionNotFound:
+                    print(f"FAILED - {extension}", file=sys.stderr)
+
         print("Loading cogs...")
-        for extension in EXTENSIONS:
-            try:
-                await self.load_extension(extension)
-                print(f"SUCCESS - {extension}")
-            except commands.ExtensionNotFound:
-                print(f"FAILED - {extension}", file=sys.stderr)
+        await asyncio.gather(*(load(extension) for extension in EXTENSIONS))
+
+    async def setup_hook(self) -> None:
+        """
+        Called by discord.py once the bot has logged in, but before it connects
+        to the websocket. Runs the migrations, opens the database connections
+        shared by the cogs and loads the cogs.
+        """
+        with self.timed("migrations"):
+            await migrations.run_migrations(self.db_path)
+
+        await self.error_log.start()
+        self.deletions.start()
+
+        with self.timed("database"):
+            await self.db.open()
+            await self.message_log.load()
+            await self.grant_ledger.load()
+            await self.guild_sync.load()
+            await self.guild_settings.load_all()
+            self.message_log.start()
+            self.message_buffer.start()
+
+            async with self.db.connection() as database:
+                for problem in await unindexed_scans(database):
+                    print(
+                        f"WARNING - query without an index: {problem}", file=sys.stderr
+                    )
+
+        with self.timed("extensions"):
+            await self.load_extensions()
+
+        if self.config.get("metricspath"):
+            self.metrics.start_exporting(
+                self.process_path(pathlib.Path(self.config["metricspath"])),
+                float(self.config.get("metricsinterval", 60)),
+            )
+
+        self.memory.start()
+        self.print_startup_timings()
+
+    def print_startup_timings(self) -> None:
+        """
+        Prints how long each part of the startup took, extensions are indented
+        under the phase that loaded them.
+        """
+        print("Startup timings:")
+        for phase in ("migrations", "database", "extensions"):
+            print(f"  {phase:<32} {self.startup_timings.get(phase, 0) * 1000:9.1f}ms")
+        for extension in sorted(
+            EXTENSIONS, key=lambda name: -self.startup_timings.get(name, 0)
+        ):
+            print(
+                f"    {extension:<30} "
+                f"{self.startup_timings.get(extension, 0) * 1000:9.1f}ms"
+            )
+
+    def print_cache_estimate(self) -> None:
+        """
+        Prints the intents and caches the bot asked for, and roughly how much
+        memory discord.py's caches take with them.
+        """
+        print(f"Cache policy - {self.cache_policy.describe()}")
+        estimate = cache_estimate(self)
+        for kind, (count, size) in estimate.items():
+            print(f"  {kind:<32} {count:9} {size / 1024:9.1f}KiB")
+        total = sum(size for _, size in estimate.values())
+        print(f"  {'total':<32} {'':9} {total / 1024:9.1f}KiB")
+
+    async def close(self) -> None:
+        """
+        Deletes the messages that were scheduled for deletion, closes the
+        connection to discord, writes out any buffered messages and afterwards
+        closes the database connections.
+        """
+        await self.deletions.stop()
+        await super().close()
+        await self.ingestion.drain()
+        self.metrics.stop_exporting()
+        self.memory.stop()
+        self.role_grants.stop()
+        self.error_log.stop()
+        self.message_log.stop()
+        if self.db.is_open:
+            await self.message_buffer.stop()
+        await self.message_log.close()
+        await self.db.close()
+
+        stats = self.db.stats
+        print(
+            f"Database pool - {stats.acquisitions} acquisitions, "
+            f"{stats.contended} contended, "
+            f"{stats.average_wait * 1000:.3f}ms average wait, "
+            f"{stats.max_wait * 1000:.3f}ms max wait"
+        )
+        buffer_stats = self.message_buffer.stats
+        print(
+            f"Message log buffer - {buffer_stats.rows_flushed} rows in "
+            f"{buffer_stats.flushes} flushes, "
+            f"{buffer_stats.average_flush_latency * 1000:.3f}ms average flush, "
+            f"{buffer_stats.max_flush_latency * 1000:.3f}ms max flush, "
+            f"{self.message_buffer.depth} rows left unwritten"
+        )
+        grant_stats = self.role_grants.stats
+        print(
+            f"Role grants - {grant_stats.granted} roles granted in "
+            f"{grant_stats.edits} member edits, {grant_stats.merged} merged, "
+            f"{grant_stats.failures} failures, {grant_stats.gave_up} given up"
+        )
+        deletion_stats = self.deletions.stats
+        print(
+            f"Scheduled deletions - {deletion_stats.deleted} messages deleted in "
+            f"{deletion_stats.requests} requests, {deletion_stats.failed} failed"
+        )
+
+    async def run_until_closed(self) -> None:
+        """
+        Runs the whole lifecycle of the bot on one event loop: setup_hook,
+        the connection to discord and finally close.
+        """
+        async with self:
+            await self.start(self.config["token"])
 
     def run(self):  # pylint: disable=W0221
         """
         Overrides DPY's event loop initialization logic allowing for more fine control.
         """
         try:
-            asyncio.run(migrations.run_migrations(self.db_path))
-            asyncio.run(self.start(self.config["token"]))
+            asyncio.run(self.run_until_closed())
         except KeyboardInterrupt:
+            # the bot was already closed while the event loop shut down.
             print("\nKeyboard Interrupt Detected")
-            asyncio.run(self.close())
             return
         except Exception:  # pylint: disable=W0703
             traceback.print_exc(file=sys.stderr)
             return
 
-        # Perform a graceful shutdown
-        asyncio.run(self.close())
         print("\nConnection Closed")
 
     async def on_ready(self):
@@ -179,25 +549,51 @@ class PCParadiseBot(commands.Bot):
         print(f"Logged in as {self.user} (ID: {self.user.id})")
         print(f"Discord.py Version - {discord.__version__}")
         print(f"Prefix - {self.config.get('prefix')}")
+        if "ready" not in self.startup_timings:
+            self.startup_timings["ready"] = time.perf_counter() - self.started_at
+            print(f"Ready after {self.startup_timings['ready']:.2f}s")
+            self.print_cache_estimate()
         print(" - ")
 
         print("The bot currently has access to the following guilds:")
         for guild in self.guilds:
             print(guild.name)
 
-        async with aiosqlite.connect(self.db_path) as database:
-            cur = await database.cursor()
-            await cur.executemany(
-                "INSERT OR IGNORE INTO servers VALUES (?)",
-                [(guild.id,) for guild in self.guilds],
-            )
-            await database.commit()
+        # on_ready is also sent after reconnecting, this only writes if the
+        # bot joined or left guilds while it was away.
+        removed = await self.guild_sync.reconcile(
+            (guild.id for guild in self.guilds), self.owns_guild
+        )
+        if removed:
+            print(f"Removed the data of guilds the bot left: {removed}")
+            self.dispatch("guilds_removed", removed)
 
         # Set the presence visible on the bot's profile
         await self.change_presence(
             status=discord.Status.online, activity=self.default_activity
         )
 
+    async def on_message(self, message: discord.Message, /) -> None:
+        """
+        Feeds the message to the ingestion pipeline, then runs it as a command.
+        Cogs subscribe to bot.ingestion instead of listening to on_message.
+        """
+        await self.ingestion.ingest(message)
+        await self.process_commands(message)
+
+    async def on_guild_join(self, guild: discord.Guild):
+        """
+        Registers a guild the bot was just added to.
+        """
+        await self.guild_sync.join(guild.id)
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        """
+        Removes everything stored about a guild the bot was removed from.
+        """
+        await self.guild_sync.leave(guild.id)
+        self.dispatch("guilds_removed", [guild.id])
+
     @staticmethod
     async def on_disconnect():
         """
@@ -207,11 +603,105 @@ class PCParadiseBot(commands.Bot):
         print("\nClient has disconnected")
 
 
+class ShardedPCParadiseBot(  # pylint: disable=too-many-ancestors
+    PCParadiseBot, commands.AutoShardedBot
+):
+    """
+    The bot running a subset of the shards, as one process of run_sharded.
+    """
+
+
+def shards_of(worker: int, workers: int, shard_count: int) -> List[int]:
+    """The shard ids a worker process runs, every workers-th shard."""
+    return list(range(worker, shard_count, workers))
+
+
+def run_worker(writer: WriterConnection, shard_ids: List[int], shard_count: int):
+    """Entry point of a worker process."""
+    ShardedPCParadiseBot(
+        writer=writer, shard_ids=shard_ids, shard_count=shard_count
+    ).run()
+
+
+def run_sharded(config: Dict[str, str], workers: int, shard_count: int) -> None:
+    """
+    Runs the bot as workers processes that each connect a share of the shards,
+    and one process that does all writes to message_log for them, since a
+    single event loop can't keep up with every guild at once.
+    """
+    context = multiprocessing.get_context("spawn")
+    db_path = PCParadiseBot.database_path(config)
+    asyncio.run(migrations.run_migrations(db_path))
+
+    requests = context.Queue()
+    replies = [context.Queue() for _ in range(workers)]
+    ready = context.Event()
+    writer = context.Process(
+        target=serve,
+        args=(db_path, config, requests, replies, ready),
+        name="message-writer",
+    )
+    writer.start()
+    # loading the store can take a while, e.g. when it first moves the
+    # history into guild shards, so only give up if the writer died.
+    while not ready.wait(WRITER_POLL):
+        if not writer.is_alive():
+            print(
+                f"The message writer exited with code {writer.exitcode} "
+                "before it was ready",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(
+                WriterConnection(worker, requests, replies[worker]),
+                shards_of(worker, workers, shard_count),
+                shard_count,
+            ),
+            name=f"worker-{worker}",
+        )
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        # the workers get Ctrl-C as well and close themselves, flushing their
+        # buffered messages through the writer, which ignores it.
+        while process.is_alive():
+            try:
+                process.join(WRITER_POLL)
+            except KeyboardInterrupt:
+                continue
+            if process.is_alive() and not writer.is_alive():
+                # the workers wait for the writer's answers, they'd never stop.
+                print(
+                    f"The message writer exited with code {writer.exitcode}, "
+                    "stopping the workers",
+                    file=sys.stderr,
+                )
+                for worker in processes:
+                    worker.terminate()
+    # nothing can send the writer anything anymore.
+    requests.put(None)
+    writer.join()
+
+
 def main():
     """
-    Entry point for poetry.
+    Entry point for poetry. With ShardProcesses above 1 the bot is split
+    into that many processes, see run_sharded.
     """
-    PCParadiseBot().run()
+    config = PCParadiseBot.initialize_config()
+    workers = int(config.get("shardprocesses", 1))
+    if workers > 1:
+        # every process needs at least one shard.
+        shard_count = max(workers, int(config.get("shardcount", workers)))
+        run_sharded(config, workers, shard_count)
+    else:
+        PCParadiseBot().run()
 
 
 if __name__ == "__main__":
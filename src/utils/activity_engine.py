@@ -0,0 +1,247 @@
+"""
+An in-memory engine that keeps track of who meets an activity rule,
+updated one message at a time.
+"""
+import math
+from collections import deque
+from dataclasses import dataclass
+from typing import (
+    Container,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+HOUR = 60 * 60
+
+
+@dataclass(frozen=True)
+class ActivityRule:
+    """
+    A row of activity_tracking_settings along with its channels.
+    An empty set of channels means the rule applies to all channels.
+    """
+
+    id: int  # pylint: disable=invalid-name
+    server_id: int
+    time_period: int
+    role_id: int
+    message_count: int
+    channels: FrozenSet[int]
+
+    def applies_to(self, channel_id: int) -> bool:
+        """Whether a message in the given channel counts towards this rule."""
+        return not self.channels or channel_id in self.channels
+
+
+class HourlyWindow:
+    """
+    The messages of a user per hour, for rules with a long time period where
+    keeping message_count timestamps would take too much memory. Only hours
+    that lie completely inside the time period are counted, so a user may meet
+    the rule up to an hour late, but never early.
+    """
+
+    __slots__ = ("buckets", "total", "latest")
+
+    def __init__(self):
+        # [hour, count], oldest first.
+        self.buckets: Deque[List[int]] = deque()
+        self.total = 0
+        # when the last counted message was sent.
+        self.latest = float("-inf")
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def add(self, timestamp: float, count: int = 1) -> None:
+        """Counts messages sent at timestamp, which can't be older than the last."""
+        hour = int(timestamp // HOUR)
+        if self.buckets and self.buckets[-1][0] == hour:
+            self.buckets[-1][1] += count
+        else:
+            self.buckets.append([hour, count])
+        self.total += count
+        self.latest = max(self.latest, timestamp)
+
+    def trim(self, since: float) -> None:
+        """Forgets the hours that started before since."""
+        first_hour = math.ceil(since / HOUR)
+        while self.buckets and self.buckets[0][0] < first_hour:
+            self.total -= self.buckets.popleft()[1]
+
+
+Window = Union[Deque[float], HourlyWindow]
+
+
+class ActivityEngine:
+    """
+    Keeps a sliding window of message timestamps per (rule, user), and reports
+    when a user crosses a rule's message_count. A window never holds more than
+    message_count timestamps, since older ones can't change whether the rule is met.
+    Users that already got a rule's role, going by granted, aren't tracked at all.
+
+    Rules with a time_period of at least coarse_period count messages per hour
+    in an HourlyWindow instead, which can be warmed up from message_counts.
+    """
+
+    def __init__(
+        self,
+        granted: Container[Tuple[int, int, int]] = frozenset(),
+        coarse_period: float = 0,
+    ):
+        # (server id, role id, user id) that were already granted.
+        self.granted = granted
+        # 0 keeps the timestamps for every rule.
+        self.coarse_period = coarse_period
+        self.rules: Dict[int, List[ActivityRule]] = {}
+        self.windows: Dict[Tuple[int, int], Window] = {}
+        # (rule id, user id) pairs that currently meet their rule.
+        self.qualified: Set[Tuple[int, int]] = set()
+
+    def load_rules(self, rules: Iterable[ActivityRule]) -> List[ActivityRule]:
+        """
+        Replaces the rules, dropping the windows of rules that no longer exist.
+        Returns the rules that weren't loaded before.
+        """
+        known = {rule.id for rules in self.rules.values() for rule in rules}
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.server_id, []).append(rule)
+
+        current = {rule.id for rules in self.rules.values() for rule in rules}
+        for key in [key for key in self.windows if key[0] not in current]:
+            del self.windows[key]
+            self.qualified.discard(key)
+        return [
+            rule
+            for rules in self.rules.values()
+            for rule in rules
+            if rule.id not in known
+        ]
+
+    def forget_servers(self, server_ids: Iterable[int]) -> None:
+        """
+        Drops the rules of the given servers, along with their windows.
+        """
+        removed = {
+            rule.id
+            for server_id in server_ids
+            for rule in self.rules.pop(server_id, ())
+        }
+        for key in [key for key in self.windows if key[0] in removed]:
+            del self.windows[key]
+        self.qualified = {key for key in self.qualified if key[0] not in removed}
+
+    def tracked_channels(self) -> Dict[int, Optional[FrozenSet[int]]]:
+        """
+        The channels that count towards any rule, per server.
+        None means a rule of the server counts every channel.
+        """
+        tracked: Dict[int, Optional[FrozenSet[int]]] = {}
+        for server_id, rules in self.rules.items():
+            if any(not rule.channels for rule in rules):
+                tracked[server_id] = None
+            else:
+                tracked[server_id] = frozenset().union(
+                    *(rule.channels for rule in rules)
+                )
+        return tracked
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def record(
+        self,
+        server_id: int,
+        channel_id: int,
+        user_id: int,
+        timestamp: float,
+        skip: Container[int] = frozenset(),
+    ) -> List[ActivityRule]:
+        """
+        Counts a message towards every rule of its server, except the rules
+        whose id is in skip. Messages have to be recorded in the order they
+        were sent. Returns the rules the user just started meeting.
+        """
+        return [
+            rule
+            for rule in self.rules.get(server_id, ())
+            if rule.id not in skip
+            and rule.applies_to(channel_id)
+            and self.record_rule(rule, user_id, timestamp)
+        ]
+
+    def is_coarse(self, rule: ActivityRule) -> bool:
+        """Whether the rule counts messages per hour, see HourlyWindow."""
+        return 0 < self.coarse_period <= rule.time_period
+
+    def record_rule(
+        self, rule: ActivityRule, user_id: int, timestamp: float, count: int = 1
+    ) -> bool:
+        """
+        Counts count messages sent at timestamp towards a single rule, without
+        looking at its channel. Counts above 1 are only for coarse rules.
+        Returns whether the user just started meeting the rule.
+        """
+        if (rule.server_id, rule.role_id, user_id) in self.granted:
+            return False
+        key = (rule.id, user_id)
+        window = self.windows.get(key)
+        oldest_counted = timestamp - rule.time_period
+        if self.is_coarse(rule):
+            if window is None:
+                window = self.windows[key] = HourlyWindow()
+            assert isinstance(window, HourlyWindow)
+            window.add(timestamp, count)
+            window.trim(oldest_counted)
+            counted = window.total
+        else:
+            if window is None:
+                window = self.windows[key] = deque(maxlen=rule.message_count)
+            assert isinstance(window, deque)
+            window.append(timestamp)
+            while window and window[0] < oldest_counted:
+                window.popleft()
+            counted = len(window)
+
+        if counted < rule.message_count:
+            self.qualified.discard(key)
+            return False
+        if key in self.qualified:
+            return False
+        self.qualified.add(key)
+        return True
+
+    def forget_user(self, server_id: int, role_id: int, user_id: int) -> None:
+        """
+        Drops the windows of every rule of the server that grants the role,
+        for once the user got it.
+        """
+        for rule in self.rules.get(server_id, ()):
+            if rule.role_id == role_id:
+                self.windows.pop((rule.id, user_id), None)
+                self.qualified.discard((rule.id, user_id))
+
+    def prune(self, now: float) -> None:
+        """
+        Forgets windows of users that haven't sent a counted message within
+        the rule's time period, so inactive users don't stay in memory.
+        """
+        periods = {
+            rule.id: rule.time_period for rules in self.rules.values() for rule in rules
+        }
+        for key, window in list(self.windows.items()):
+            if not window:
+                latest = float("-inf")
+            elif isinstance(window, HourlyWindow):
+                latest = window.latest
+            else:
+                latest = window[-1]
+            if latest < now - periods.get(key[0], 0):
+                del self.windows[key]
+                self.qualified.discard(key)
@@ -0,0 +1,197 @@
+"""
+Which gateway intents and caches the bot asks discord.py for. Every extension
+declares what it needs in a module level NEEDS, and the bot only asks for the
+union of those unless the [Bot] section of config.ini says otherwise.
+"""
+import importlib
+import sys
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Iterable, Optional
+
+import discord
+
+# how many cached objects of a kind are measured to estimate the size of all of them.
+SAMPLE_SIZE = 200
+# the intents each member cache flag needs to be filled.
+MEMBER_CACHE_INTENTS = {"joined": "members", "voice": "voice_states"}
+
+
+@dataclass(frozen=True)
+class Needs:
+    """
+    What an extension needs from the gateway: intents, member cache flags,
+    whether members have to be chunked on startup and how many messages
+    have to be cached.
+    """
+
+    intents: FrozenSet[str] = field(default_factory=frozenset)
+    member_cache: FrozenSet[str] = field(default_factory=frozenset)
+    chunk_guilds: bool = False
+    max_messages: int = 0
+
+    def __or__(self, other: "Needs") -> "Needs":
+        return Needs(
+            intents=self.intents | other.intents,
+            member_cache=self.member_cache | other.member_cache,
+            chunk_guilds=self.chunk_guilds or other.chunk_guilds,
+            max_messages=max(self.max_messages, other.max_messages),
+        )
+
+
+# what the bot needs itself: guild events for GuildSync, and messages
+# with their content for prefix commands, which also work in DMs.
+CORE_NEEDS = Needs(
+    intents=frozenset({"guilds", "guild_messages", "dm_messages", "message_content"})
+)
+
+
+def extension_needs(extensions: Iterable[str]) -> Needs:
+    """
+    The combined needs of the bot and the given extensions. Extensions that
+    can't be imported are skipped, load_extensions reports them later.
+    """
+    needs = CORE_NEEDS
+    for extension in extensions:
+        try:
+            module = importlib.import_module(extension)
+        except ImportError:
+            continue
+        needs |= getattr(module, "NEEDS", Needs())
+    return needs
+
+
+def _names(setting: str) -> FrozenSet[str]:
+    return frozenset(name.strip() for name in setting.split(",") if name.strip())
+
+
+@dataclass
+class CachePolicy:
+    """
+    The intents and cache settings the bot is constructed with.
+    """
+
+    intents: discord.Intents
+    member_cache_flags: discord.MemberCacheFlags
+    chunk_guilds_at_startup: bool
+    max_messages: Optional[int]
+
+    @staticmethod
+    def from_config(config: Dict[str, str], needs: Needs) -> "CachePolicy":
+        """
+        Builds the policy from the Intents, MemberCache, ChunkGuildsAtStartup
+        and MaxMessages settings. "auto" uses what the extensions need.
+        """
+        setting = config.get("intents", "auto").strip().lower()
+        if setting == "all":
+            intents = discord.Intents.all()
+        elif setting == "default":
+            intents = discord.Intents.default()
+        else:
+            names = needs.intents if setting == "auto" else _names(setting)
+            intents = discord.Intents(**{name: True for name in names})
+
+        setting = config.get("membercache", "auto").strip().lower()
+        if setting == "all":
+            member_cache = discord.MemberCacheFlags.from_intents(intents)
+        else:
+            names = needs.member_cache if setting == "auto" else _names(setting)
+            if "none" in names:
+                names = frozenset()
+            for name in sorted(names):
+                intent = MEMBER_CACHE_INTENTS.get(name)
+                if intent and not getattr(intents, intent):
+                    print(
+                        f"WARNING - the {name} member cache needs the {intent} "
+                        "intent, it stays off",
+                        file=sys.stderr,
+                    )
+                    names -= {name}
+            member_cache = discord.MemberCacheFlags.none()
+            for name in names:
+                setattr(member_cache, name, True)
+
+        setting = config.get("chunkguildsatstartup", "auto").strip().lower()
+        chunk = needs.chunk_guilds if setting == "auto" else setting in ("yes", "true")
+        # discord only sends the member list with the members intent.
+        chunk = chunk and intents.members
+
+        setting = config.get("maxmessages", "auto").strip().lower()
+        max_messages = needs.max_messages if setting == "auto" else int(setting)
+
+        return CachePolicy(intents, member_cache, chunk, max_messages or None)
+
+    def options(self) -> Dict[str, Any]:
+        """The keyword arguments for commands.Bot."""
+        return {
+            "intents": self.intents,
+            "member_cache_flags": self.member_cache_flags,
+            "chunk_guilds_at_startup": self.chunk_guilds_at_startup,
+            "max_messages": self.max_messages,
+        }
+
+    def describe(self) -> str:
+        """A one line summary, for the startup output."""
+        intents = ", ".join(name for name, enabled in self.intents if enabled)
+        member_cache = ", ".join(
+            name for name, enabled in self.member_cache_flags if enabled
+        )
+        return (
+            f"intents {intents or 'none'} - member cache {member_cache or 'none'} - "
+            f"chunking {'on' if self.chunk_guilds_at_startup else 'off'} - "
+            f"{self.max_messages or 0} cached messages"
+        )
+
+
+def approximate_size(obj: Any) -> int:
+    """
+    The size of an object along with the strings and containers directly in
+    its slots or __dict__. Other objects it refers to are counted separately,
+    like a member's guild, or shared, like interned strings.
+    """
+    size = sys.getsizeof(obj)
+    values = list(getattr(obj, "__dict__", {}).values())
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(obj, name):
+                values.append(getattr(obj, name))
+    for value in values:
+        if isinstance(value, (str, bytes, list, tuple, dict, set, frozenset)):
+            size += sys.getsizeof(value)
+    return size
+
+
+def estimate(objects: Iterable[Any], count: int) -> int:
+    """
+    Estimates the size of count objects from the first SAMPLE_SIZE of them.
+    """
+    sizes = []
+    for obj in objects:
+        sizes.append(approximate_size(obj))
+        if len(sizes) >= SAMPLE_SIZE:
+            break
+    if not sizes:
+        return 0
+    return int(sum(sizes) / len(sizes) * count)
+
+
+def cache_estimate(bot: discord.Client) -> Dict[str, Any]:
+    """
+    How many objects of each kind discord.py caches, and roughly how many
+    bytes they take, as {kind: (count, bytes)}.
+    """
+    guilds = bot.guilds
+    channels = [channel for guild in guilds for channel in guild.channels]
+    roles = [role for guild in guilds for role in guild.roles]
+    members = [member for guild in guilds for member in guild.members]
+    messages = list(bot.cached_messages)
+    return {
+        kind: (len(objects), estimate(objects, len(objects)))
+        for kind, objects in (
+            ("guilds", guilds),
+            ("channels", channels),
+            ("roles", roles),
+            ("members", members),
+            ("users", bot.users),
+            ("messages", messages),
+        )
+    }
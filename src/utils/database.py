@@ -0,0 +1,335 @@
+"""
+A small pool of long-lived aiosqlite connections shared by the whole bot.
+"""
+import asyncio
+import contextlib
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+import aiosqlite
+
+from src.utils.metrics import Metrics
+
+
+@dataclass
+class DatabaseSettings:  # pylint: disable=too-many-instance-attributes
+    """
+    The pragmas applied to every connection in the pool, and how often the
+    write-ahead log is checkpointed. Read from the [Database] section of config.ini.
+    """
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    # negative values are in KiB, positive ones in pages.
+    cache_size: int = -20000
+    mmap_size: int = 256 * 1024 * 1024
+    temp_store: str = "MEMORY"
+    # how long a connection waits for a lock before giving up, in milliseconds.
+    busy_timeout: int = 5000
+    # in seconds, 0 disables the scheduled checkpoints.
+    checkpoint_interval: float = 300
+    pool_size: int = 4
+
+    @staticmethod
+    def from_config(config: Dict[str, str]) -> "DatabaseSettings":
+        """
+        Builds the settings from the bot's config, using the defaults for missing keys.
+        """
+        defaults = DatabaseSettings()
+        return DatabaseSettings(
+            journal_mode=config.get("journalmode", defaults.journal_mode),
+            synchronous=config.get("synchronous", defaults.synchronous),
+            cache_size=int(config.get("cachesize", defaults.cache_size)),
+            mmap_size=int(config.get("mmapsize", defaults.mmap_size)),
+            temp_store=config.get("tempstore", defaults.temp_store),
+            busy_timeout=int(config.get("busytimeout", defaults.busy_timeout)),
+            checkpoint_interval=float(
+                config.get("checkpointinterval", defaults.checkpoint_interval)
+            ),
+            pool_size=int(config.get("poolsize", defaults.pool_size)),
+        )
+
+    def pragmas(self) -> List[str]:
+        """
+        The PRAGMA statements to run on a freshly opened connection.
+        """
+        for name, value in (
+            ("journal_mode", self.journal_mode),
+            ("synchronous", self.synchronous),
+            ("temp_store", self.temp_store),
+        ):
+            if not value.isalnum():
+                raise ValueError(f"Invalid value for {name}: {value!r}")
+        return [
+            f"PRAGMA journal_mode = {self.journal_mode}",
+            f"PRAGMA synchronous = {self.synchronous}",
+            f"PRAGMA cache_size = {int(self.cache_size)}",
+            f"PRAGMA mmap_size = {int(self.mmap_size)}",
+            f"PRAGMA temp_store = {self.temp_store}",
+            f"PRAGMA busy_timeout = {int(self.busy_timeout)}",
+        ]
+
+
+def _operation(name: str, sql: str) -> str:
+    """The metric name of a call, name and the first keyword of the SQL."""
+    keyword = sql.split(maxsplit=1)[:1]
+    return f"{name} {keyword[0].upper()}" if keyword else name
+
+
+class TimedCursor:
+    """
+    Wraps an aiosqlite cursor and records how long its execute and fetch
+    calls take, see TimedConnection. Everything else is passed on to the cursor.
+    """
+
+    def __init__(self, cursor: aiosqlite.Cursor, metrics: Metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.cursor, name)
+
+    async def execute(self, sql: str, parameters: Optional[Iterable[Any]] = None):
+        """See aiosqlite.Cursor.execute."""
+        with self.metrics.timed("db", _operation("execute", sql)):
+            await self.cursor.execute(sql, parameters)
+        return self
+
+    async def executemany(self, sql: str, parameters: Iterable[Iterable[Any]]):
+        """See aiosqlite.Cursor.executemany."""
+        with self.metrics.timed("db", _operation("executemany", sql)):
+            await self.cursor.executemany(sql, parameters)
+        return self
+
+    async def fetchone(self) -> Optional[sqlite3.Row]:
+        """See aiosqlite.Cursor.fetchone."""
+        with self.metrics.timed("db", "fetchone"):
+            return await self.cursor.fetchone()
+
+    async def fetchmany(self, size: Optional[int] = None) -> Iterable[sqlite3.Row]:
+        """See aiosqlite.Cursor.fetchmany."""
+        with self.metrics.timed("db", "fetchmany"):
+            return await self.cursor.fetchmany(size)
+
+    async def fetchall(self) -> Iterable[sqlite3.Row]:
+        """See aiosqlite.Cursor.fetchall."""
+        with self.metrics.timed("db", "fetchall"):
+            return await self.cursor.fetchall()
+
+
+class TimedConnection:
+    """
+    Wraps an aiosqlite connection and records how long its execute, commit
+    and rollback calls take, and those of its cursors, labelled with the
+    operation and the first keyword of the SQL, for e.g. "execute SELECT" or
+    "commit". Only aiosqlite's public API is used, everything else is passed
+    on to the connection.
+    """
+
+    def __init__(self, connection: aiosqlite.Connection, metrics: Metrics):
+        self.connection = connection
+        self.metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.connection, name)
+
+    async def cursor(self) -> TimedCursor:
+        """See aiosqlite.Connection.cursor."""
+        return TimedCursor(await self.connection.cursor(), self.metrics)
+
+    async def execute(
+        self, sql: str, parameters: Optional[Iterable[Any]] = None
+    ) -> TimedCursor:
+        """See aiosqlite.Connection.execute."""
+        with self.metrics.timed("db", _operation("execute", sql)):
+            cursor = await self.connection.execute(sql, parameters)
+        return TimedCursor(cursor, self.metrics)
+
+    async def executemany(
+        self, sql: str, parameters: Iterable[Iterable[Any]]
+    ) -> TimedCursor:
+        """See aiosqlite.Connection.executemany."""
+        with self.metrics.timed("db", _operation("executemany", sql)):
+            cursor = await self.connection.executemany(sql, parameters)
+        return TimedCursor(cursor, self.metrics)
+
+    async def commit(self) -> None:
+        """See aiosqlite.Connection.commit."""
+        with self.metrics.timed("db", "commit"):
+            await self.connection.commit()
+
+    async def rollback(self) -> None:
+        """See aiosqlite.Connection.rollback."""
+        with self.metrics.timed("db", "rollback"):
+            await self.connection.rollback()
+
+
+# what the pool hands out, a TimedConnection when metrics are recorded.
+Connection = Union[aiosqlite.Connection, TimedConnection]
+
+
+@dataclass
+class PoolStats:
+    """
+    Counters describing how long callers waited to get a connection.
+    Used to figure out if the pool size needs to change.
+    """
+
+    size: int = 0
+    acquisitions: int = 0
+    # acquisitions that had to wait because every connection was in use
+    contended: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def average_wait(self) -> float:
+        """The average time spent waiting for a connection, in seconds."""
+        return self.total_wait / self.acquisitions if self.acquisitions else 0.0
+
+
+class ConnectionPool:  # pylint: disable=too-many-instance-attributes
+    """
+    Owns a fixed amount of connections to the database which are opened
+    once on startup and handed out to cogs with acquire/release, or
+    more conveniently with `async with bot.db.connection() as database:`.
+    """
+
+    def __init__(
+        self,
+        db_path: pathlib.Path,
+        settings: Optional[DatabaseSettings] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.db_path = db_path
+        self.settings = settings or DatabaseSettings()
+        self.metrics = metrics
+        self.size = max(1, self.settings.pool_size)
+        self.stats = PoolStats(size=self.size)
+        self._connections: List[Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._checkpoint_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        """Whether open() has been called and close() hasn't been yet."""
+        return self._idle is not None
+
+    async def open(self) -> None:
+        """
+        Opens all the connections in the pool and applies the pragmas from the
+        settings to them. Calling this on an already open pool does nothing.
+        """
+        if self.is_open:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            connection: Connection = await aiosqlite.connect(self.db_path)
+            if self.metrics is not None:
+                connection = TimedConnection(connection, self.metrics)
+            for pragma in self.settings.pragmas():
+                await connection.execute(pragma)
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+
+        if self.settings.checkpoint_interval > 0:
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_periodically())
+
+    async def close(self) -> None:
+        """
+        Closes every connection in the pool. Safe to call more than once.
+        """
+        if not self.is_open:
+            return
+        if self._checkpoint_task is not None:
+            self._checkpoint_task.cancel()
+            self._checkpoint_task = None
+        self._idle = None
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
+
+    async def acquire(self) -> Connection:
+        """
+        Takes a connection out of the pool, waiting for one to be released
+        if they're all in use. Every acquire must be paired with a release.
+        """
+        if self._idle is None:
+            raise RuntimeError("The connection pool isn't open.")
+
+        start = time.perf_counter()
+        if self._idle.empty():
+            self.stats.contended += 1
+        connection = await self._idle.get()
+        waited = time.perf_counter() - start
+
+        self.stats.acquisitions += 1
+        self.stats.total_wait += waited
+        self.stats.max_wait = max(self.stats.max_wait, waited)
+        if self.metrics is not None:
+            self.metrics.observe("db", "pool wait", waited)
+        return connection
+
+    async def release(self, connection: Connection) -> None:
+        """
+        Puts a connection back into the pool. Any transaction left open
+        by the caller is rolled back so the next user starts clean.
+        """
+        if self._idle is None:
+            # the pool was closed while this connection was checked out,
+            # close() already took care of it.
+            return
+        if connection.in_transaction:
+            await connection.rollback()
+        self._idle.put_nowait(connection)
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        """
+        Context manager wrapping acquire and release.
+        """
+        connection = await self.acquire()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    @property
+    def wal_size(self) -> int:
+        """The size of the write-ahead log file in bytes, 0 if there is none."""
+        try:
+            return os.path.getsize(f"{self.db_path}-wal")
+        except OSError:
+            return 0
+
+    async def checkpoint(self) -> Tuple[int, int, int]:
+        """
+        Copies the write-ahead log back into the database and truncates it.
+        Returns sqlite's (busy, log frames, checkpointed frames), busy is 1
+        if a reader or writer kept the checkpoint from finishing.
+        """
+        async with self.connection() as database:
+            cur = await database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy, log, checkpointed = await cur.fetchone() or (0, 0, 0)
+        return busy, log, checkpointed
+
+    async def _checkpoint_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.checkpoint_interval)
+            size_before = self.wal_size
+            try:
+                busy, log, checkpointed = await self.checkpoint()
+            except Exception as error:  # pylint: disable=W0703
+                print(f"WAL checkpoint failed: {error}", file=sys.stderr)
+                continue
+            if not size_before and not busy:
+                continue
+            print(
+                f"WAL checkpoint - {size_before} bytes before, {self.wal_size} after, "
+                f"{checkpointed}/{log} frames checkpointed"
+                + (" (busy)" if busy else "")
+            )
@@ -0,0 +1,146 @@
+"""
+Deletes messages after a delay. Every scheduled deletion goes in one heap
+that a single task works through, and deletions due in the same channel are
+sent as one bulk delete.
+"""
+import asyncio
+import heapq
+import itertools
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import discord
+
+# discord's limit for a single bulk delete.
+BULK_LIMIT = 100
+# deletions due within this many seconds of each other are sent together.
+BATCH_WINDOW = 0.5
+# how long to wait before retrying when discord couldn't be reached, in seconds.
+RETRY_DELAY = 5
+MAX_ATTEMPTS = 5
+
+
+@dataclass
+class DeletionStats:
+    """
+    Counters describing how many requests the deletions took.
+    """
+
+    scheduled: int = 0
+    deleted: int = 0
+    # requests sent to discord, a bulk delete is one request.
+    requests: int = 0
+    failed: int = 0
+
+
+class DeletionScheduler:
+    """
+    A heap of (due, message) driven by one task, which sleeps until the earliest
+    deletion is due. The task only talks to discord over http, so it keeps
+    running while the gateway reconnects, failed requests are retried.
+    """
+
+    def __init__(self):
+        # (monotonic due time, tie breaker, attempts, message)
+        self.heap: List[Tuple[float, int, int, discord.Message]] = []
+        self.stats = DeletionStats()
+        self._order = itertools.count()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """The amount of messages waiting to be deleted."""
+        return len(self.heap)
+
+    def schedule(self, message: discord.Message, delay: float) -> None:
+        """Deletes the message after delay seconds."""
+        self.stats.scheduled += 1
+        self._push(time.monotonic() + delay, 0, message)
+
+    def _push(self, due: float, attempts: int, message: discord.Message) -> None:
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (due, next(self._order), attempts, message))
+        if earliest is None or due < earliest:
+            # wake the task up so it sleeps until the new earliest deletion.
+            self._changed.set()
+
+    def _pop_due(self, now: float) -> List[Tuple[int, discord.Message]]:
+        due = []
+        while self.heap and self.heap[0][0] <= now + BATCH_WINDOW:
+            _, _, attempts, message = heapq.heappop(self.heap)
+            due.append((attempts, message))
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            self._changed.clear()
+            if self.heap:
+                timeout: Optional[float] = self.heap[0][0] - time.monotonic()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._delete(self._pop_due(time.monotonic()))
+
+    async def _delete(self, due: List[Tuple[int, discord.Message]]) -> None:
+        by_channel: Dict[int, List[Tuple[int, discord.Message]]] = {}
+        for attempts, message in due:
+            by_channel.setdefault(message.channel.id, []).append((attempts, message))
+        for entries in by_channel.values():
+            for start in range(0, len(entries), BULK_LIMIT):
+                await self._delete_chunk(entries[start : start + BULK_LIMIT])
+
+    async def _delete_chunk(self, entries: List[Tuple[int, discord.Message]]) -> None:
+        messages = [message for _, message in entries]
+        self.stats.requests += 1
+        try:
+            if len(messages) == 1:
+                await messages[0].delete()
+            else:
+                await messages[0].channel.delete_messages(messages)
+        except (discord.NotFound, discord.Forbidden) as error:
+            # a bulk delete fails as a whole if one of the messages is already
+            # gone, and needs manage messages, which the bot's own messages don't.
+            if len(messages) == 1:
+                if isinstance(error, discord.Forbidden):
+                    self.stats.failed += 1
+                return
+            for entry in entries:
+                await self._delete_chunk([entry])
+            return
+        except (discord.HTTPException, aiohttp.ClientError, OSError) as error:
+            # discord is unreachable or having problems, try again later.
+            for attempts, message in entries:
+                if attempts + 1 >= MAX_ATTEMPTS:
+                    self.stats.failed += 1
+                    print(f"Giving up deleting {message.id}: {error}", file=sys.stderr)
+                    continue
+                self._push(time.monotonic() + RETRY_DELAY, attempts + 1, message)
+            return
+        self.stats.deleted += len(messages)
+
+    def start(self) -> None:
+        """Starts the task that deletes the messages."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the task, deleting everything still scheduled right away
+        so nothing is left behind.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        pending = [(attempts, message) for _, _, attempts, message in self.heap]
+        self.heap = []
+        if pending:
+            await self._delete(pending)
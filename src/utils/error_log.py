@@ -0,0 +1,217 @@
+"""
+The error log: command errors are handed to a queue and written as one json
+object per line by a background thread, into a file that is rotated by size and
+age. Every entry is indexed by its log id, so !errorlog can find it directly.
+"""
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import pathlib
+import queue
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+LOGGER_NAME = "pcparadise.errors"
+# the record attributes that are written to the log besides the message.
+FIELDS = ("log_id", "error", "command", "guild_id", "channel_id", "user_id")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line of json."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for name in FIELDS:
+            if hasattr(record, name):
+                entry[name] = getattr(record, name)
+        if record.exc_info:
+            entry["traceback"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class IndexedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates the file once it reaches max_bytes or is older than interval seconds,
+    keeping backup_count old files as path.1, path.2, ... Remembers which file
+    and where in it every entry with a log_id was written.
+    """
+
+    def __init__(
+        self, path: pathlib.Path, max_bytes: int, backup_count: int, interval: float
+    ):
+        # delay, so the file is only created once something goes wrong.
+        super().__init__(
+            path,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        self.interval = interval
+        self.rollover_at = self._next_rollover()
+        # bumped on every rotation, the file of generation g is path.(generation - g).
+        self.generation = 0
+        # log id -> (generation, offset)
+        self.index: Dict[str, Tuple[int, int]] = {}
+        self.index_lock = threading.Lock()
+
+    def _next_rollover(self) -> float:
+        if self.interval <= 0:
+            return float("inf")
+        try:
+            started = os.path.getmtime(self.baseFilename)
+        except OSError:
+            started = time.time()
+        return started + self.interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = (
+            time.time() + self.interval if self.interval > 0 else float("inf")
+        )
+        with self.index_lock:
+            self.generation += 1
+            oldest = self.generation - self.backupCount
+            self.index = {
+                log_id: location
+                for log_id, location in self.index.items()
+                if location[0] >= oldest
+            }
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            offset = self.stream.tell()
+            self.stream.write(self.format(record) + self.terminator)
+            self.flush()
+            log_id = getattr(record, "log_id", None)
+            if log_id:
+                with self.index_lock:
+                    self.index[log_id] = (self.generation, offset)
+        except Exception:  # pylint: disable=W0703
+            self.handleError(record)
+
+    def file_of(self, generation: int) -> str:
+        """The file the entries of a generation are in now."""
+        age = self.generation - generation
+        return self.baseFilename if age == 0 else f"{self.baseFilename}.{age}"
+
+    def load_index(self) -> None:
+        """
+        Indexes the entries already on disk, from the oldest backup to the
+        current file. Lines that aren't json, like ones from before the log
+        was structured, are skipped.
+        """
+        for age in range(self.backupCount, -1, -1):
+            generation = self.generation - age
+            try:
+                with open(self.file_of(generation), "rb") as file:
+                    offset = 0
+                    for line in file:
+                        try:
+                            log_id = json.loads(line).get("log_id")
+                        except (ValueError, AttributeError):
+                            log_id = None
+                        if log_id:
+                            with self.index_lock:
+                                self.index[log_id] = (generation, offset)
+                        offset += len(line)
+            except OSError:
+                continue
+
+    def find(self, log_id: str) -> Optional[Dict[str, Any]]:
+        """Reads the entry with the given log id, None if it isn't in the log."""
+        with self.index_lock:
+            location = self.index.get(log_id)
+            if location is None:
+                return None
+            path = self.file_of(location[0])
+        try:
+            with open(path, "rb") as file:
+                file.seek(location[1])
+                entry = json.loads(file.readline())
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("log_id") == log_id else None
+
+
+class ErrorLog:
+    """
+    Owns the queue the error logger writes into, and the thread that moves
+    records from it into the file. Logging is just putting a record in a queue,
+    so it never blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        max_bytes: int = 1024 * 1024,
+        backup_count: int = 5,
+        interval: float = 24 * 60 * 60,
+    ):
+        self.handler = IndexedRotatingFileHandler(
+            path, max_bytes, backup_count, interval
+        )
+        self.handler.setFormatter(JsonFormatter())
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.propagate = False
+        self._queue_handler = logging.handlers.QueueHandler(self.queue)
+        self._running = False
+
+    async def start(self) -> None:
+        """
+        Indexes the existing log and starts the writer thread.
+        """
+        if self._running:
+            return
+        await asyncio.to_thread(self.handler.load_index)
+        self.logger.addHandler(self._queue_handler)
+        self.listener.start()
+        self._running = True
+
+    def stop(self) -> None:
+        """
+        Writes out whatever is still queued and stops the writer thread.
+        """
+        if not self._running:
+            return
+        self._running = False
+        self.logger.removeHandler(self._queue_handler)
+        self.listener.stop()
+        self.handler.close()
+
+    def error(self, log_id: str, error: BaseException, **fields: Any) -> None:
+        """
+        Logs an error under the given log id, fields like command or
+        guild_id are stored with it.
+        """
+        self.logger.error(
+            "%s - %s",
+            type(error).__name__,
+            error,
+            extra={"log_id": log_id, "error": type(error).__name__, **fields},
+        )
+
+    async def find(self, log_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Looks an entry up by its log id, reading it from disk off the event loop.
+        """
+        return await asyncio.to_thread(self.handler.find, log_id)
@@ -0,0 +1,62 @@
+"""
+A record of every role the activity rules granted, kept in activity_grant_ledger.
+"""
+import time
+from typing import Iterable, Optional, Set, Tuple
+
+from src.utils.database import ConnectionPool
+
+# (server id, role id, user id)
+LedgerKey = Tuple[int, int, int]
+
+
+class GrantLedger:
+    """
+    Holds every (server, role, user) that was granted in memory, written through
+    to the database so the next run doesn't evaluate or grant them again.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.granted: Set[LedgerKey] = set()
+
+    async def load(self) -> None:
+        """
+        Reads the whole ledger from the database.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT server_id, role_id, user_id FROM activity_grant_ledger"
+            )
+            self.granted = set(await cur.fetchall())
+
+    def __contains__(self, key: LedgerKey) -> bool:
+        return key in self.granted
+
+    async def record(
+        self,
+        server_id: int,
+        role_id: int,
+        user_id: int,
+        granted_at: Optional[float] = None,
+    ) -> None:
+        """
+        Records that the user has the role.
+        """
+        key = (server_id, role_id, user_id)
+        if key in self.granted:
+            return
+        self.granted.add(key)
+        async with self.pool.connection() as database:
+            await database.execute(
+                "INSERT OR IGNORE INTO activity_grant_ledger VALUES (?, ?, ?, ?)",
+                (*key, time.time() if granted_at is None else granted_at),
+            )
+            await database.commit()
+
+    def forget_servers(self, server_ids: Iterable[int]) -> None:
+        """
+        Drops the in-memory grants of servers whose rows were deleted.
+        """
+        server_ids = set(server_ids)
+        self.granted = {key for key in self.granted if key[0] not in server_ids}
@@ -0,0 +1,73 @@
+"""
+An in-memory cache of per guild settings, so hot paths don't have to query them.
+"""
+from typing import Dict, NamedTuple, Optional
+
+from src.utils.database import ConnectionPool
+from src.utils.queries import WELCOME_SETTINGS_QUERY
+
+
+class WelcomeSettings(NamedTuple):
+    """
+    A row of welcome_config_settings.
+    """
+
+    detection_word: str
+    role_id: int
+    welcome_channel_id: int
+
+
+class GuildSettingsCache:
+    """
+    Holds the settings of every guild. Filled with one bulk query, and kept up to
+    date by whoever changes the settings (write-through) and on guild join/leave.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.welcome: Dict[int, WelcomeSettings] = {}
+
+    async def load_all(self) -> None:
+        """
+        Replaces the cache with the settings of every guild.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT server_id, detection_word, role_id, welcome_channel_id "
+                "FROM welcome_config_settings"
+            )
+            self.welcome = {
+                server_id: WelcomeSettings(*settings)
+                for server_id, *settings in await cur.fetchall()
+            }
+
+    async def load_guild(self, server_id: int) -> None:
+        """
+        (Re)loads the settings of a single guild, for e.g. when the bot joins it.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(WELCOME_SETTINGS_QUERY, (server_id,))
+            result = await cur.fetchone()
+        self.set_welcome(server_id, WelcomeSettings(*result) if result else None)
+
+    def forget_guild(self, server_id: int) -> None:
+        """
+        Drops everything cached about a guild.
+        """
+        self.welcome.pop(server_id, None)
+
+    def welcome_for(self, server_id: int) -> Optional[WelcomeSettings]:
+        """
+        The welcome settings of a guild, None if it doesn't have a welcome channel.
+        """
+        return self.welcome.get(server_id)
+
+    def set_welcome(self, server_id: int, settings: Optional[WelcomeSettings]) -> None:
+        """
+        Updates the cached welcome settings after they were written to the database.
+        Passing None means the welcome channel was disabled.
+        """
+        if settings is None:
+            self.welcome.pop(server_id, None)
+        else:
+            self.welcome[server_id] = settings
@@ -0,0 +1,136 @@
+"""
+Keeps the servers table in step with the guilds the bot is in, and removes
+everything stored about a guild once the bot leaves it.
+"""
+import asyncio
+from typing import Callable, Iterable, List, Optional, Set
+
+from src.utils.database import ConnectionPool
+from src.utils.grant_ledger import GrantLedger
+from src.utils.guild_settings import GuildSettingsCache
+from src.utils.message_buffer import MessageLogBuffer
+from src.utils.message_writer import MessageLog
+
+
+class GuildSync:
+    """
+    Remembers which servers are in the database, so joins, leaves and the diff
+    against the guilds discord reports on ready only write what changed.
+    A reconnect that finds the same guilds doesn't touch the database at all.
+    """
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        message_log: MessageLog,
+        message_buffer: MessageLogBuffer,
+        guild_settings: GuildSettingsCache,
+        grant_ledger: GrantLedger,
+    ):
+        self.pool = pool
+        self.message_log = message_log
+        self.message_buffer = message_buffer
+        self.guild_settings = guild_settings
+        self.grant_ledger = grant_ledger
+        # the ids in the servers table.
+        self.known: Set[int] = set()
+        # joins, leaves and reconciles run one at a time.
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        """
+        Reads the servers table. Has to be called before anything else.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute("SELECT id FROM servers")
+            self.known = {server_id for (server_id,) in await cur.fetchall()}
+
+    async def join(self, server_id: int) -> None:
+        """
+        Registers a guild the bot was added to.
+        """
+        async with self._lock:
+            await self._add([server_id])
+
+    async def leave(self, server_id: int) -> None:
+        """
+        Removes everything stored about a guild the bot was removed from.
+        """
+        async with self._lock:
+            await self._remove([server_id])
+
+    async def reconcile(
+        self,
+        server_ids: Iterable[int],
+        owned: Optional[Callable[[int], bool]] = None,
+    ) -> List[int]:
+        """
+        Brings the servers table in line with the guilds the bot is in now,
+        adding the ones joined and removing the ones left while it was offline.
+        When the bot is split into processes, owned tells which servers this
+        one sees, the others are left alone. Returns the servers that were removed.
+        """
+        server_ids = set(server_ids)
+        async with self._lock:
+            removed = sorted(
+                server_id
+                for server_id in self.known - server_ids
+                if owned is None or owned(server_id)
+            )
+            await self._add(server_ids - self.known)
+            await self._remove(removed)
+        return removed
+
+    async def _add(self, server_ids: Iterable[int]) -> None:
+        added = [server_id for server_id in server_ids if server_id not in self.known]
+        if not added:
+            return
+        async with self.pool.connection() as database:
+            await database.executemany(
+                "INSERT OR IGNORE INTO servers VALUES (?)",
+                [(server_id,) for server_id in added],
+            )
+            await database.commit()
+        self.known.update(added)
+        for server_id in added:
+            await self.guild_settings.load_guild(server_id)
+
+    async def _remove(self, server_ids: List[int]) -> None:
+        if not server_ids:
+            return
+        # nothing of the guild may be written after its rows are gone.
+        await self.message_buffer.flush()
+        await self.message_log.delete_servers(server_ids)
+
+        placeholders = ", ".join("?" * len(server_ids))
+        async with self.pool.connection() as database:
+            try:
+                await database.execute("BEGIN")
+                await database.execute(
+                    "DELETE FROM activity_tracking_channels "
+                    "WHERE activity_tracking_id IN ("
+                    "    SELECT id FROM activity_tracking_settings"
+                    f"    WHERE server_id IN ({placeholders})"
+                    ")",
+                    server_ids,
+                )
+                for table, column in (
+                    ("activity_tracking_settings", "server_id"),
+                    ("activity_grant_ledger", "server_id"),
+                    ("welcome_config_settings", "server_id"),
+                    ("servers", "id"),
+                ):
+                    await database.execute(
+                        f"DELETE FROM {table} WHERE {column} IN ({placeholders})",
+                        server_ids,
+                    )
+                await database.commit()
+            except BaseException:
+                await database.rollback()
+                raise
+
+        self.known.difference_update(server_ids)
+        self.grant_ledger.forget_servers(server_ids)
+        for server_id in server_ids:
+            self.guild_settings.forget_guild(server_id)
@@ -0,0 +1,141 @@
+"""
+The message ingestion pipeline: every message is inspected once, DMs and bot
+messages are dropped right away, and what the cogs need to know about the rest
+is put in a MessageContext that is handed to every subscribed handler.
+"""
+import asyncio
+import sys
+import traceback
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import discord
+
+from src.utils.guild_settings import GuildSettingsCache, WelcomeSettings
+from src.utils.metrics import Metrics
+
+Handler = Callable[["MessageContext"], Coroutine[Any, Any, Any]]
+Accepts = Callable[["MessageContext"], bool]
+
+
+@dataclass(frozen=True)
+class MessageContext:
+    """
+    What the pipeline found out about a guild message, shared by every handler.
+    """
+
+    message: discord.Message
+    guild_id: int
+    channel_id: int
+    author_id: int
+    sent_at: float
+    # the guild's welcome settings, None if it has no welcome channel.
+    welcome: Optional[WelcomeSettings]
+    # whether messages in the channel count towards an activity rule.
+    tracked: bool
+
+    @property
+    def in_welcome_channel(self) -> bool:
+        """Whether the message was sent in the guild's welcome channel."""
+        return self.welcome is not None and (
+            self.channel_id == self.welcome.welcome_channel_id
+        )
+
+
+class MessagePipeline:
+    """
+    Runs once per message from the bot's on_message. Handlers subscribe with a
+    predicate on the context, so a cog only hears about the messages it cares
+    about without looking at the message itself. Every handler runs in a task
+    of its own, so a slow or failing handler doesn't hold up the others, the
+    commands or the next message, and the order they subscribed in doesn't matter.
+    """
+
+    def __init__(self, guild_settings: GuildSettingsCache, metrics: Metrics):
+        self.guild_settings = guild_settings
+        self.metrics = metrics
+        # (metric name, handler, accepts) in the order they subscribed.
+        self.subscribers: List[Tuple[str, Handler, Optional[Accepts]]] = []
+        # server id -> the channels its activity rules count, None for all of them.
+        self.tracked: Dict[int, Optional[FrozenSet[int]]] = {}
+        # handlers that are still running.
+        self.handling: Set[asyncio.Task] = set()
+
+    def subscribe(self, handler: Handler, accepts: Optional[Accepts] = None) -> None:
+        """
+        Calls handler with the context of every message accepts returns True
+        for, or of every message if accepts is None.
+        """
+        name = getattr(handler, "__qualname__", repr(handler))
+        self.subscribers.append((name, handler, accepts))
+
+    def unsubscribe(self, handler: Handler) -> None:
+        """Stops calling a handler passed to subscribe."""
+        self.subscribers = [
+            subscriber for subscriber in self.subscribers if subscriber[1] != handler
+        ]
+
+    def track(self, tracked: Dict[int, Optional[FrozenSet[int]]]) -> None:
+        """
+        Sets which channels count towards activity rules, per server.
+        """
+        self.tracked = tracked
+
+    def context(self, message: discord.Message) -> Optional[MessageContext]:
+        """
+        The context of a message, None if no handler should see it.
+        """
+        if message.guild is None or message.author.bot:
+            return None
+        guild_id, channel_id = message.guild.id, message.channel.id
+        tracked = guild_id in self.tracked
+        if tracked:
+            channels = self.tracked[guild_id]
+            tracked = channels is None or channel_id in channels
+        return MessageContext(
+            message=message,
+            guild_id=guild_id,
+            channel_id=channel_id,
+            author_id=message.author.id,
+            sent_at=message.created_at.timestamp(),
+            welcome=self.guild_settings.welcome_for(guild_id),
+            tracked=tracked,
+        )
+
+    async def _handle(self, name: str, handler: Handler, ctx: MessageContext) -> None:
+        try:
+            with self.metrics.timed("listener", name):
+                await handler(ctx)
+        except Exception:  # pylint: disable=W0703
+            print(f"Ignoring exception in {name}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+    async def ingest(self, message: discord.Message) -> None:
+        """
+        Builds the message's context and starts every handler that accepts it.
+        Returns without waiting for them, see drain.
+        """
+        ctx = self.context(message)
+        if ctx is None:
+            return
+        for name, handler, accepts in self.subscribers:
+            if accepts is not None and not accepts(ctx):
+                continue
+            task = asyncio.create_task(self._handle(name, handler, ctx))
+            self.handling.add(task)
+            task.add_done_callback(self.handling.discard)
+
+    async def drain(self) -> None:
+        """Waits until the handlers of every message ingested so far are done."""
+        while self.handling:
+            await asyncio.wait(self.handling)
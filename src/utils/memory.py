@@ -0,0 +1,231 @@
+"""
+Where the bot's memory goes: the size of discord.py's caches, of the
+structures the bot and its cogs keep in memory, and with tracemalloc turned
+on the lines that allocated the most. Snapshots are written to disk so runs
+can be compared offline:
+
+    python -m src.utils.memory memory/snapshot_1.tracemalloc memory/snapshot_2.tracemalloc
+"""
+import argparse
+import asyncio
+import os
+import pathlib
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# allocations of these files are tracemalloc's own or import machinery.
+IGNORED = ("<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>")
+IGNORED_MODULES = (tracemalloc.__file__,)
+
+Probe = Callable[[], int]
+
+
+def resident_memory() -> Optional[int]:
+    """
+    The resident set size of the process in bytes, None where /proc isn't
+    available.
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _filtered(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+    return snapshot.filter_traces(
+        [tracemalloc.Filter(False, name) for name in IGNORED + IGNORED_MODULES]
+    )
+
+
+def top_allocations(
+    snapshot: tracemalloc.Snapshot, count: int
+) -> List[tracemalloc.Statistic]:
+    """The lines that allocated the most memory still alive in snapshot."""
+    return _filtered(snapshot).statistics("lineno")[:count]
+
+
+def top_differences(
+    snapshot: tracemalloc.Snapshot, earlier: tracemalloc.Snapshot, count: int
+) -> List[tracemalloc.StatisticDiff]:
+    """The lines whose allocations grew or shrank the most since earlier."""
+    return _filtered(snapshot).compare_to(_filtered(earlier), "lineno")[:count]
+
+
+def describe(statistic: Union[tracemalloc.Statistic, tracemalloc.StatisticDiff]) -> str:
+    """
+    One line for a statistic: where it was allocated, how much is alive and
+    for a difference how much that changed.
+    """
+    frame = statistic.traceback[0]
+    where = "/".join(pathlib.Path(frame.filename).parts[-2:])
+    line = f"{where}:{frame.lineno} {statistic.size / 1024:.1f}KiB in {statistic.count}"
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        line += f" ({statistic.size_diff / 1024:+.1f}KiB, {statistic.count_diff:+})"
+    return line
+
+
+class MemoryMonitor:  # pylint: disable=too-many-instance-attributes
+    """
+    Keeps the size probes registered by the bot and its cogs, takes
+    tracemalloc snapshots and, once started with an interval, prints a
+    report and writes a snapshot every interval seconds.
+
+    Every probe returns how many entries a structure holds, e.g. the number
+    of activity windows. They're cheap enough to run on every !memstats.
+    """
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        frames: int = 0,
+        interval: float = 0,
+        keep: int = 24,
+        report_count: int = 10,
+    ):
+        self.directory = directory
+        # how many frames tracemalloc keeps per allocation, 0 leaves it off.
+        self.frames = frames
+        self.interval = interval
+        # how many snapshot files are kept, the oldest are deleted.
+        self.keep = max(1, keep)
+        self.report_count = report_count
+        self.probes: Dict[str, Probe] = {}
+        # the first snapshot, and the one taken before the latest.
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, probe: Probe) -> None:
+        """
+        Registers a size probe, replacing one of the same name. Cogs register
+        theirs in cog_load and unregister them in cog_unload.
+        """
+        self.probes[name] = probe
+
+    def unregister(self, name: str) -> None:
+        """Removes a size probe, see register."""
+        self.probes.pop(name, None)
+
+    def sizes(self) -> Dict[str, int]:
+        """Runs every probe, a failing probe is reported as -1."""
+        sizes = {}
+        for name, probe in sorted(self.probes.items()):
+            try:
+                sizes[name] = probe()
+            except Exception as error:  # pylint: disable=W0703
+                print(f"Memory probe {name} failed: {error}", file=sys.stderr)
+                sizes[name] = -1
+        return sizes
+
+    @property
+    def tracing(self) -> bool:
+        """Whether tracemalloc is tracing allocations."""
+        return tracemalloc.is_tracing()
+
+    def snapshot(self) -> Tuple[tracemalloc.Snapshot, Optional[tracemalloc.Snapshot]]:
+        """
+        Takes a snapshot, returns it and the one taken before it. The first
+        snapshot becomes the baseline. tracemalloc has to be tracing.
+        """
+        snapshot = tracemalloc.take_snapshot()
+        previous = self.previous
+        if self.baseline is None:
+            self.baseline = snapshot
+        self.previous = snapshot
+        return snapshot, previous
+
+    def write(self, snapshot: tracemalloc.Snapshot) -> pathlib.Path:
+        """
+        Writes the snapshot to the directory, and deletes the oldest ones
+        beyond keep. Returns the path it was written to.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"snapshot_{time.time_ns()}.tracemalloc"
+        temporary = path.with_name(path.name + ".tmp")
+        snapshot.dump(str(temporary))
+        temporary.replace(path)
+        for old in sorted(self.directory.glob("snapshot_*.tracemalloc"))[: -self.keep]:
+            old.unlink(missing_ok=True)
+        return path
+
+    def capture(
+        self,
+    ) -> Tuple[tracemalloc.Snapshot, Optional[tracemalloc.Snapshot], str]:
+        """
+        Takes a snapshot and writes it, see snapshot. The last element says
+        where it was written to.
+        """
+        snapshot, previous = self.snapshot()
+        try:
+            written = f"snapshot written to {self.write(snapshot)}"
+        except OSError as error:
+            print(f"Failed to write memory snapshot: {error}", file=sys.stderr)
+            written = "snapshot couldn't be written"
+        return snapshot, previous, written
+
+    async def report(self) -> str:
+        """
+        The resident memory, the probes, and if tracing the allocations that
+        grew the most since the previous report. Takes and writes a snapshot.
+        """
+        rss = resident_memory()
+        lines = [
+            "Memory - "
+            + (f"{rss / 1024 / 1024:.1f}MiB resident" if rss else "resident unknown")
+        ]
+        lines.extend(f"  {name:<40} {size:9}" for name, size in self.sizes().items())
+        if self.tracing:
+            # snapshots of a big heap take a while, the event loop keeps running.
+            snapshot, previous, written = await asyncio.to_thread(self.capture)
+            lines.append(f"  {written}")
+            if previous is not None:
+                differences = await asyncio.to_thread(
+                    top_differences, snapshot, previous, self.report_count
+                )
+                lines.extend(f"  {describe(difference)}" for difference in differences)
+        return "\n".join(lines)
+
+    async def _report_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            print(await self.report())
+
+    def start(self) -> None:
+        """
+        Starts tracemalloc if frames is set, and the periodic report if an
+        interval is set.
+        """
+        if self.frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        if self.interval and self._task is None:
+            self._task = asyncio.create_task(self._report_periodically())
+
+    def stop(self) -> None:
+        """Stops the periodic report and tracemalloc."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.frames and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def main():
+    """Compares two snapshots written by MemoryMonitor, see the module docstring."""
+    parser = argparse.ArgumentParser(description="Compares two memory snapshots.")
+    parser.add_argument("earlier", type=pathlib.Path)
+    parser.add_argument("later", type=pathlib.Path)
+    parser.add_argument("--count", type=int, default=25)
+    args = parser.parse_args()
+    earlier = tracemalloc.Snapshot.load(str(args.earlier))
+    later = tracemalloc.Snapshot.load(str(args.later))
+    for difference in top_differences(later, earlier, args.count):
+        print(describe(difference))
+
+
+if __name__ == "__main__":
+    main()
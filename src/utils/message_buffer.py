@@ -0,0 +1,119 @@
+"""
+A write-behind buffer for the message_log table.
+"""
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Set
+
+from src.utils.message_log import MessageLogRow, PartialInsertError
+from src.utils.message_writer import MessageLog
+
+
+@dataclass
+class BufferStats:
+    """
+    Counters describing how the buffer is flushing, used to tune the thresholds.
+    """
+
+    flushes: int = 0
+    rows_flushed: int = 0
+    total_flush_latency: float = 0.0
+    last_flush_latency: float = 0.0
+    max_flush_latency: float = 0.0
+
+    @property
+    def average_flush_latency(self) -> float:
+        """The average time a flush took, in seconds."""
+        return self.total_flush_latency / self.flushes if self.flushes else 0.0
+
+
+class MessageLogBuffer:  # pylint: disable=too-many-instance-attributes
+    """
+    Queues rows for message_log in memory and writes them with a single
+    executemany and commit, either once `flush_rows` rows are queued or
+    every `flush_interval` seconds, whichever comes first.
+    """
+
+    def __init__(
+        self, store: MessageLog, flush_rows: int = 500, flush_interval: float = 2
+    ):
+        self.store = store
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.stats = BufferStats()
+        self._rows: List[MessageLogRow] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        # keeps a reference to flushes started from add() so they aren't garbage collected.
+        self._pending: Set[asyncio.Task] = set()
+
+    @property
+    def depth(self) -> int:
+        """The amount of rows waiting to be written."""
+        return len(self._rows)
+
+    def add(self, row: MessageLogRow) -> None:
+        """
+        Queues a row, starting a flush in the background if the buffer is full.
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_rows and not self._lock.locked():
+            task = asyncio.create_task(self.flush())
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def flush(self) -> None:
+        """
+        Writes every queued row in one transaction. If the write fails the
+        rows are put back so the next flush can retry them, when only some
+        servers failed just their rows.
+        """
+        async with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return
+            start = time.perf_counter()
+            try:
+                await self.store.insert(rows)
+            except asyncio.CancelledError:
+                self._rows[:0] = rows
+                raise
+            except PartialInsertError as error:
+                self._rows[:0] = error.rows
+                print(f"Failed to flush message_log: {error}", file=sys.stderr)
+                return
+            except Exception as error:  # pylint: disable=W0703
+                self._rows[:0] = rows
+                print(f"Failed to flush message_log: {error}", file=sys.stderr)
+                return
+            latency = time.perf_counter() - start
+
+        self.stats.flushes += 1
+        self.stats.rows_flushed += len(rows)
+        self.stats.total_flush_latency += latency
+        self.stats.last_flush_latency = latency
+        self.stats.max_flush_latency = max(self.stats.max_flush_latency, latency)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        """
+        Starts the timer that flushes the buffer every flush_interval seconds.
+        """
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """
+        Stops the timer and writes whatever is left in the buffer.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # a flush that is already running holds the lock, so this waits for it.
+        await self.flush()
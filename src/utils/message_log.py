@@ -0,0 +1,529 @@
+"""
+The storage behind message_log. Messages are kept in one table per week, so
+old history can be removed by dropping whole tables instead of deleting rows.
+Alongside them message_counts keeps how many messages every user sent per
+channel and hour, for reports and long activity rules.
+"""
+import abc
+import asyncio
+import math
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+import aiosqlite
+
+from src.utils.activity_engine import ActivityRule
+from src.utils.database import ConnectionPool
+from src.utils.queries import (
+    PARTITION_COUNT_QUERY,
+    PARTITION_WINDOW_QUERY,
+    RULE_HOURS_QUERY,
+    SERVER_TOTALS_QUERY,
+    TOP_ACTIVE_CHANNEL_QUERY,
+    TOP_ACTIVE_QUERY,
+    USER_ACTIVITY_QUERY,
+)
+
+# (channel_id, user_id, time, server_id), the same order as the columns of message_log.
+MessageLogRow = Tuple[int, int, float, int]
+
+PARTITION_SPAN = 7 * 24 * 60 * 60
+COLUMNS = "channel_id, user_id, time, server_id"
+# how often expired partitions are dropped, in seconds.
+RETENTION_INTERVAL = 60 * 60
+# how many rows delete_servers removes per transaction.
+DELETE_BATCH = 5000
+
+HOUR = 60 * 60
+# how long message_counts is kept, at least as long as the messages themselves.
+COUNTS_RETENTION = 90 * 24 * 60 * 60
+# pruning message_counts reads the whole table, so it only happens once a day.
+COUNTS_PRUNE_INTERVAL = 24 * 60 * 60
+COUNTS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS message_counts ("
+    "    server_id INTEGER NOT NULL,"
+    "    user_id INTEGER NOT NULL,"
+    "    hour INTEGER NOT NULL,"
+    "    channel_id INTEGER NOT NULL,"
+    "    count INTEGER NOT NULL,"
+    "    PRIMARY KEY (server_id, user_id, hour, channel_id)"
+    ") WITHOUT ROWID;",
+    "CREATE INDEX IF NOT EXISTS message_counts_channel_hour "
+    "ON message_counts (server_id, channel_id, hour)",
+    "CREATE INDEX IF NOT EXISTS message_counts_hour "
+    "ON message_counts (server_id, hour)",
+)
+COUNTS_COLUMNS = "server_id, user_id, hour, channel_id, count"
+# (server_id, user_id, hour, channel_id, count), a row of message_counts.
+MessageCountRow = Tuple[int, int, int, int, int]
+
+
+def partition_name(timestamp: float) -> str:
+    """The name of the partition a message sent at timestamp belongs to."""
+    return f"message_log_w{int(timestamp // PARTITION_SPAN)}"
+
+
+def partition_bounds(name: str) -> Tuple[int, int]:
+    """The [start, end) time range a partition covers."""
+    number = int(name.rsplit("_w", 1)[1])
+    return number * PARTITION_SPAN, (number + 1) * PARTITION_SPAN
+
+
+def hourly_counts(rows: Iterable[MessageLogRow]) -> List[MessageCountRow]:
+    """How many of the rows were sent per server, user, hour and channel."""
+    counts: Dict[Tuple[int, int, int, int], int] = {}
+    for channel_id, user_id, sent_at, server_id in rows:
+        key = (server_id, user_id, int(sent_at // HOUR), channel_id)
+        counts[key] = counts.get(key, 0) + 1
+    return [(*key, count) for key, count in counts.items()]
+
+
+def rule_scope(rule: ActivityRule) -> Tuple[str, Tuple]:
+    """
+    The condition limiting a query to the rule's channels, or to its whole
+    server if it has none, and its parameters. See RULE_SCOPES.
+    """
+    if rule.channels:
+        return f"channel_id IN ({', '.join('?' * len(rule.channels))})", tuple(
+            rule.channels
+        )
+    return "server_id = ?", (rule.server_id,)
+
+
+class PartialInsertError(Exception):
+    """
+    Raised by an insert that wrote the rows of some servers but not of the
+    servers in server_ids. rows are the ones that weren't written, retrying
+    any others would count them twice.
+    """
+
+    def __init__(
+        self, server_ids: Iterable[int], rows: List[MessageLogRow], problem: str
+    ):
+        self.server_ids = frozenset(server_ids)
+        self.rows = rows
+        super().__init__(
+            f"{len(rows)} rows of servers {sorted(self.server_ids)} weren't "
+            f"written: {problem}"
+        )
+
+
+class ExpiringStore(abc.ABC):
+    """
+    Runs drop_expired every RETENTION_INTERVAL seconds between start and stop.
+    """
+
+    _retention_task: Optional[asyncio.Task] = None
+
+    @abc.abstractmethod
+    async def drop_expired(self, now: Optional[float] = None) -> List[str]:
+        """Drops the expired history, returns what was dropped."""
+
+    async def _drop_expired_periodically(self) -> None:
+        while True:
+            try:
+                dropped = await self.drop_expired()
+                if dropped:
+                    print(f"Dropped expired message_log partitions: {dropped}")
+            except Exception as error:  # pylint: disable=W0703
+                print(f"Failed to drop expired partitions: {error}", file=sys.stderr)
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def start(self) -> None:
+        """
+        Starts dropping expired partitions every RETENTION_INTERVAL seconds.
+        """
+        if self._retention_task is None:
+            self._retention_task = asyncio.create_task(
+                self._drop_expired_periodically()
+            )
+
+    def stop(self) -> None:
+        """
+        Stops dropping expired partitions.
+        """
+        if self._retention_task is not None:
+            self._retention_task.cancel()
+            self._retention_task = None
+
+
+class MessageLogStore(ExpiringStore):
+    """
+    Reads and writes message_log through its weekly partitions. The message_log
+    view over every partition is kept up to date for ad-hoc queries, but the cogs
+    should go through this class so only the partitions they need are read.
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        retention_margin: float = 0,
+        counts_retention: float = COUNTS_RETENTION,
+    ):
+        self.pool = pool
+        self.retention_margin = retention_margin
+        self.counts_retention = counts_retention
+        # partition name -> (start, end), loaded from message_log_partitions.
+        self.partitions: Dict[str, Tuple[int, int]] = {}
+        self.counts_pruned_at = float("-inf")
+
+    async def load(self) -> None:
+        """
+        Reads the list of partitions. Has to be called before anything else.
+        """
+        async with self.pool.connection() as database:
+            await self._reload(database)
+
+    async def refresh(self) -> None:
+        """
+        Rereads the list of partitions, which another process may have
+        changed. Only reads from the database.
+        """
+        await self.load()
+
+    async def ensure_counts(self) -> None:
+        """
+        Creates message_counts if the database doesn't have it yet, and fills
+        it from the partitions. The main database gets it from migration 9,
+        guild shards created before it get it here.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'message_counts'"
+            )
+            if await cur.fetchone():
+                return
+            try:
+                await database.execute("BEGIN")
+                for statement in COUNTS_SCHEMA:
+                    await database.execute(statement)
+                for name in self.partitions:
+                    # partitions are whole weeks, so no hour spans two of them.
+                    await database.execute(
+                        "INSERT INTO message_counts "
+                        "SELECT server_id, user_id, CAST(time / 3600 AS INTEGER), "
+                        f"channel_id, COUNT(*) FROM {name} GROUP BY 1, 2, 3, 4"
+                    )
+                await database.commit()
+            except BaseException:
+                await database.rollback()
+                raise
+
+    def overlapping(self, since: float, until: float) -> List[str]:
+        """
+        The partitions holding messages sent in [since, until), oldest first.
+        """
+        return sorted(
+            (
+                name
+                for name, (start, end) in self.partitions.items()
+                if start < until and end > since
+            ),
+            key=lambda name: self.partitions[name][0],
+        )
+
+    async def _rebuild_view(self, database: aiosqlite.Connection) -> None:
+        await database.execute("DROP VIEW IF EXISTS message_log")
+        if not self.partitions:
+            return
+        await database.execute(
+            "CREATE VIEW message_log AS "
+            + " UNION ALL ".join(
+                f"SELECT {COLUMNS} FROM {name}"
+                for name in self.overlapping(float("-inf"), float("inf"))
+            )
+        )
+
+    async def _create_partitions(
+        self, database: aiosqlite.Connection, names: Iterable[str]
+    ) -> None:
+        """
+        Creates the partitions that don't exist yet, inside the caller's transaction.
+        """
+        missing = [name for name in set(names) if name not in self.partitions]
+        if not missing:
+            return
+        for name in missing:
+            await database.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} ("
+                "    channel_id INTEGER NOT NULL,"
+                "    user_id INTEGER NOT NULL,"
+                "    time INTEGER NOT NULL,"
+                "    server_id INTEGER NOT NULL,"
+                "    FOREIGN KEY(server_id) REFERENCES servers(id)"
+                ");"
+            )
+            await database.execute(
+                f"CREATE INDEX IF NOT EXISTS {name}_channel_time_user "
+                f"ON {name} (channel_id, time, user_id)"
+            )
+            await database.execute(
+                f"CREATE INDEX IF NOT EXISTS {name}_server_time_user "
+                f"ON {name} (server_id, time, user_id)"
+            )
+            await database.execute(
+                "INSERT OR IGNORE INTO message_log_partitions VALUES (?, ?, ?)",
+                (name, *partition_bounds(name)),
+            )
+            self.partitions[name] = partition_bounds(name)
+        await self._rebuild_view(database)
+
+    async def insert(self, rows: List[MessageLogRow]) -> None:
+        """
+        Writes rows into their partitions, creating partitions as needed,
+        and adds them to message_counts, in a single transaction.
+        """
+        by_partition: Dict[str, List[MessageLogRow]] = {}
+        for row in rows:
+            by_partition.setdefault(partition_name(row[2]), []).append(row)
+
+        async with self.pool.connection() as database:
+            try:
+                await database.execute("BEGIN")
+                await self._create_partitions(database, by_partition)
+                for name, partition_rows in by_partition.items():
+                    await database.executemany(
+                        f"INSERT INTO {name} VALUES(?, ?, ?, ?)", partition_rows
+                    )
+                await database.executemany(
+                    "INSERT INTO message_counts VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (server_id, user_id, hour, channel_id) "
+                    "DO UPDATE SET count = count + excluded.count",
+                    hourly_counts(rows),
+                )
+                await database.commit()
+            except BaseException:
+                # forget about partitions whose creation was rolled back.
+                await database.rollback()
+                await self._reload(database)
+                raise
+
+    async def _reload(self, database: aiosqlite.Connection) -> None:
+        cur = await database.execute(
+            "SELECT name, start, end FROM message_log_partitions"
+        )
+        self.partitions = {
+            name: (start, end) for name, start, end in await cur.fetchall()
+        }
+
+    async def latest_per_user(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, float]]:
+        """
+        The last message_count messages every user sent in the rule's channels
+        (all channels of its server if it has none), in the time_period before until.
+        Returns (user_id, time) ordered by user and then time.
+
+        Each partition is range scanned on (channel_id, time) or (server_id, time),
+        so only the messages inside the window are read.
+        """
+        since = until - rule.time_period
+        names = self.overlapping(since, until)
+        if not names:
+            return []
+        where, where_params = rule_scope(rule)
+        parts, params = [], []
+        for name in names:
+            parts.append(PARTITION_WINDOW_QUERY.format(partition=name, where=where))
+            params.extend((*where_params, since, until))
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT user_id, time FROM ("
+                "    SELECT user_id, time, ROW_NUMBER() OVER ("
+                "        PARTITION BY user_id ORDER BY time DESC"
+                "    ) AS newest"
+                f"    FROM ({' UNION ALL '.join(parts)})"
+                ") WHERE newest <= ? ORDER BY user_id, time",
+                (*params, rule.message_count),
+            )
+            return list(await cur.fetchall())
+
+    async def user_activity(
+        self, server_id: int, user_id: int, since: float
+    ) -> List[Tuple[int, int]]:
+        """
+        How many messages the user sent in each channel of the server since
+        the start of the hour of since, as (channel_id, count), most first.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                USER_ACTIVITY_QUERY, (server_id, user_id, int(since // HOUR))
+            )
+            return list(await cur.fetchall())
+
+    async def top_active(
+        self,
+        server_id: int,
+        since: float,
+        channel_id: Optional[int] = None,
+        limit: int = 10,
+    ) -> List[Tuple[int, int]]:
+        """
+        The users who sent the most messages in the server, or one of its
+        channels, since the start of the hour of since, as (user_id, count).
+        """
+        async with self.pool.connection() as database:
+            if channel_id is None:
+                cur = await database.execute(
+                    TOP_ACTIVE_QUERY, (server_id, int(since // HOUR), limit)
+                )
+            else:
+                cur = await database.execute(
+                    TOP_ACTIVE_CHANNEL_QUERY,
+                    (server_id, channel_id, int(since // HOUR), limit),
+                )
+            return list(await cur.fetchall())
+
+    async def server_totals(
+        self, since: float, limit: int = 10
+    ) -> List[Tuple[int, int]]:
+        """
+        The servers whose members sent the most messages since the start of
+        the hour of since, as (server_id, count).
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                SERVER_TOTALS_QUERY, (int(since // HOUR), limit)
+            )
+            return list(await cur.fetchall())
+
+    async def rule_counts(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, int, int]]:
+        """
+        How many messages every user sent in the rule's channels per hour, for
+        the hours that lie completely in the time_period before until, as
+        (user_id, hour, count) ordered by user and hour. The hours before the
+        current one come from message_counts, the current hour is counted from
+        the partitions, since message_counts may already hold messages sent
+        after until.
+        """
+        first_hour = math.ceil((until - rule.time_period) / HOUR)
+        current_hour = int(until // HOUR)
+        where, where_params = rule_scope(rule)
+        counts: List[Tuple[int, int, int]] = []
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                RULE_HOURS_QUERY.format(where=where),
+                (rule.server_id, *where_params, first_hour, current_hour),
+            )
+            counts.extend(await cur.fetchall())
+            if current_hour >= first_hour:
+                for name in self.overlapping(current_hour * HOUR, until):
+                    cur = await database.execute(
+                        PARTITION_COUNT_QUERY.format(partition=name, where=where),
+                        (current_hour, *where_params, current_hour * HOUR, until),
+                    )
+                    counts.extend(await cur.fetchall())
+        counts.sort()
+        return counts
+
+    async def keep_since(self, now: float) -> float:
+        """
+        The oldest time that still has to be kept: the longest activity rule
+        window plus the retention margin before now.
+        """
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT MAX(time_period) FROM activity_tracking_settings"
+            )
+            (longest_window,) = await cur.fetchone() or (None,)
+        return now - (longest_window or 0) - self.retention_margin
+
+    async def drop_expired(self, now: Optional[float] = None) -> List[str]:
+        """
+        Drops every partition that only holds messages older than the longest
+        activity rule window plus the retention margin. The partition for the
+        current week is never dropped. Returns the dropped partitions.
+        """
+        now = time.time() if now is None else now
+        return await self.drop_before(await self.keep_since(now), now)
+
+    async def drop_before(self, keep_since: float, now: float) -> List[str]:
+        """
+        Drops every partition that ends before keep_since, except the one for
+        the current week, and the message_counts older than both keep_since
+        and the counts retention. Returns the dropped partitions.
+        """
+        await self.drop_expired_counts(min(keep_since, now - self.counts_retention))
+        expired = [
+            name
+            for name, (_, end) in self.partitions.items()
+            if end <= keep_since and name != partition_name(now)
+        ]
+        if not expired:
+            return []
+
+        async with self.pool.connection() as database:
+            try:
+                await database.execute("BEGIN")
+                await self._create_partitions(database, [partition_name(now)])
+                for name in expired:
+                    await database.execute(f"DROP TABLE IF EXISTS {name}")
+                    await database.execute(
+                        "DELETE FROM message_log_partitions WHERE name = ?", (name,)
+                    )
+                    del self.partitions[name]
+                await self._rebuild_view(database)
+                await database.commit()
+            except BaseException:
+                await database.rollback()
+                await self._reload(database)
+                raise
+        return expired
+
+    async def drop_expired_counts(self, keep_since: float) -> int:
+        """
+        Deletes the message_counts of the hours before keep_since, at most once
+        every COUNTS_PRUNE_INTERVAL. Returns how many rows were deleted.
+        """
+        now = time.monotonic()
+        if now - self.counts_pruned_at < COUNTS_PRUNE_INTERVAL:
+            return 0
+        self.counts_pruned_at = now
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "DELETE FROM message_counts WHERE hour < ?", (int(keep_since // HOUR),)
+            )
+            await database.commit()
+        return cur.rowcount
+
+    async def delete_servers(
+        self, server_ids: Iterable[int], batch_size: int = DELETE_BATCH
+    ) -> int:
+        """
+        Deletes every message of the given servers, batch_size rows per
+        transaction so the writes of the message buffer aren't held up for long.
+        Returns how many rows were deleted.
+        """
+        server_ids = list(server_ids)
+        if not server_ids:
+            return 0
+        placeholders = ", ".join("?" * len(server_ids))
+        deleted = 0
+        for name in self.overlapping(float("-inf"), float("inf")):
+            while True:
+                async with self.pool.connection() as database:
+                    cur = await database.execute(
+                        f"DELETE FROM {name} WHERE rowid IN ("
+                        f"    SELECT rowid FROM {name}"
+                        f"    WHERE server_id IN ({placeholders}) LIMIT ?"
+                        ")",
+                        (*server_ids, batch_size),
+                    )
+                    await database.commit()
+                deleted += cur.rowcount
+                if cur.rowcount < batch_size:
+                    break
+        async with self.pool.connection() as database:
+            await database.execute(
+                f"DELETE FROM message_counts WHERE server_id IN ({placeholders})",
+                server_ids,
+            )
+            await database.commit()
+        return deleted
+
+    async def close(self) -> None:
+        """
+        Nothing to close, the pool belongs to the bot.
+        """
@@ -0,0 +1,439 @@
+"""
+An optional layout for message_log that keeps every guild's history in a
+database file of its own, so one busy guild's writes and activity queries
+don't contend with everyone else's. The main database only keeps a catalog
+of which guild is in which file.
+"""
+import asyncio
+import contextlib
+import dataclasses
+import os
+import pathlib
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+import aiosqlite
+
+from src.utils.activity_engine import ActivityRule
+from src.utils.database import ConnectionPool, DatabaseSettings
+from src.utils.message_log import (
+    COLUMNS,
+    COUNTS_COLUMNS,
+    COUNTS_RETENTION,
+    HOUR,
+    ExpiringStore,
+    MessageLogRow,
+    MessageLogStore,
+    PartialInsertError,
+)
+from src.utils.metrics import Metrics
+from src.utils.queries import SERVER_TOTALS_QUERY
+
+# sqlite's default limit on the databases attached to one connection.
+MAX_ATTACHED = 10
+# how many rows are moved at a time when importing the main database's message_log.
+IMPORT_BATCH = 50000
+
+
+def shard_file(server_id: int) -> str:
+    """The name of the file holding a guild's message log."""
+    return f"guild_{server_id}.db"
+
+
+class ShardedMessageLogStore(
+    ExpiringStore
+):  # pylint: disable=too-many-instance-attributes
+    """
+    Has the same interface as MessageLogStore, but hands every guild's rows to
+    a MessageLogStore over that guild's own file. Shards are opened the first
+    time they're needed, and at most max_open of them are kept open, closing
+    the least recently used one that isn't in use. Queries across guilds
+    ATTACH the shard files to a single connection, see attached.
+
+    A read_only store never writes: it doesn't import the main database,
+    create shards or add them to the catalog. It's used by the workers of
+    run_sharded, which leave every write to the writer process, see refresh.
+    """
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        directory: pathlib.Path,
+        settings: Optional[DatabaseSettings] = None,
+        metrics: Optional[Metrics] = None,
+        retention_margin: float = 0,
+        max_open: int = 32,
+        counts_retention: float = COUNTS_RETENTION,
+        read_only: bool = False,
+    ):
+        self.pool = pool
+        self.directory = directory
+        # a shard is only ever used by a few tasks at once, and sqlite
+        # checkpoints its write-ahead log on its own.
+        self.settings = dataclasses.replace(
+            settings or DatabaseSettings(), pool_size=1, checkpoint_interval=0
+        )
+        self.metrics = metrics
+        self.retention_margin = retention_margin
+        self.counts_retention = counts_retention
+        self.max_open = max(1, max_open)
+        # the message log in the main database, only read to import it.
+        self.main = MessageLogStore(pool, retention_margin, counts_retention)
+        # server id -> file name, loaded from message_log_shards.
+        self.catalog: Dict[int, str] = {}
+        # the open shards, least recently used first.
+        self.open: "OrderedDict[int, MessageLogStore]" = OrderedDict()
+        # how many tasks are using each open shard right now.
+        self.users: Dict[int, int] = {}
+        self.read_only = read_only
+        # (device, inode) of the file of every open shard, to notice when
+        # another process deleted or replaced it.
+        self.files: Dict[int, Tuple[int, int]] = {}
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        """
+        Reads the catalog, and unless read_only moves any history still in the
+        main database into the shards. Has to be called before anything else.
+        """
+        if self.read_only:
+            await self.refresh()
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.catalog = await self._read_catalog()
+        await self.main.load()
+        await self._import_main()
+
+    async def _read_catalog(self) -> Dict[int, str]:
+        async with self.pool.connection() as database:
+            cur = await database.execute(
+                "SELECT server_id, file FROM message_log_shards"
+            )
+            return dict(await cur.fetchall())
+
+    def _file_of(self, server_id: int) -> Optional[Tuple[int, int]]:
+        file = self.catalog.get(server_id)
+        if file is None:
+            return None
+        try:
+            stat = os.stat(self.directory / file)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    async def refresh(self) -> None:
+        """
+        Rereads the catalog and the partitions of the open shards, which
+        another process may have changed. Open shards whose file was deleted
+        or replaced since are closed, unless they're in use right now, then
+        the next refresh closes them. Only reads from the databases.
+        """
+        catalog = await self._read_catalog()
+        async with self._lock:
+            self.catalog = catalog
+            for server_id, store in list(self.open.items()):
+                if self.users.get(server_id):
+                    continue
+                if self._file_of(server_id) != self.files.get(server_id):
+                    del self.open[server_id]
+                    self.files.pop(server_id, None)
+                    await store.pool.close()
+                else:
+                    await store.load()
+
+    async def _import_main(self) -> None:
+        """
+        Copies the rows of the main database's partitions into the shards, one
+        guild at a time, deleting them from the main database once copied, and
+        drops the emptied partitions. Only does anything the first time the bot
+        runs with sharding turned on.
+        """
+        names = self.main.overlapping(float("-inf"), float("inf"))
+        if not names:
+            return
+        for name in names:
+            async with self.pool.connection() as database:
+                cur = await database.execute(f"SELECT DISTINCT server_id FROM {name}")
+                server_ids = [server_id for (server_id,) in await cur.fetchall()]
+            for server_id in server_ids:
+                print(f"Moving {name} of {server_id} into its shard")
+                async with self.shard(server_id) as store:
+                    async with self.pool.connection() as database:
+                        cur = await database.execute(
+                            f"SELECT {COLUMNS} FROM {name} WHERE server_id = ?",
+                            (server_id,),
+                        )
+                        while rows := await cur.fetchmany(IMPORT_BATCH):
+                            await store.insert(rows)
+                        # a crash right before this commit copies this guild's
+                        # rows of the partition again on the next start.
+                        await database.execute(
+                            f"DELETE FROM {name} WHERE server_id = ?", (server_id,)
+                        )
+                        # the shard counts the copied rows itself.
+                        await database.execute(
+                            "DELETE FROM message_counts WHERE server_id = ?",
+                            (server_id,),
+                        )
+                        await database.commit()
+        await self.main.drop_before(float("inf"), time.time())
+
+    async def _open_shard(self, server_id: int) -> MessageLogStore:
+        file = self.catalog.get(server_id)
+        if file is None and self.read_only:
+            raise RuntimeError(f"Guild {server_id} has no shard to read.")
+        file = file or shard_file(server_id)
+        pool = ConnectionPool(self.directory / file, self.settings, self.metrics)
+        await pool.open()
+        store = MessageLogStore(pool, self.retention_margin, self.counts_retention)
+        if self.read_only:
+            await store.load()
+            return store
+        async with pool.connection() as database:
+            await database.execute(
+                "CREATE TABLE IF NOT EXISTS message_log_partitions ("
+                "    name TEXT PRIMARY KEY NOT NULL,"
+                "    start INTEGER NOT NULL,"
+                "    end INTEGER NOT NULL"
+                ");"
+            )
+            await database.commit()
+        await store.load()
+        await store.ensure_counts()
+        if server_id not in self.catalog:
+            async with self.pool.connection() as database:
+                await database.execute(
+                    "INSERT OR IGNORE INTO message_log_shards VALUES (?, ?)",
+                    (server_id, file),
+                )
+                await database.commit()
+            self.catalog[server_id] = file
+        return store
+
+    async def _close_unused(self) -> None:
+        """Closes the least recently used shards until at most max_open are open."""
+        for server_id in list(self.open):
+            if len(self.open) <= self.max_open:
+                return
+            if self.users.get(server_id):
+                continue
+            self.files.pop(server_id, None)
+            await self.open.pop(server_id).pool.close()
+
+    @contextlib.asynccontextmanager
+    async def shard(self, server_id: int) -> AsyncIterator[MessageLogStore]:
+        """
+        The store of a guild's shard, opening and creating it if needed.
+        It isn't closed while the block runs.
+        """
+        async with self._lock:
+            store = self.open.get(server_id)
+            if store is None:
+                store = self.open[server_id] = await self._open_shard(server_id)
+                self.files[server_id] = self._file_of(server_id)
+            self.open.move_to_end(server_id)
+            self.users[server_id] = self.users.get(server_id, 0) + 1
+            await self._close_unused()
+        try:
+            yield store
+        finally:
+            self.users[server_id] -= 1
+            if not self.users[server_id]:
+                del self.users[server_id]
+
+    @contextlib.asynccontextmanager
+    async def attached(
+        self, server_ids: Iterable[int]
+    ) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        A connection with the shards of up to MAX_ATTACHED guilds attached read
+        only, and temporary message_log and message_counts views over all of
+        them, for queries across guilds. Guilds without a shard are left out.
+        """
+        server_ids = [
+            server_id for server_id in server_ids if server_id in self.catalog
+        ]
+        if len(server_ids) > MAX_ATTACHED:
+            raise ValueError(f"Can't attach more than {MAX_ATTACHED} shards at once.")
+        async with aiosqlite.connect("file::memory:", uri=True) as database:
+            messages, counts = [], []
+            for server_id in server_ids:
+                schema = f"guild_{server_id}"
+                # read only, so a shard deleted in the meantime isn't recreated empty.
+                path = (self.directory / self.catalog[server_id]).resolve()
+                await database.execute(
+                    f"ATTACH DATABASE ? AS {schema}", (f"{path.as_uri()}?mode=ro",)
+                )
+                cur = await database.execute(
+                    f"SELECT name FROM {schema}.message_log_partitions"
+                )
+                messages.extend(
+                    f"SELECT {COLUMNS} FROM {schema}.{name}"
+                    for (name,) in await cur.fetchall()
+                )
+                cur = await database.execute(
+                    f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'message_counts'"
+                )
+                if await cur.fetchone():
+                    counts.append(
+                        f"SELECT {COUNTS_COLUMNS} FROM {schema}.message_counts"
+                    )
+            for view, columns, parts in (
+                ("message_log", COLUMNS, messages),
+                ("message_counts", COUNTS_COLUMNS, counts),
+            ):
+                if not parts:
+                    # an empty view with the same columns.
+                    names = ", ".join(f"0 AS {name}" for name in columns.split(", "))
+                    parts = [f"SELECT {names} LIMIT 0"]
+                await database.execute(
+                    f"CREATE TEMP VIEW {view} AS {' UNION ALL '.join(parts)}"
+                )
+            yield database
+
+    async def insert(self, rows: List[MessageLogRow]) -> None:
+        """
+        Writes rows into the shards of their guilds, the guilds are written
+        concurrently since they don't share a file. Every guild is committed
+        or rolled back on its own, if some fail PartialInsertError says which.
+        """
+        by_server: Dict[int, List[MessageLogRow]] = {}
+        for row in rows:
+            by_server.setdefault(row[3], []).append(row)
+
+        async def insert_shard(server_id: int, shard_rows: List[MessageLogRow]):
+            async with self.shard(server_id) as store:
+                await store.insert(shard_rows)
+
+        # every guild has to be done before anything is retried.
+        results = await asyncio.gather(
+            *(insert_shard(server_id, rows) for server_id, rows in by_server.items()),
+            return_exceptions=True,
+        )
+        failed = {
+            server_id: result
+            for server_id, result in zip(by_server, results)
+            if isinstance(result, BaseException)
+        }
+        if not failed:
+            return
+        for result in failed.values():
+            if not isinstance(result, Exception):
+                raise result
+        if len(failed) == len(by_server):
+            raise next(iter(failed.values()))
+        raise PartialInsertError(
+            failed,
+            [row for server_id in failed for row in by_server[server_id]],
+            "; ".join(f"{server_id}: {error!r}" for server_id, error in failed.items()),
+        )
+
+    async def latest_per_user(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, float]]:
+        """
+        See MessageLogStore.latest_per_user, only the rule's guild's shard is read.
+        """
+        if rule.server_id not in self.catalog:
+            return []
+        async with self.shard(rule.server_id) as store:
+            return await store.latest_per_user(rule, until)
+
+    async def user_activity(
+        self, server_id: int, user_id: int, since: float
+    ) -> List[Tuple[int, int]]:
+        """See MessageLogStore.user_activity, only the guild's shard is read."""
+        if server_id not in self.catalog:
+            return []
+        async with self.shard(server_id) as store:
+            return await store.user_activity(server_id, user_id, since)
+
+    async def top_active(
+        self,
+        server_id: int,
+        since: float,
+        channel_id: Optional[int] = None,
+        limit: int = 10,
+    ) -> List[Tuple[int, int]]:
+        """See MessageLogStore.top_active, only the guild's shard is read."""
+        if server_id not in self.catalog:
+            return []
+        async with self.shard(server_id) as store:
+            return await store.top_active(server_id, since, channel_id, limit)
+
+    async def server_totals(
+        self, since: float, limit: int = 10
+    ) -> List[Tuple[int, int]]:
+        """
+        See MessageLogStore.server_totals, the shards are attached
+        MAX_ATTACHED at a time.
+        """
+        totals: List[Tuple[int, int]] = []
+        server_ids = list(self.catalog)
+        for start in range(0, len(server_ids), MAX_ATTACHED):
+            async with self.attached(server_ids[start : start + MAX_ATTACHED]) as db:
+                cur = await db.execute(SERVER_TOTALS_QUERY, (int(since // HOUR), limit))
+                totals.extend(await cur.fetchall())
+        totals.sort(key=lambda total: total[1], reverse=True)
+        return totals[:limit]
+
+    async def rule_counts(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, int, int]]:
+        """See MessageLogStore.rule_counts, only the rule's guild's shard is read."""
+        if rule.server_id not in self.catalog:
+            return []
+        async with self.shard(rule.server_id) as store:
+            return await store.rule_counts(rule, until)
+
+    async def delete_servers(self, server_ids: Iterable[int], _: int = 0) -> int:
+        """
+        Deletes the shard files of the given guilds. Returns how many were deleted.
+        """
+        deleted = 0
+        for server_id in server_ids:
+            async with self._lock:
+                file = self.catalog.pop(server_id, None)
+                store = self.open.pop(server_id, None)
+                self.files.pop(server_id, None)
+                if store is not None:
+                    await store.pool.close()
+            if file is None:
+                continue
+            async with self.pool.connection() as database:
+                await database.execute(
+                    "DELETE FROM message_log_shards WHERE server_id = ?", (server_id,)
+                )
+                await database.commit()
+            for suffix in ("", "-wal", "-shm"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.directory / f"{file}{suffix}")
+            deleted += 1
+        return deleted
+
+    async def drop_expired(self, now: Optional[float] = None) -> List[str]:
+        """
+        Drops the expired partitions of every shard, see
+        MessageLogStore.drop_expired. Returns them as guild/partition.
+        """
+        now = time.time() if now is None else now
+        keep_since = await self.main.keep_since(now)
+        dropped = []
+        for server_id in list(self.catalog):
+            async with self.shard(server_id) as store:
+                dropped.extend(
+                    f"{server_id}/{name}"
+                    for name in await store.drop_before(keep_since, now)
+                )
+        return dropped
+
+    async def close(self) -> None:
+        """
+        Closes every open shard.
+        """
+        async with self._lock:
+            self.files.clear()
+            while self.open:
+                _, store = self.open.popitem()
+                await store.pool.close()
@@ -0,0 +1,364 @@
+"""
+The single writer of message_log when the bot runs as several processes.
+Workers send their rows to the writer process over a multiprocessing queue
+instead of writing to sqlite themselves, so they never wait on each other's
+write locks. Reads still go straight to the database.
+"""
+import asyncio
+import dataclasses
+import itertools
+import multiprocessing
+import pathlib
+import queue
+import signal
+import sys
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import pytimeparse
+
+from src.utils.activity_engine import ActivityRule
+from src.utils.database import ConnectionPool, DatabaseSettings
+from src.utils.message_log import (
+    COUNTS_RETENTION,
+    MessageLogRow,
+    MessageLogStore,
+    PartialInsertError,
+)
+from src.utils.message_shards import ShardedMessageLogStore
+from src.utils.metrics import Metrics
+
+# the store methods workers may call in the writer.
+WRITER_METHODS = ("insert", "delete_servers")
+# how long a worker waits for the writer to answer before it warns, in seconds.
+WRITER_WARN_AFTER = 60
+# how many queued inserts the writer commits together at most.
+MAX_COALESCED = 64
+
+# (worker, request id, method, args), None stops the writer.
+Request = Optional[Tuple[int, int, str, Tuple]]
+# (request id, result, error), None stops the worker's reply thread. When an
+# insert failed for some servers only, result holds the rows that weren't written.
+Reply = Optional[Tuple[int, Any, Optional[str]]]
+
+
+def message_log_from_config(
+    config: Dict[str, str],
+    pool: ConnectionPool,
+    metrics: Optional[Metrics] = None,
+    read_only: bool = False,
+) -> Union[MessageLogStore, ShardedMessageLogStore]:
+    """
+    The message log store the config asks for, sharded by guild if
+    ShardDirectory is set. A read_only store leaves every write to the
+    writer process, see RemoteMessageLog.
+    """
+    retention_margin = pytimeparse.parse(config.get("retentionmargin", "1 week")) or 0
+    counts_retention = (
+        pytimeparse.parse(config.get("countsretention", "90 days")) or COUNTS_RETENTION
+    )
+    if config.get("sharddirectory"):
+        return ShardedMessageLogStore(
+            pool,
+            pathlib.Path(config["sharddirectory"]),
+            DatabaseSettings.from_config(config),
+            metrics,
+            retention_margin=retention_margin,
+            max_open=int(config.get("shardmaxopen", 32)),
+            counts_retention=counts_retention,
+            read_only=read_only,
+        )
+    return MessageLogStore(
+        pool, retention_margin=retention_margin, counts_retention=counts_retention
+    )
+
+
+@dataclasses.dataclass
+class WriterConnection:
+    """
+    A worker's end of the writer: the queue every worker sends requests on,
+    and the worker's own queue for the answers.
+    """
+
+    worker: int
+    requests: multiprocessing.Queue
+    replies: multiprocessing.Queue
+
+
+class RemoteMessageLog:
+    """
+    Has the same interface as MessageLogStore. Writes are sent to the writer
+    process, reads are answered from a local store over the same database,
+    which reloads its partitions first since the writer creates and drops them.
+    """
+
+    def __init__(
+        self,
+        local: Union[MessageLogStore, ShardedMessageLogStore],
+        connection: WriterConnection,
+    ):
+        self.local = local
+        self.connection = connection
+        self._ids = itertools.count()
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def _receive(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Runs in a thread, hands the writer's answers to the waiting calls."""
+        while True:
+            reply: Reply = self.connection.replies.get()
+            if reply is None:
+                return
+            loop.call_soon_threadsafe(self._resolve, *reply)
+
+    def _resolve(self, request_id: int, result: Any, error: Optional[str]) -> None:
+        future = self._waiting.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        elif result is not None:
+            future.set_exception(
+                PartialInsertError({row[3] for row in result}, result, error)
+            )
+        else:
+            future.set_exception(RuntimeError(f"message writer: {error}"))
+
+    async def _call(self, method: str, *args: Any) -> Any:
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        self.connection.requests.put((self.connection.worker, request_id, method, args))
+        try:
+            while True:
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(future), WRITER_WARN_AFTER
+                    )
+                except asyncio.TimeoutError:
+                    # giving up would have the buffer retry rows the writer may
+                    # still commit. If the writer died run_sharded stops the workers.
+                    print(
+                        f"Still waiting for the message writer to answer {method}",
+                        file=sys.stderr,
+                    )
+        finally:
+            self._waiting.pop(request_id, None)
+
+    async def load(self) -> None:
+        """
+        Reads the local store and starts listening for the writer's answers.
+        The local store is only ever read, the writer creates and fills it.
+        """
+        await self.local.refresh()
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._receive,
+                args=(asyncio.get_running_loop(),),
+                name=f"message-writer-replies-{self.connection.worker}",
+                daemon=True,
+            )
+            self._thread.start()
+
+    async def insert(self, rows: List[MessageLogRow]) -> None:
+        """Has the writer write the rows, returns once they're committed."""
+        await self._call("insert", rows)
+
+    async def delete_servers(self, server_ids: Iterable[int], _: int = 0) -> int:
+        """Has the writer delete the history of the given servers."""
+        return await self._call("delete_servers", list(server_ids))
+
+    async def latest_per_user(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, float]]:
+        """See MessageLogStore.latest_per_user."""
+        await self.local.refresh()
+        return await self.local.latest_per_user(rule, until)
+
+    async def user_activity(
+        self, server_id: int, user_id: int, since: float
+    ) -> List[Tuple[int, int]]:
+        """See MessageLogStore.user_activity."""
+        await self.local.refresh()
+        return await self.local.user_activity(server_id, user_id, since)
+
+    async def top_active(
+        self,
+        server_id: int,
+        since: float,
+        channel_id: Optional[int] = None,
+        limit: int = 10,
+    ) -> List[Tuple[int, int]]:
+        """See MessageLogStore.top_active."""
+        await self.local.refresh()
+        return await self.local.top_active(server_id, since, channel_id, limit)
+
+    async def server_totals(
+        self, since: float, limit: int = 10
+    ) -> List[Tuple[int, int]]:
+        """See MessageLogStore.server_totals."""
+        await self.local.refresh()
+        return await self.local.server_totals(since, limit)
+
+    async def rule_counts(
+        self, rule: ActivityRule, until: float
+    ) -> List[Tuple[int, int, int]]:
+        """See MessageLogStore.rule_counts."""
+        await self.local.refresh()
+        return await self.local.rule_counts(rule, until)
+
+    def start(self) -> None:
+        """Expired history is dropped by the writer."""
+
+    def stop(self) -> None:
+        """See start."""
+
+    async def close(self) -> None:
+        """
+        Stops listening for answers, and closes the local store.
+        """
+        if self._thread is not None:
+            self.connection.replies.put(None)
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        await self.local.close()
+
+
+# any of the layouts of message_log, they're used the same way.
+MessageLog = Union[MessageLogStore, ShardedMessageLogStore, RemoteMessageLog]
+
+
+class MessageWriter:  # pylint: disable=too-few-public-methods
+    """
+    The writer process's side: takes requests off the queue and runs them on
+    the store. Inserts that queued up while the previous request ran are
+    committed together.
+    """
+
+    def __init__(
+        self,
+        store: Union[MessageLogStore, ShardedMessageLogStore],
+        requests: multiprocessing.Queue,
+        replies: List[multiprocessing.Queue],
+    ):
+        self.store = store
+        self.requests = requests
+        self.replies = replies
+        self.rows_written = 0
+
+    def _next_batch(self, first: Request) -> Tuple[List[Request], bool]:
+        """
+        first and the inserts queued right behind it, and whether a stop
+        request was among them.
+        """
+        batch = [first]
+        while first is not None and first[2] == "insert" and len(batch) < MAX_COALESCED:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            if request is None or request[2] != "insert":
+                break
+        stop = batch[-1] is None
+        return [request for request in batch if request is not None], stop
+
+    async def run(self) -> None:
+        """Serves requests until a None request arrives."""
+        while True:
+            first = await asyncio.to_thread(self.requests.get)
+            batch, stop = self._next_batch(first)
+            inserts = [request for request in batch if request[2] == "insert"]
+            if inserts:
+                await self._insert(inserts)
+            for request in batch:
+                if request[2] == "insert":
+                    continue
+                if request[2] not in WRITER_METHODS:
+                    self._reply([request], None, f"unknown method {request[2]}")
+                    continue
+                await self._answer(
+                    [request], getattr(self.store, request[2])(*request[3])
+                )
+            if stop:
+                return
+
+    async def _insert(self, inserts: List[Request]) -> None:
+        """
+        Writes the rows of every insert request at once, and tells each worker
+        whether its own rows were written.
+        """
+        rows = [row for request in inserts for row in request[3][0]]
+        try:
+            await self.store.insert(rows)
+        except PartialInsertError as error:
+            print(f"Message writer failed: {error}", file=sys.stderr)
+            for request in inserts:
+                failed = [row for row in request[3][0] if row[3] in error.server_ids]
+                self._reply([request], failed or None, str(error) if failed else None)
+            self.rows_written += len(rows) - len(error.rows)
+            return
+        except Exception as error:  # pylint: disable=W0703
+            print(f"Message writer failed: {error}", file=sys.stderr)
+            self._reply(inserts, None, repr(error))
+            return
+        self._reply(inserts, None, None)
+        self.rows_written += len(rows)
+
+    async def _answer(self, requests: List[Request], call) -> None:
+        try:
+            result = await call
+        except Exception as error:  # pylint: disable=W0703
+            print(f"Message writer failed: {error}", file=sys.stderr)
+            self._reply(requests, None, repr(error))
+            return
+        self._reply(requests, result, None)
+
+    def _reply(
+        self, requests: List[Request], result: Any, error: Optional[str]
+    ) -> None:
+        for request in requests:
+            assert request is not None
+            worker, request_id, _, _ = request
+            self.replies[worker].put((request_id, result, error))
+
+
+async def _serve(
+    db_path: pathlib.Path,
+    config: Dict[str, str],
+    requests: multiprocessing.Queue,
+    replies: List[multiprocessing.Queue],
+    ready,
+) -> None:
+    pool = ConnectionPool(db_path, DatabaseSettings.from_config(config))
+    await pool.open()
+    store = message_log_from_config(config, pool)
+    try:
+        await store.load()
+        store.start()
+        ready.set()
+        writer = MessageWriter(store, requests, replies)
+        await writer.run()
+        print(f"Message writer - {writer.rows_written} rows written")
+    finally:
+        store.stop()
+        await store.close()
+        await pool.close()
+
+
+def serve(
+    db_path: pathlib.Path,
+    config: Dict[str, str],
+    requests: multiprocessing.Queue,
+    replies: List[multiprocessing.Queue],
+    ready,
+) -> None:
+    """
+    The writer process's entry point. Sets ready once the store is loaded,
+    and runs until None is put on requests.
+    """
+    # Ctrl-C reaches every process of the group. The workers still write
+    # their buffered messages through the writer while they close, so it
+    # only stops once run_sharded sends None after joining them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(db_path, config, requests, replies, ready))
@@ -0,0 +1,147 @@
+"""
+Latency metrics for listeners, commands and database calls, kept as rolling
+histograms and exported in the prometheus text format.
+"""
+import asyncio
+import contextlib
+import os
+import pathlib
+import statistics
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+# how many of the most recent samples the percentiles are computed from.
+WINDOW = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+# what each kind of metric measures, used as the prometheus help text.
+KINDS = {
+    "listener": "Time spent in cog listeners.",
+    "command": "Time spent running commands.",
+    "db": "Time spent in database calls, including waiting for a pooled connection.",
+}
+
+
+class RollingHistogram:
+    """
+    Keeps the most recent samples for percentiles, and a running count and sum
+    over everything ever observed.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Adds a sample."""
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, fraction: float) -> float:
+        """The given quantile of the recent samples, 0 if there are none."""
+        if not self.samples:
+            return 0.0
+        if len(self.samples) == 1:
+            return self.samples[0]
+        cuts = statistics.quantiles(self.samples, n=100, method="inclusive")
+        return cuts[min(98, max(0, round(fraction * 100) - 1))]
+
+
+class Metrics:
+    """
+    A registry of histograms keyed by (kind, name), for e.g.
+    ("listener", "Logging.log_message") or ("db", "execute SELECT").
+    """
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], RollingHistogram] = {}
+        self._export_task: Optional[asyncio.Task] = None
+
+    def observe(self, kind: str, name: str, seconds: float) -> None:
+        """Records a sample for the given metric."""
+        histogram = self.histograms.get((kind, name))
+        if histogram is None:
+            histogram = self.histograms[(kind, name)] = RollingHistogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, kind: str, name: str) -> Iterator[None]:
+        """Records how long the body took."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time.perf_counter() - start)
+
+    def top(
+        self, count: int, kind: Optional[str] = None
+    ) -> List[Tuple[Tuple[str, str], RollingHistogram]]:
+        """
+        The metrics with the highest total time, optionally only of one kind.
+        """
+        return sorted(
+            (
+                (key, histogram)
+                for key, histogram in self.histograms.items()
+                if kind is None or key[0] == kind
+            ),
+            key=lambda item: item[1].total,
+            reverse=True,
+        )[:count]
+
+    def prometheus(self) -> str:
+        """
+        Every metric in the prometheus text format, as one summary per kind.
+        """
+        lines = []
+        for kind, help_text in KINDS.items():
+            metric = f"pcparadise_{kind}_seconds"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} summary")
+            for (histogram_kind, name), histogram in sorted(self.histograms.items()):
+                if histogram_kind != kind:
+                    continue
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                for fraction in QUANTILES:
+                    lines.append(
+                        f'{metric}{{name="{label}",quantile="{fraction}"}} '
+                        f"{histogram.quantile(fraction):.9f}"
+                    )
+                lines.append(f'{metric}_sum{{name="{label}"}} {histogram.total:.9f}')
+                lines.append(f'{metric}_count{{name="{label}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path: pathlib.Path) -> None:
+        """
+        Writes the prometheus snapshot to path. The file is replaced atomically
+        so a scraper never reads a half written file.
+        """
+        temporary = path.with_name(path.name + ".tmp")
+        temporary.write_text(self.prometheus(), encoding="utf-8")
+        os.replace(temporary, path)
+
+    async def _export_periodically(self, path: pathlib.Path, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_snapshot(path)
+            except OSError as error:
+                print(f"Failed to write metrics to {path}: {error}", file=sys.stderr)
+
+    def start_exporting(self, path: pathlib.Path, interval: float) -> None:
+        """
+        Starts writing a prometheus snapshot to path every interval seconds.
+        """
+        if self._export_task is None:
+            self._export_task = asyncio.create_task(
+                self._export_periodically(path, interval)
+            )
+
+    def stop_exporting(self) -> None:
+        """Stops writing snapshots."""
+        if self._export_task is not None:
+            self._export_task.cancel()
+            self._export_task = None
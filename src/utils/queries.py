@@ -0,0 +1,168 @@
+"""
+SQL for the queries that run on hot paths, along with a check that
+sqlite's query planner actually uses an index for them.
+"""
+from typing import Dict, List, NamedTuple, Tuple
+import aiosqlite
+
+# The welcome settings of a server.
+WELCOME_SETTINGS_QUERY = (
+    "SELECT detection_word, role_id, welcome_channel_id "
+    "FROM welcome_config_settings "
+    "WHERE server_id = ?"
+)
+
+# How many messages a user sent in each channel of a server since an hour.
+USER_ACTIVITY_QUERY = (
+    "SELECT channel_id, SUM(count) FROM message_counts "
+    "WHERE server_id = ? AND user_id = ? AND hour >= ? "
+    "GROUP BY channel_id ORDER BY 2 DESC"
+)
+
+# The users of a server who sent the most messages since an hour.
+TOP_ACTIVE_QUERY = (
+    "SELECT user_id, SUM(count) FROM message_counts "
+    "WHERE server_id = ? AND hour >= ? "
+    "GROUP BY user_id ORDER BY 2 DESC LIMIT ?"
+)
+
+# The same for a single channel.
+TOP_ACTIVE_CHANNEL_QUERY = (
+    "SELECT user_id, SUM(count) FROM message_counts "
+    "WHERE server_id = ? AND channel_id = ? AND hour >= ? "
+    "GROUP BY user_id ORDER BY 2 DESC LIMIT ?"
+)
+
+# The servers whose members sent the most messages since an hour, across every
+# server, only run by the bot's owner so it may scan.
+SERVER_TOTALS_QUERY = (
+    "SELECT server_id, SUM(count) FROM message_counts "
+    "WHERE hour >= ? GROUP BY server_id ORDER BY 2 DESC LIMIT ?"
+)
+
+# The rest are templates, {where} limits them to a rule's channels or to its
+# whole server, see RULE_SCOPES, and {partition} is a message_log partition.
+
+# How many messages every user sent per hour in a rule's channels.
+RULE_HOURS_QUERY = (
+    "SELECT user_id, hour, SUM(count) FROM message_counts "
+    "WHERE server_id = ? AND {where} AND hour >= ? AND hour < ? "
+    "GROUP BY user_id, hour"
+)
+
+# The messages sent in a rule's channels in a window, from one partition.
+PARTITION_WINDOW_QUERY = (
+    "SELECT user_id, time FROM {partition} " "WHERE {where} AND time >= ? AND time < ?"
+)
+
+# How many messages every user sent in a rule's channels in a window, from one
+# partition. The first parameter is the hour the counts are reported for.
+PARTITION_COUNT_QUERY = (
+    "SELECT user_id, ?, COUNT(*) FROM {partition} "
+    "WHERE {where} AND time >= ? AND time < ? GROUP BY user_id"
+)
+
+# {where} for a rule with two channels and for one counting the whole server,
+# with dummy parameters.
+RULE_SCOPES = {
+    "channels": ("channel_id IN (?, ?)", (0, 0)),
+    "server": ("server_id = ?", (0,)),
+}
+
+
+class HotQuery(NamedTuple):
+    """
+    A query that should never scan the given tables without an index.
+    """
+
+    sql: str
+    params: Tuple
+    indexed_tables: Tuple[str, ...]
+
+
+HOT_QUERIES: Dict[str, HotQuery] = {
+    "welcome settings": HotQuery(
+        WELCOME_SETTINGS_QUERY, (0,), ("welcome_config_settings",)
+    ),
+    "user activity": HotQuery(USER_ACTIVITY_QUERY, (0, 0, 0), ("message_counts",)),
+    "top active": HotQuery(TOP_ACTIVE_QUERY, (0, 0, 10), ("message_counts",)),
+    "top active in a channel": HotQuery(
+        TOP_ACTIVE_CHANNEL_QUERY, (0, 0, 0, 10), ("message_counts",)
+    ),
+    **{
+        f"rule hours by {scope}": HotQuery(
+            RULE_HOURS_QUERY.format(where=where),
+            (0, *params, 0, 0),
+            ("message_counts",),
+        )
+        for scope, (where, params) in RULE_SCOPES.items()
+    },
+}
+
+# checked against the newest partition, {partition} is filled in by unindexed_scans.
+PARTITION_QUERIES: Dict[str, HotQuery] = {
+    **{
+        f"rule window by {scope}": HotQuery(
+            PARTITION_WINDOW_QUERY.format(partition="{partition}", where=where),
+            (*params, 0, 0),
+            ("{partition}",),
+        )
+        for scope, (where, params) in RULE_SCOPES.items()
+    },
+    **{
+        f"current hour by {scope}": HotQuery(
+            PARTITION_COUNT_QUERY.format(partition="{partition}", where=where),
+            (0, *params, 0, 0),
+            ("{partition}",),
+        )
+        for scope, (where, params) in RULE_SCOPES.items()
+    },
+}
+
+
+def _table_name(sql: str, alias: str) -> str:
+    """
+    Maps an alias used in a query plan back to the table name, when the alias
+    was declared as `table alias` in the query.
+    """
+    words = sql.replace(",", " ").split()
+    for index, word in enumerate(words[1:], start=1):
+        # right after FROM or JOIN it's the table itself.
+        if word == alias and words[index - 1].upper() not in ("FROM", "JOIN"):
+            return words[index - 1]
+    return alias
+
+
+async def unindexed_scans(database: aiosqlite.Connection) -> List[str]:
+    """
+    Runs EXPLAIN QUERY PLAN on every hot query, and on the partition queries
+    against the newest message_log partition if there is one, and returns a
+    description of each step that reads one of the query's indexed_tables
+    without using an index. Automatic indexes don't count, sqlite rebuilds
+    those on every run. An empty list means every hot query is indexed.
+    """
+    queries = dict(HOT_QUERIES)
+    cur = await database.execute(
+        "SELECT name FROM message_log_partitions ORDER BY start DESC LIMIT 1"
+    )
+    newest = await cur.fetchone()
+    if newest is not None:
+        for name, query in PARTITION_QUERIES.items():
+            queries[f"{name} in {newest[0]}"] = HotQuery(
+                query.sql.format(partition=newest[0]), query.params, (newest[0],)
+            )
+    problems = []
+    for name, query in queries.items():
+        cur = await database.execute(f"EXPLAIN QUERY PLAN {query.sql}", query.params)
+        for *_, detail in await cur.fetchall():
+            words = detail.split()
+            if len(words) < 2 or words[0] not in ("SCAN", "SEARCH"):
+                continue
+            uses_index = "PRIMARY KEY" in detail or (
+                "INDEX" in detail and "AUTOMATIC" not in detail
+            )
+            if uses_index:
+                continue
+            if _table_name(query.sql, words[1]) in query.indexed_tables:
+                problems.append(f"{name}: {detail}")
+    return problems
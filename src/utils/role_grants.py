@@ -0,0 +1,292 @@
+"""
+Grants roles to members without hammering discord: a bounded amount of member
+edits per guild, one edit for every role a member is waiting on, and
+exponential backoff when discord refuses.
+"""
+import asyncio
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import discord
+
+
+@dataclass
+class GrantStats:
+    """
+    Counters describing how many member edits the dispatcher made.
+    """
+
+    requested: int = 0
+    # member edits sent to discord, one edit can grant several roles.
+    edits: int = 0
+    granted: int = 0
+    # grants that were folded into an edit that was already queued.
+    merged: int = 0
+    failures: int = 0
+    gave_up: int = 0
+
+
+@dataclass
+class PendingEdit:
+    """
+    The roles a member is waiting on, with the futures of everyone who asked
+    for each of them.
+    """
+
+    member: discord.Member
+    reason: Optional[str]
+    roles: Dict[int, discord.Role] = field(default_factory=dict)
+    waiters: Dict[int, List[asyncio.Future]] = field(default_factory=dict)
+    attempts: int = 0
+
+    def add(self, role: discord.Role, future: asyncio.Future) -> None:
+        """Adds a role to the edit, future is resolved once it was granted."""
+        self.roles[role.id] = role
+        self.waiters.setdefault(role.id, []).append(future)
+
+    def resolve(self, role_id: int, granted: bool) -> None:
+        """Tells everyone waiting on the role whether it was granted."""
+        for future in self.waiters.pop(role_id, []):
+            if not future.done():
+                future.set_result(granted)
+        self.roles.pop(role_id, None)
+
+
+class Backoff:
+    """
+    Exponential backoff per key: every failure doubles the delay up to maximum,
+    a success resets it.
+    """
+
+    def __init__(self, base: float, maximum: float):
+        self.base = base
+        self.maximum = maximum
+        # key -> (consecutive failures, monotonic time the key is blocked until)
+        self.blocked: Dict[object, Tuple[int, float]] = {}
+
+    def fail(self, key: object) -> float:
+        """Records a failure and returns how long the key is blocked for."""
+        failures = self.blocked.get(key, (0, 0.0))[0] + 1
+        delay = min(self.maximum, self.base * 2 ** (failures - 1))
+        self.blocked[key] = (failures, time.monotonic() + delay)
+        return delay
+
+    def succeed(self, key: object) -> None:
+        """Records a success, the next failure starts from the base delay again."""
+        self.blocked.pop(key, None)
+
+    def remaining(self, key: object) -> float:
+        """How many seconds the key is still blocked for."""
+        return max(0.0, self.blocked.get(key, (0, 0.0))[1] - time.monotonic())
+
+
+class RoleGrantDispatcher:  # pylint: disable=too-many-instance-attributes
+    """
+    Queues role grants and sends them as member edits, at most concurrency of
+    them at once per guild. Grants for a member whose edit hasn't been sent yet
+    are merged into it. When discord refuses with Forbidden the role is backed
+    off, any other HTTP error backs off the whole guild, and the grant is
+    retried until it failed max_attempts times.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 2,
+        backoff: float = 5,
+        max_backoff: float = 600,
+        max_attempts: int = 5,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = Backoff(backoff, max_backoff)
+        self.stats = GrantStats()
+        # edits that are waiting to be sent, by (guild id, member id).
+        self.queued: Dict[Tuple[int, int], PendingEdit] = {}
+        # members with an edit on its way to discord, set once it's done.
+        self._in_flight: Dict[Tuple[int, int], asyncio.Event] = {}
+        self._semaphores: Dict[int, asyncio.Semaphore] = {}
+        # the task sending each edit, queued, waiting or on its way to discord.
+        self._tasks: Dict[asyncio.Task, PendingEdit] = {}
+
+    @property
+    def depth(self) -> int:
+        """The amount of member edits waiting to be sent."""
+        return len(self.queued)
+
+    def grant(
+        self, member: discord.Member, role: discord.Role, reason: Optional[str] = None
+    ) -> asyncio.Future:
+        """
+        Queues a role for the member. Returns a future that resolves to True
+        once the member has the role, or False if the dispatcher gave up.
+        """
+        self.stats.requested += 1
+        future = asyncio.get_running_loop().create_future()
+        if role in member.roles:
+            future.set_result(True)
+            return future
+
+        key = (member.guild.id, member.id)
+        edit = self.queued.get(key)
+        if edit is not None:
+            self.stats.merged += 1
+            edit.add(role, future)
+            return future
+
+        edit = self.queued[key] = PendingEdit(member, reason)
+        edit.add(role, future)
+        self._spawn(edit)
+        return future
+
+    def _spawn(self, edit: PendingEdit) -> None:
+        task = asyncio.create_task(self._send(edit))
+        self._tasks[task] = edit
+        task.add_done_callback(self._forget)
+
+    def _forget(self, task: asyncio.Task) -> None:
+        self._tasks.pop(task, None)
+
+    def _delay(self, edit: PendingEdit) -> float:
+        """How long until neither the guild nor any of the roles is backed off."""
+        guild_id = edit.member.guild.id
+        return max(
+            [self.backoff.remaining(guild_id)]
+            + [self.backoff.remaining((guild_id, role_id)) for role_id in edit.roles]
+        )
+
+    async def _send(self, edit: PendingEdit) -> None:
+        member = edit.member
+        key = (member.guild.id, member.id)
+        semaphore = self._semaphores.setdefault(
+            member.guild.id, asyncio.Semaphore(self.concurrency)
+        )
+        while True:
+            # other grants can still be merged in while waiting.
+            delay = self._delay(edit)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                # the member's roles are only known once the previous edit landed.
+                await in_flight.wait()
+                continue
+            async with semaphore:
+                if self._delay(edit) > 0 or key in self._in_flight:
+                    continue
+                # from here on new grants for the member start a new edit.
+                if self.queued.get(key) is edit:
+                    del self.queued[key]
+                done = self._in_flight[key] = asyncio.Event()
+                try:
+                    await self._apply(edit)
+                finally:
+                    del self._in_flight[key]
+                    done.set()
+            return
+
+    @staticmethod
+    def _resolve_held(edit: PendingEdit) -> List[discord.Role]:
+        """Resolves the roles the member already has, returns the others."""
+        for role_id, role in list(edit.roles.items()):
+            if role in edit.member.roles:
+                edit.resolve(role_id, True)
+        return list(edit.roles.values())
+
+    async def _apply(self, edit: PendingEdit) -> None:
+        member = edit.member
+        guild_id = member.guild.id
+        roles = self._resolve_held(edit)
+        if not roles:
+            return
+
+        try:
+            if len(roles) > 1:
+                # atomic=False sends a single edit with the member's whole new role
+                # list instead of one request per role, so the list has to be
+                # current. The cached member can be missing roles granted or
+                # removed since it was queued, which the edit would undo.
+                member = edit.member = await member.guild.fetch_member(member.id)
+                roles = self._resolve_held(edit)
+                if not roles:
+                    return
+            self.stats.edits += 1
+            if len(roles) == 1:
+                await member.add_roles(roles[0], reason=edit.reason)
+            else:
+                await member.add_roles(*roles, reason=edit.reason, atomic=False)
+        except discord.NotFound as error:
+            # the member left the guild.
+            self.stats.failures += 1
+            self._give_up(edit, str(error))
+        except discord.Forbidden as error:
+            self.stats.failures += 1
+            if len(roles) > 1:
+                # find out which role is refused by trying them one by one.
+                for role in roles:
+                    single = PendingEdit(member, edit.reason, attempts=edit.attempts)
+                    single.roles[role.id] = role
+                    single.waiters[role.id] = edit.waiters.pop(role.id, [])
+                    self._spawn(single)
+                return
+            delay = self.backoff.fail((guild_id, roles[0].id))
+            self._retry(edit, f"{error} (role {roles[0].id})", delay)
+        except discord.HTTPException as error:
+            self.stats.failures += 1
+            delay = self.backoff.fail(guild_id)
+            self._retry(edit, str(error), delay)
+        else:
+            self.backoff.succeed(guild_id)
+            for role in roles:
+                self.backoff.succeed((guild_id, role.id))
+                edit.resolve(role.id, True)
+                self.stats.granted += 1
+
+    def _give_up(self, edit: PendingEdit, problem: str) -> None:
+        member = edit.member
+        print(
+            f"Giving up granting roles {list(edit.roles)} to {member.id} "
+            f"in guild {member.guild.id}: {problem}",
+            file=sys.stderr,
+        )
+        self.stats.gave_up += len(edit.roles)
+        for role_id in list(edit.roles):
+            edit.resolve(role_id, False)
+
+    def _retry(self, edit: PendingEdit, problem: str, delay: float) -> None:
+        member = edit.member
+        edit.attempts += 1
+        if edit.attempts >= self.max_attempts:
+            self._give_up(edit, problem)
+            return
+
+        print(
+            f"Failed to grant roles to {member.id} in guild {member.guild.id}, "
+            f"retrying in {delay:.0f}s: {problem}",
+            file=sys.stderr,
+        )
+        key = (member.guild.id, member.id)
+        queued = self.queued.get(key)
+        if queued is None:
+            self.queued[key] = edit
+            self._spawn(edit)
+            return
+        # another edit for the member was queued meanwhile, join it.
+        for role_id, role in edit.roles.items():
+            queued.roles[role_id] = role
+            queued.waiters.setdefault(role_id, []).extend(edit.waiters.get(role_id, []))
+        queued.attempts = max(queued.attempts, edit.attempts)
+
+    def stop(self) -> None:
+        """
+        Drops every edit that isn't done yet, whether it's queued, waiting for
+        its turn or on its way to discord, resolving its futures to False.
+        """
+        tasks, self._tasks = self._tasks, {}
+        for task, edit in tasks.items():
+            task.cancel()
+            for role_id in list(edit.waiters):
+                edit.resolve(role_id, False)
+        self.queued.clear()
@@ -0,0 +1,81 @@
+"""
+"Did you mean ...?" suggestions for mistyped command names, from an n-gram
+index over every command name and alias.
+"""
+import difflib
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from discord.ext import commands
+
+# how similar a name has to be to be suggested, the same as difflib's default.
+CUTOFF = 0.6
+
+
+def bigrams(word: str) -> Set[str]:
+    """
+    The pairs of neighbouring characters in word, padded so the first and
+    last character get a pair of their own.
+    """
+    padded = f"^{word}$"
+    return {padded[i : i + 2] for i in range(len(padded) - 1)}
+
+
+class SuggestionIndex:
+    """
+    Maps every bigram to the command names and aliases containing it. A lookup
+    only scores the names that share a bigram with the typo, with the same
+    similarity ratio difflib.get_close_matches uses. The index is built from
+    source() on the first lookup after invalidate, so the bot only has to call
+    invalidate whenever a command is added or removed.
+    """
+
+    def __init__(self, source: Callable[[], Iterable[commands.Command]]):
+        self.source = source
+        self.index: Optional[Dict[str, List[str]]] = None
+        # command name or alias -> the command's qualified name.
+        self.names: Dict[str, str] = {}
+
+    def invalidate(self) -> None:
+        """Rebuilds the index on the next lookup."""
+        self.index = None
+
+    def build(self) -> Dict[str, List[str]]:
+        """Builds the index from the source's commands."""
+        self.names = {}
+        for command in self.source():
+            for name in (command.name, *command.aliases):
+                self.names.setdefault(name, command.qualified_name)
+        index: Dict[str, List[str]] = {}
+        for name in self.names:
+            for bigram in bigrams(name):
+                index.setdefault(bigram, []).append(name)
+        self.index = index
+        return index
+
+    def suggest(self, word: str, limit: int = 1) -> List[str]:
+        """
+        The commands whose name or an alias is most similar to word,
+        best match first.
+        """
+        index = self.index if self.index is not None else self.build()
+        candidates = {
+            name for bigram in bigrams(word) for name in index.get(bigram, ())
+        }
+
+        matcher = difflib.SequenceMatcher()
+        # seq2 is the one difflib caches information about.
+        matcher.set_seq2(word)
+        scored = []
+        for name in candidates:
+            matcher.set_seq1(name)
+            if matcher.real_quick_ratio() < CUTOFF or matcher.quick_ratio() < CUTOFF:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= CUTOFF:
+                scored.append((ratio, name))
+
+        suggestions: List[str] = []
+        for _, name in sorted(scored, reverse=True):
+            if self.names[name] not in suggestions:
+                suggestions.append(self.names[name])
+        return suggestions[:limit]